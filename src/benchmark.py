@@ -0,0 +1,465 @@
+import argparse
+import bisect
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import host_index
+import new_task
+import utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+CHUNK_PAIRS = 250000
+# sequences of the dataset, set once in each generator worker
+chunk_sources = {}
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choices('ACGT', k=length))
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def dataset_key(params):
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def plant_variants(rng, ref_dict, variant_num):
+    # SNVs at distinct positions, spread over segments by length
+    headers = list(ref_dict)
+    cum_len = list(accumulate_len(ref_dict[h] for h in headers))
+    positions = set()
+    while len(positions) < min(variant_num, cum_len[-1]):
+        positions.add(rng.randrange(cum_len[-1]))
+    alt_dict = {h: list(seq) for h, seq in ref_dict.items()}
+    variants = []
+    for p in sorted(positions):
+        i = bisect.bisect_right(cum_len, p)
+        header = headers[i]
+        pos = p - (cum_len[i-1] if i > 0 else 0)
+        ref_base = alt_dict[header][pos]
+        alt_base = rng.choice([b for b in 'ACGT' if b != ref_base])
+        alt_dict[header][pos] = alt_base
+        variants.append({'contig': header, 'pos': pos + 1, 'ref': ref_base, 'alt': alt_base})
+    return {h: ''.join(seq) for h, seq in alt_dict.items()}, variants
+
+
+def accumulate_len(seqs):
+    total = 0
+    for seq in seqs:
+        total += len(seq)
+        yield total
+
+
+def init_chunk_worker(sources):
+    chunk_sources.update(sources)
+
+
+def pick_contig(rng, source):
+    seqs, cum_len = source
+    return seqs[bisect.bisect_right(cum_len, rng.randrange(cum_len[-1]))]
+
+
+def add_errors(rng, read, error_rate):
+    # geometric skips between errors, a few random draws per read instead of one per base
+    if error_rate <= 0:
+        return read
+    bases = None
+    pos = -1
+    log_q = math.log(1 - error_rate)
+    while True:
+        pos += 1 + int(math.log(1 - rng.random()) / log_q)
+        if pos >= len(read):
+            break
+        if bases == None:
+            bases = list(read)
+        bases[pos] = rng.choice([b for b in 'ACGT' if b != bases[pos]])
+    return read if bases == None else ''.join(bases)
+
+
+def generate_chunk(chunk_inputs):
+    # run in a worker process, writes one gzip member per read file which are concatenated later
+    rng = random.Random(chunk_inputs['seed'])
+    read_len = chunk_inputs['read_len']
+    qual = 'F' * read_len
+    source_names = list(chunk_inputs['fractions'])
+    source_weights = [chunk_inputs['fractions'][s] for s in source_names]
+    counts = {s: 0 for s in source_names}
+    r1_lines = []
+    r2_lines = []
+    for i in range(chunk_inputs['pairs']):
+        source = rng.choices(source_names, weights=source_weights)[0]
+        if source == 'viral' and rng.random() < chunk_inputs['variant_af']:
+            seq = pick_contig(rng, chunk_sources['viral_alt'])
+        else:
+            seq = pick_contig(rng, chunk_sources[source])
+        frag_len = int(rng.gauss(chunk_inputs['fragment_len'], chunk_inputs['fragment_len'] / 10))
+        frag_len = min(len(seq), max(read_len, frag_len))
+        start = rng.randrange(len(seq) - frag_len + 1)
+        frag = seq[start:start+frag_len]
+        if rng.random() < 0.5:
+            frag = reverse_complement(frag)
+        r1 = add_errors(rng, frag[:read_len], chunk_inputs['error_rate'])
+        r2 = add_errors(rng, reverse_complement(frag)[:read_len], chunk_inputs['error_rate'])
+        name = 'SYN%d.%d:%s' % (chunk_inputs['chunk'], i, source)
+        r1_lines.append('@%s 1:N:0:1\n%s\n+\n%s\n' % (name, r1, qual[:len(r1)]))
+        r2_lines.append('@%s 2:N:0:1\n%s\n+\n%s\n' % (name, r2, qual[:len(r2)]))
+        counts[source] += 1
+    for path, lines in ((chunk_inputs['r1_path'], r1_lines), (chunk_inputs['r2_path'], r2_lines)):
+        with gzip.open(path, 'wt', compresslevel=1) as f:
+            f.write(''.join(lines))
+    return counts
+
+
+def host_index_prefix(params):
+    # synthetic host genome index in /app/genomes, so it is used as a custom --remove_host genome
+    host_key = dataset_key({'host_len': params['host_len'], 'seed': params['seed']})
+    return 'viva_bench_host_%s' % host_key
+
+
+def prepare_host(params, threads):
+    remove_host = host_index_prefix(params)
+    index_prefix = host_index.host_genome(remove_host)[1]
+    if len(host_index.index_files(index_prefix)) > 0 and Path(index_prefix + '.fasta').is_file():
+        return remove_host, utils.load_fasta_file(index_prefix + '.fasta')
+    logger.info('Building synthetic host genome index %s.' % remove_host)
+    rng = random.Random('host-%d' % params['seed'])
+    host_dict = {'bench_host_chr%d' % (n+1): random_seq(rng, params['host_len'] // 4) for n in range(4)}
+    Path.mkdir(Path(index_prefix).parent, parents=True, exist_ok=True)
+    utils.build_fasta_file(index_prefix + '.fasta', host_dict)
+    subprocess.run(
+        ['bowtie2-build', '--threads', str(threads), index_prefix + '.fasta', index_prefix],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return remove_host, host_dict
+
+
+def generate_dataset(bench_path, params, gen_workers, threads):
+    # Datasets are kept by their generation params, the same sweep point is generated once.
+    dataset_path = bench_path.joinpath('datasets', dataset_key(params))
+    dataset_meta_path = dataset_path.joinpath('dataset.json')
+    if dataset_meta_path.is_file():
+        logger.info('Using synthetic dataset %s.' % dataset_path.name)
+        return utils.load_json_file(dataset_meta_path)
+    Path.mkdir(dataset_path, parents=True, exist_ok=True)
+    logger.info('Generating synthetic dataset %s (%d read pairs).' % (dataset_path.name, params['read_pairs']))
+    rng = random.Random(params['seed'])
+    seg_len = max(params['fragment_len'], params['ref_len'] // params['ref_segments'])
+    ref_dict = {'bench_seg%d' % (n+1): random_seq(rng, seg_len) for n in range(params['ref_segments'])}
+    alt_dict, variants = plant_variants(rng, ref_dict, params['variants'])
+    meta = {
+        'dataset': dataset_path.name,
+        'params': params,
+        'ref': str(dataset_path.joinpath('ref.fasta')),
+        'remove_impurities': None,
+        'remove_host': None,
+        'variants': variants
+    }
+    utils.build_fasta_file(meta['ref'], ref_dict)
+    sources = {'viral': ref_dict, 'viral_alt': alt_dict}
+    fractions = {'viral': 1 - params['host_fraction'] - params['impurity_fraction']}
+    if params['impurity_fraction'] > 0:
+        impurities_dict = {
+            'bench_impurity%d' % (n+1): random_seq(rng, params['impurity_len'])
+            for n in range(params['impurities'])
+        }
+        meta['remove_impurities'] = str(dataset_path.joinpath('impurities.fasta'))
+        utils.build_fasta_file(meta['remove_impurities'], impurities_dict)
+        sources['impurity'] = impurities_dict
+        fractions['impurity'] = params['impurity_fraction']
+    if params['host_fraction'] > 0:
+        meta['remove_host'], sources['host'] = prepare_host(params, threads)
+        fractions['host'] = params['host_fraction']
+    if fractions['viral'] <= 0:
+        raise ValueError('host_fraction and impurity_fraction leave no viral reads.')
+    sources = {
+        name: (list(seq_dict.values()), list(accumulate_len(seq_dict.values())))
+        for name, seq_dict in sources.items()
+    }
+
+    chunks = []
+    for n, start in enumerate(range(0, params['read_pairs'], CHUNK_PAIRS)):
+        chunks.append({
+            'chunk': n,
+            'seed': params['seed'] * 1000003 + n,
+            'pairs': min(CHUNK_PAIRS, params['read_pairs'] - start),
+            'read_len': params['read_len'],
+            'fragment_len': params['fragment_len'],
+            'error_rate': params['error_rate'],
+            'variant_af': params['variant_af'],
+            'fractions': fractions,
+            'r1_path': dataset_path.joinpath('part_%d_R1.fastq.gz' % n),
+            'r2_path': dataset_path.joinpath('part_%d_R2.fastq.gz' % n)
+        })
+    counts = {s: 0 for s in fractions}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=gen_workers, initializer=init_chunk_worker, initargs=(sources,)) as executor:
+        for chunk_counts in executor.map(generate_chunk, chunks):
+            for s, c in chunk_counts.items():
+                counts[s] += c
+    # gzip members concatenate into one valid gzip file
+    for read in ('R1', 'R2'):
+        meta['ex_' + read.lower()] = str(dataset_path.joinpath('bench_%s.fastq.gz' % read))
+        with open(meta['ex_' + read.lower()], 'wb') as out:
+            for chunk in chunks:
+                part_path = chunk['r1_path'] if read == 'R1' else chunk['r2_path']
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, out, 8388608)
+                os.remove(part_path)
+    meta['read_counts'] = counts
+    utils.build_json_file(dataset_meta_path, meta)
+    return meta
+
+
+def sample_tree_rss(stop_event, peak):
+    # Sum of VmRSS of all descendants, concurrent stages add up unlike the per-process ru_maxrss.
+    root_pid = os.getpid()
+    while not stop_event.wait(1):
+        children = {}
+        rss = {}
+        for proc in Path('/proc').iterdir():
+            if not proc.name.isdigit():
+                continue
+            try:
+                status = proc.joinpath('status').read_text()
+            except OSError:
+                continue
+            fields = dict(line.split(':', 1) for line in status.split('\n') if ':' in line)
+            children.setdefault(int(fields['PPid']), []).append(int(proc.name))
+            rss[int(proc.name)] = int(fields['VmRSS'].split()[0]) if 'VmRSS' in fields else 0
+        tree_rss = 0
+        stack = list(children.get(root_pid, []))
+        while stack:
+            pid = stack.pop()
+            tree_rss += rss.get(pid, 0)
+            stack.extend(children.get(pid, []))
+        peak['tree_rss_kb'] = max(peak['tree_rss_kb'], tree_rss)
+
+
+def run_bench_task(task_args):
+    # run in a fresh worker process, its rusage covers the pipeline and every tool it waited for
+    try:
+        task_id = new_task.main(task_args)
+    except SystemExit as e:
+        raise RuntimeError('Task exited with code %s' % e.code)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'task_id': task_id,
+        'user_time': round(self_usage.ru_utime + children_usage.ru_utime, 3),
+        'sys_time': round(self_usage.ru_stime + children_usage.ru_stime, 3),
+        'peak_rss_kb': max(self_usage.ru_maxrss, children_usage.ru_maxrss)
+    }
+
+
+def stage_results(summary):
+    stages = {}
+    for stage_run in summary.get('stage_metrics', []):
+        if stage_run['status'] != 'finished':
+            continue
+        stage_cmds = [
+            m for m in summary.get('cmd_metrics', [])
+            if m.get('stage') == stage_run['stage']
+            and stage_run['start_time'] <= m['start_time'] <= stage_run['finish_time']
+        ]
+        stages[stage_run['stage']] = {
+            'wall_time': round(stage_run['finish_time'] - stage_run['start_time'], 3),
+            'cpu_time': round(sum(m['user_time'] + m['sys_time'] for m in stage_cmds), 3),
+            'peak_rss_kb': max([m['max_rss_kb'] for m in stage_cmds], default=None),
+            'read_bytes': stage_run.get('read_bytes'),
+            'write_bytes': stage_run.get('write_bytes'),
+            'threads': stage_run.get('threads')
+        }
+    return stages
+
+
+def compare_baseline(result, baseline_runs, tolerance):
+    # the latest baseline run of the same dataset and pipeline args
+    same_runs = [
+        r for r in baseline_runs
+        if r['dataset'] == result['dataset'] and r['pipeline_args'] == result['pipeline_args']
+        and r['status'] == 'done'
+    ]
+    if len(same_runs) == 0:
+        return None
+    baseline = same_runs[-1]
+    regressions = []
+    timings = [('total', baseline['wall_time'], result['wall_time'])] + [
+        (stage, baseline['stages'][stage]['wall_time'], v['wall_time'])
+        for stage, v in result['stages'].items() if stage in baseline['stages']
+    ]
+    for name, base_time, new_time in timings:
+        # sub-second stages are too noisy to compare
+        if base_time >= 1 and new_time > base_time * (1 + tolerance):
+            regressions.append({'name': name, 'baseline': base_time, 'current': new_time})
+            logger.warning('Regression in %s: %.1f s -> %.1f s.' % (name, base_time, new_time))
+    changed_versions = {
+        k: [baseline['version'].get(k), v] for k, v in result['version'].items()
+        if baseline['version'].get(k) != v
+    }
+    return {
+        'baseline_time': baseline['time'],
+        'regressions': regressions,
+        'changed_versions': changed_versions
+    }
+
+
+def run_benchmark(params, pipeline_args, bench_path, gen_workers, baseline_runs, tolerance):
+    threads = int(pipeline_args[pipeline_args.index('--threads')+1]) if '--threads' in pipeline_args else 6
+    dataset = generate_dataset(bench_path, params, gen_workers, threads)
+    task_args = [
+        '--prefix', 'bench-%s' % dataset['dataset'],
+        '--ex_r1', dataset['ex_r1'],
+        '--ex_r2', dataset['ex_r2'],
+        '--ref', dataset['ref']
+    ]
+    if dataset['remove_impurities'] != None:
+        task_args += ['--remove_impurities', dataset['remove_impurities']]
+    if dataset['remove_host'] != None:
+        task_args += ['--remove_host', dataset['remove_host']]
+    result = {
+        'time': int(time.time()),
+        'dataset': dataset['dataset'],
+        'dataset_params': params,
+        'read_counts': dataset['read_counts'],
+        'pipeline_args': pipeline_args,
+        'status': 'done'
+    }
+    peak = {'tree_rss_kb': 0}
+    stop_event = threading.Event()
+    sampler = threading.Thread(target=sample_tree_rss, args=(stop_event, peak), daemon=True)
+    sampler.start()
+    start_monotonic = time.monotonic()
+    try:
+        # a fresh process per run, so rusage and imported state do not carry over between runs
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            usage = executor.submit(run_bench_task, task_args + pipeline_args).result()
+    except Exception as e:
+        logger.error('Benchmark run of dataset %s failed: %s' % (dataset['dataset'], str(e)))
+        result['status'] = 'Error: %s' % e
+        return result
+    finally:
+        result['wall_time'] = round(time.monotonic() - start_monotonic, 3)
+        stop_event.set()
+        sampler.join()
+    summary = utils.load_json_file(Path.cwd().joinpath(
+        'tasks', usage['task_id'], usage['task_id'] + '_summary.json'))
+    reads = params['read_pairs'] * 2
+    result.update(usage)
+    result.update({
+        'peak_tree_rss_kb': peak['tree_rss_kb'],
+        'reads_per_s': round(reads / result['wall_time'], 1),
+        'bases_per_s': round(reads * params['read_len'] / result['wall_time'], 1),
+        'task_dir_peak_bytes': summary.get('task_dir_peak_bytes'),
+        'version': summary.get('version', {}),
+        'stages': stage_results(summary)
+    })
+    result['baseline'] = compare_baseline(result, baseline_runs, tolerance)
+    logger.info('Benchmark %s: %d read pairs in %.1f s (%.0f reads/s), peak RSS %d MB.' % (
+        result['dataset'], params['read_pairs'], result['wall_time'], result['reads_per_s'],
+        max(result['peak_rss_kb'], result['peak_tree_rss_kb']) // 1024))
+    return result
+
+
+def main(input_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--read_pairs', help="Read pairs of the synthetic dataset, a comma separated list runs a sweep (e.g. 1000000,10000000). Default: from --depth.", default=None)
+    parser.add_argument(
+        '--depth', help="Mean depth of the reference when --read_pairs is not given.", default='100')
+    parser.add_argument(
+        '--read_len', help="Read length.", default='150')
+    parser.add_argument(
+        '--fragment_len', help="Mean fragment (insert) length.", default='350')
+    parser.add_argument(
+        '--error_rate', help="Per base substitution error rate.", default='0.001')
+    parser.add_argument(
+        '--ref_len', help="Total reference length (bp).", default='30000')
+    parser.add_argument(
+        '--ref_segments', help="Number of reference segments (FASTA records).", default='1')
+    parser.add_argument(
+        '--variants', help="Number of planted SNVs.", default='20')
+    parser.add_argument(
+        '--variant_af', help="Allele frequency of the planted SNVs.", default='1.0')
+    parser.add_argument(
+        '--host_fraction', help="Fraction of read pairs from the synthetic host genome.", default='0')
+    parser.add_argument(
+        '--host_len', help="Synthetic host genome length (bp).", default='5000000')
+    parser.add_argument(
+        '--impurity_fraction', help="Fraction of read pairs from the synthetic impurity sequences.", default='0')
+    parser.add_argument(
+        '--impurities', help="Number of synthetic impurity sequences.", default='2')
+    parser.add_argument(
+        '--impurity_len', help="Length (bp) of each synthetic impurity sequence.", default='5000')
+    parser.add_argument(
+        '--seed', help="Random seed of the synthetic dataset.", default='1')
+    parser.add_argument(
+        '--gen_workers', help="Worker processes generating reads. Default: all CPUs.", default=None)
+    parser.add_argument(
+        '--repeat', help="Runs per sweep point.", default='1')
+    parser.add_argument(
+        '--bench_out', help="Benchmark results JSON file, results are appended.", default=None)
+    parser.add_argument(
+        '--bench_baseline', help="Results JSON file of an earlier benchmark to compare stage timings with.", default=None)
+    parser.add_argument(
+        '--bench_tolerance', help="Slowdown ratio reported as a regression against the baseline.", default='0.2')
+    args, pipeline_args = parser.parse_known_args(input_args)
+    # remaining args go to new_task, e.g. --threads, --alns, --unmapped_assemble
+    pipeline_args = [a for a in pipeline_args if a != '--benchmark']
+
+    bench_path = Path.cwd().joinpath('tasks', 'benchmarks')
+    Path.mkdir(bench_path, parents=True, exist_ok=True)
+    bench_out = Path(args.bench_out) if args.bench_out != None else bench_path.joinpath('benchmark_results.json')
+    baseline_runs = utils.load_json_file(args.bench_baseline) if args.bench_baseline != None else []
+    gen_workers = int(args.gen_workers) if args.gen_workers != None else os.cpu_count()
+
+    params = {
+        'read_len': int(args.read_len),
+        'fragment_len': int(args.fragment_len),
+        'error_rate': float(args.error_rate),
+        'ref_len': int(args.ref_len),
+        'ref_segments': int(args.ref_segments),
+        'variants': int(args.variants),
+        'variant_af': float(args.variant_af),
+        'host_fraction': float(args.host_fraction),
+        'host_len': int(args.host_len),
+        'impurity_fraction': float(args.impurity_fraction),
+        'impurities': int(args.impurities),
+        'impurity_len': int(args.impurity_len),
+        'seed': int(args.seed)
+    }
+    if args.read_pairs != None:
+        read_pairs_list = [int(float(n)) for n in args.read_pairs.split(',')]
+    else:
+        viral_fraction = 1 - params['host_fraction'] - params['impurity_fraction']
+        read_pairs_list = [int(float(args.depth) * params['ref_len'] / (2 * params['read_len']) / viral_fraction)]
+
+    for read_pairs in read_pairs_list:
+        for _ in range(int(args.repeat)):
+            result = run_benchmark(
+                dict(params, read_pairs=read_pairs), pipeline_args, bench_path,
+                gen_workers, baseline_runs, float(args.bench_tolerance))
+            results = utils.load_json_file(bench_out) if bench_out.is_file() else []
+            results.append(result)
+            utils.build_json_file(bench_out, results)
+    logger.info('Benchmark results written to %s.' % bench_out)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+import index_cache
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# keys per SELECT, below the SQLite host parameter limit
+LOOKUP_BATCH = 500
+
+
+def cache_enabled(task):
+    return getattr(task, 'blast_cache', 'True') == 'True'
+
+
+def cache_db_path(task):
+    # inside the tasks folder like the index cache, so all tasks of the mounted tasks volume share it
+    return task.path.joinpath('blast_cache', 'blast_cache.db')
+
+
+def connect(task):
+    db_path = cache_db_path(task)
+    Path.mkdir(db_path.parent, parents=True, exist_ok=True)
+    # concurrent tasks of a batch wait for the write lock instead of failing
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS Blast_Hits (
+            cache_key TEXT PRIMARY KEY,
+            db_name TEXT,
+            db_date TEXT,
+            hits TEXT,
+            created INTEGER
+        )
+    ''')
+    return conn
+
+
+def search_key(db, db_date, search_params):
+    # database name, its date from blastdbcmd -info, the blastn version and options decide the hits
+    key_text = '%s\t%s\t%s\t%s' % (db, db_date, index_cache.tool_version('blastn'), search_params)
+    return hashlib.md5(key_text.encode('utf-8')).hexdigest()
+
+
+def contig_key(seq, db_search_key):
+    return hashlib.md5(('%s\t%s' % (db_search_key, seq.upper())).encode('utf-8')).hexdigest()
+
+
+def lookup(task, keys):
+    # cache_key -> hit lines without the qseqid column, contigs without hits are cached as an empty list
+    keys = list(set(keys))
+    found = {}
+    conn = connect(task)
+    try:
+        for i in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[i:i + LOOKUP_BATCH]
+            rows = conn.execute(
+                'SELECT cache_key, hits FROM Blast_Hits WHERE cache_key IN (%s)' % ','.join('?' * len(batch)), batch)
+            for key, hits in rows:
+                found[key] = hits.split('\n') if hits != '' else []
+    finally:
+        conn.close()
+    return found
+
+
+def store(task, db, db_date, entries):
+    # entries: cache_key -> hit lines without the qseqid column
+    created = int(time.time())
+    conn = connect(task)
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO Blast_Hits (cache_key, db_name, db_date, hits, created) VALUES (?, ?, ?, ?, ?)',
+                [(key, db, db_date, '\n'.join(hits), created) for key, hits in entries.items()])
+    finally:
+        conn.close()
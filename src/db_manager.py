@@ -21,7 +21,8 @@ class VIVADatabase:
         self._init_tables()
 
     def _get_connection(self):
-        return sqlite3.connect(self.db_path)
+        # 批次模式下多個任務程序會同時寫入，等待鎖定釋放而非立即失敗
+        return sqlite3.connect(self.db_path, timeout=60)
 
     def _init_tables(self):
         """建立 SQLite 關聯資料表 (如果尚不存在)"""
@@ -122,6 +123,50 @@ class VIVADatabase:
             )
         ''')
 
+        # 7. 外部指令資源使用表 (Command_Metrics)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Command_Metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT,
+                stage TEXT,
+                log_name TEXT,
+                tool TEXT,
+                command TEXT,
+                threads INTEGER,
+                start_time REAL,
+                wall_time REAL, -- 秒 (monotonic)
+                user_time REAL, -- 秒
+                sys_time REAL, -- 秒
+                max_rss_kb INTEGER,
+                read_bytes INTEGER, -- /proc/<pid>/io，含已回收的子程序
+                write_bytes INTEGER,
+                returncode INTEGER,
+                FOREIGN KEY(task_id) REFERENCES Tasks(task_id)
+            )
+        ''')
+
+        # 8. 分析階段磁碟用量表 (Stage_Metrics)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Stage_Metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT,
+                stage TEXT,
+                status TEXT, -- 'finished', 'skipped'
+                threads INTEGER,
+                start_time REAL,
+                finish_time REAL,
+                task_dir_bytes_start INTEGER, -- 階段開始時任務資料夾大小
+                task_dir_bytes_end INTEGER, -- 階段結束時任務資料夾大小
+                read_bytes INTEGER, -- 外部指令與 Python 讀取量合計
+                write_bytes INTEGER, -- 外部指令與 Python 寫入量合計
+                cmd_read_bytes INTEGER,
+                cmd_write_bytes INTEGER,
+                python_read_bytes INTEGER,
+                python_write_bytes INTEGER,
+                FOREIGN KEY(task_id) REFERENCES Tasks(task_id)
+            )
+        ''')
+
         conn.commit()
         conn.close()
 
@@ -168,8 +213,23 @@ class VIVADatabase:
         finally:
             if conn: conn.close()
             
-    def save_final_summary(self, task_id, s_dict):
-        """讀取最終的 summary.json dict 並寫入資料庫表"""
+    def _variant_rows_from_summary(self, task_id, s_dict, ref_num):
+        """由 summary 的 vc 巢狀字典整理 Variants 資料列"""
+        variant_rows = []
+        for order in range(1, ref_num + 1):
+            o_str = str(order)
+            for caller in ['lofreq', 'varscan']:
+                caller_snv = s_dict.get('vc', {}).get(caller, {}).get(o_str, {})
+                for pos, v_data in caller_snv.items():
+                    ref = v_data.get('REF')
+                    for alt, aln_result in v_data.get('SNV', {}).items():
+                        bt2_af = aln_result.get('bowtie2', {}).get('FREQ')
+                        bwa_af = aln_result.get('bwa', {}).get('FREQ')
+                        variant_rows.append((task_id, order, pos, ref, alt, caller, bt2_af, bwa_af))
+        return variant_rows
+
+    def save_final_summary(self, task_id, s_dict, variant_rows=None):
+        """讀取最終的 summary.json dict 並寫入資料庫表；variant_rows 為變異位點表 (vc_table.variant_rows) 整理好的列，未給定時由 s_dict['vc'] 整理"""
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
@@ -223,34 +283,17 @@ class VIVADatabase:
                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                         ''', (task_id, order, header, aligner, m_reads, m_rate, cov_pct, mean_dp))
                         
-            # 4. Insert Variants (LoFreq)
-            for order in range(1, ref_num + 1):
-                o_str = str(order)
-                lofreq_snv = s_dict.get('vc', {}).get('lofreq', {}).get(o_str, {})
-                for pos, v_data in lofreq_snv.items():
-                    ref = v_data.get('REF')
-                    for alt, aln_result in v_data.get('SNV', {}).items():
-                        bt2_af = aln_result.get('bowtie2', {}).get('FREQ')
-                        bwa_af = aln_result.get('bwa', {}).get('FREQ')
-                        cursor.execute('''
-                            INSERT INTO Variants
-                            (task_id, ref_order, position, ref_base, alt_base, caller, bt2_af, bwa_af)
-                            VALUES (?, ?, ?, ?, ?, 'lofreq', ?, ?)
-                        ''', (task_id, order, pos, ref, alt, bt2_af, bwa_af))
-                        
-                # Varscan
-                varscan_snv = s_dict.get('vc', {}).get('varscan', {}).get(o_str, {})
-                for pos, v_data in varscan_snv.items():
-                    ref = v_data.get('REF')
-                    for alt, aln_result in v_data.get('SNV', {}).items():
-                        bt2_af = aln_result.get('bowtie2', {}).get('FREQ')
-                        bwa_af = aln_result.get('bwa', {}).get('FREQ')
-                        cursor.execute('''
-                            INSERT INTO Variants
-                            (task_id, ref_order, position, ref_base, alt_base, caller, bt2_af, bwa_af)
-                            VALUES (?, ?, ?, ?, ?, 'varscan', ?, ?)
-                        ''', (task_id, order, pos, ref, alt, bt2_af, bwa_af))
-                        
+            # 4. Insert Variants (LoFreq, Varscan), 逐列整理後一次批次寫入
+            if variant_rows is not None:
+                variant_rows = [(task_id,) + row for row in variant_rows]
+            else:
+                variant_rows = self._variant_rows_from_summary(task_id, s_dict, ref_num)
+            cursor.executemany('''
+                INSERT INTO Variants
+                (task_id, ref_order, position, ref_base, alt_base, caller, bt2_af, bwa_af)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', variant_rows)
+
             # 5. Insert Impurities Stats
             im_meta = s_dict.get('impurit_filter_meta', {}).get('seq_meta', {})
             im_results = s_dict.get('impurit_filter_results', {})
@@ -306,6 +349,37 @@ class VIVADatabase:
                     VALUES (?, ?, ?)
                 ''', (task_id, db_name, hit_count))
 
+            # 7. Insert Command Metrics
+            for m in s_dict.get('cmd_metrics', []):
+                cursor.execute('''
+                    INSERT INTO Command_Metrics
+                    (task_id, stage, log_name, tool, command, threads, start_time,
+                    wall_time, user_time, sys_time, max_rss_kb, read_bytes, write_bytes, returncode)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    task_id, m.get('stage'), m.get('log'), m.get('tool'), m.get('cmd'),
+                    int(m['threads']) if str(m.get('threads', '')).isdigit() else None,
+                    m.get('start_time'), m.get('wall_time'), m.get('user_time'), m.get('sys_time'),
+                    m.get('max_rss_kb'), m.get('read_bytes'), m.get('write_bytes'), m.get('returncode')
+                ))
+
+            # 8. Insert Stage Metrics
+            for m in s_dict.get('stage_metrics', []):
+                cursor.execute('''
+                    INSERT INTO Stage_Metrics
+                    (task_id, stage, status, threads, start_time, finish_time,
+                    task_dir_bytes_start, task_dir_bytes_end, read_bytes, write_bytes,
+                    cmd_read_bytes, cmd_write_bytes, python_read_bytes, python_write_bytes)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    task_id, m.get('stage'), m.get('status'), m.get('threads'),
+                    m.get('start_time'), m.get('finish_time'),
+                    m.get('task_dir_bytes_start'), m.get('task_dir_bytes_end'),
+                    m.get('read_bytes'), m.get('write_bytes'),
+                    m.get('cmd_read_bytes'), m.get('cmd_write_bytes'),
+                    m.get('python_read_bytes'), m.get('python_write_bytes')
+                ))
+
             conn.commit()
         except sqlite3.Error as e:
             logger.error(f"DB Error (save_final_summary): {e}")
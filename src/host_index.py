@@ -0,0 +1,121 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import index_cache
+import utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+HOST_GENOMES = {
+    'dog': ('Dog (Dog10K_Boxer_Tasha, GCF_000002285.5)', 'dog10k'),
+    'human': ('Human (GRCh38.p14, GCF_000001405.40)', 'GRCh38.p14'),
+    'vero': ('Vero (Vero_WHO_p1.0, GCF_015252025.1)', 'vero'),
+    'chicken': ('Chicken (GRCg6a, GCF_000002315.6)', 'grcg6a'),
+    'rhesus_monkey': ('Rhesus monkey (Mmul_10, GCF_003339765.1)', 'mmul_10')
+}
+
+
+def host_genome(remove_host):
+    # genome description for dehost_meta.json and bowtie2 index prefix
+    if remove_host in HOST_GENOMES:
+        genome, index_name = HOST_GENOMES[remove_host]
+    else:
+        genome, index_name = 'Custom sequence file (%s)' % remove_host, remove_host
+    return genome, '/app/genomes/' + index_name
+
+
+def index_files(index_prefix):
+    index_prefix = Path(index_prefix)
+    return sorted(
+        p for p in index_prefix.parent.glob(index_prefix.name + '.*')
+        if p.is_file() and p.name[len(index_prefix.name):] in index_cache.INDEX_SUFFIXES
+    )
+
+
+def mem_cap_bytes(host_index_mem):
+    # 'auto' keeps resident host indexes under half of the physical memory
+    if host_index_mem in (None, 'auto'):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    return int(float(host_index_mem) * 1024**3)
+
+
+@contextmanager
+def resident_state(tasks_path):
+    # Resident index records are shared by all tasks and batch workers, guarded by a file lock.
+    Path.mkdir(Path(tasks_path), parents=True, exist_ok=True)
+    state_path = Path(tasks_path).joinpath('host_index_resident.json')
+    with open(Path(tasks_path).joinpath('host_index_resident.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            state = utils.load_json_file(state_path) if state_path.is_file() else {}
+            yield state
+            utils.build_json_file(state_path, state)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def drop_index(index_prefix):
+    # hint the kernel to release the cached pages, pages mapped by a running bowtie2 --mm stay
+    for p in index_files(index_prefix):
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def read_index(index_prefix):
+    for p in index_files(index_prefix):
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            while os.read(fd, 8388608):
+                pass
+        finally:
+            os.close(fd)
+
+
+def warm(tasks_path, index_prefix, cap_bytes):
+    # Load the index files into the page cache, so bowtie2 --mm of every task maps the same pages.
+    index_bytes = sum(p.stat().st_size for p in index_files(index_prefix))
+    if index_bytes == 0:
+        logger.warning('Host index %s not found, skip warming.' % index_prefix)
+        return False
+    if index_bytes > cap_bytes:
+        logger.warning('Host index %s (%d MB) exceeds host index memory cap, skip warming.' % (
+            index_prefix, index_bytes // 1024**2))
+        return False
+    with resident_state(tasks_path) as state:
+        if index_prefix not in state:
+            # least recently used resident indexes leave first
+            resident_bytes = sum(v['bytes'] for v in state.values())
+            for prefix, _ in sorted(state.items(), key=lambda item: item[1]['last_used']):
+                if resident_bytes + index_bytes <= cap_bytes:
+                    break
+                logger.info('Releasing host index %s from memory.' % prefix)
+                drop_index(prefix)
+                resident_bytes -= state.pop(prefix)['bytes']
+        state[index_prefix] = {'bytes': index_bytes, 'last_used': int(time.time())}
+    logger.info('Warming host index %s (%d MB).' % (index_prefix, index_bytes // 1024**2))
+    # files already in the page cache read back fast, a re-warm also restores pages the kernel dropped
+    read_index(index_prefix)
+    return True
+
+
+def warm_in_background(tasks_path, index_prefixes, cap_bytes):
+    def warm_all():
+        for index_prefix in index_prefixes:
+            try:
+                warm(tasks_path, index_prefix, cap_bytes)
+            except OSError as e:
+                logger.warning('Warming host index %s failed: %s' % (index_prefix, str(e)))
+
+    warm_thread = threading.Thread(target=warm_all, daemon=True)
+    warm_thread.start()
+    return warm_thread
@@ -1,9 +1,6 @@
 import utils
 import logging
-import subprocess
-import sys
 import shutil
-import os
 from decimal import Decimal
 from pathlib import Path
 
@@ -17,24 +14,16 @@ def import_impurities_fasta(task):
     imported_impurities_path = task.path.joinpath(
         task.id, 'impurities_prefilter')
     Path.mkdir(imported_impurities_path, parents=True, exist_ok=True)
-    impurities_fasta_dict = utils.load_fasta_file(task.remove_impurities)
-    if impurities_fasta_dict == -1:
-        logger.critical('Failed to load FASTA.')
-        sys.exit(-1)
-    task.impurities_prefilter_num = len(impurities_fasta_dict)
-    if task.impurities_prefilter_num == 1:
-        pass
-    else:
-        logger.warning('Impurities file contains muiltple squences.')
-
-    # import impurities
+    # import impurities, records are streamed so large impurity panels are not held in memory
     meta_dict = {
         'seq_meta': {},
-        'origin_file_path': str(task.remove_impurities),
-        'impurities_num': str(task.impurities_prefilter_num)
+        'origin_file_path': str(task.remove_impurities)
     }
-    i = 1
-    for header, seq in impurities_fasta_dict.items():
+    # a repeated header keeps the order of its first record and the sequence of its last one,
+    # like the dict of load_fasta_file
+    header_orders = {}
+    for header, seq in utils.iter_fasta(task.remove_impurities):
+        i = header_orders.setdefault(header, len(header_orders) + 1)
         imported_impurities_fasta_dict = {}
         # collect seqs fasta
         imported_impurities_fasta_path = task.path.joinpath(
@@ -49,12 +38,17 @@ def import_impurities_fasta(task):
             'fasta_header_escape': header.replace("|", "&#124;"),
             'seq_length': str(len(seq))
         }
-        i += 1
         # build impurities fasta
         utils.build_fasta_file(
             imported_impurities_fasta_path,
             imported_impurities_fasta_dict
         )
+    task.impurities_prefilter_num = len(header_orders)
+    if task.impurities_prefilter_num == 1:
+        pass
+    else:
+        logger.warning('Impurities file contains muiltple squences.')
+    meta_dict['impurities_num'] = str(task.impurities_prefilter_num)
     # build meta dict
     impurities_prefilter_meta_path = task.path.joinpath(
         task.id,
@@ -85,13 +79,7 @@ def build_impurities_index(task):
             else:
                 index_cmd = ['bwa', 'index', '-p',
                              impurities_fasta_path.stem, impurities_fasta_path.name]
-            logger.info('CMD: '+' '.join(index_cmd))
-            utils.write_log_file(task.path.joinpath(task.id),
-                                 'CMD: '+' '.join(index_cmd))
-            impurities_index_run = subprocess.run(
-                index_cmd, cwd=aligner_cwd, capture_output=True)
-            print(impurities_index_run.stdout.decode(encoding='utf-8'))
-            print(impurities_index_run.stderr.decode(encoding='utf-8'))
+            utils.run_cmd(task, index_cmd, aligner_cwd)
 
 
 def remove_impurities(task):
@@ -113,7 +101,7 @@ def remove_impurities(task):
                 'mapped_reads': "", 'remove_percentage': ""
             }
 
-            mapped_sam = 'impurity_%d_mapped.sam' % impurities_order
+            sorted_bam = 'impurity_%d_mapped.sorted.bam' % impurities_order
             if impurities_order == 1:
                 if task.remove_host != None:
                     filterd_R1 = str(task.path.joinpath(
@@ -138,7 +126,6 @@ def remove_impurities(task):
                               (task.id, impurities_order)),
                     '-1', filterd_R1,
                     '-2', filterd_R2,
-                    '-S', str(mapped_sam),
                     '--very-sensitive-local'
                 ]
             else:
@@ -150,30 +137,11 @@ def remove_impurities(task):
                     '-t', str(task.threads),
                     str('%s_impurities_%d' % (task.id, impurities_order)),
                     filterd_R1,
-                    filterd_R2,
-                    '-o', str(mapped_sam)
+                    filterd_R2
                 ]
-            logger.info('CMD: '+' '.join(align_cmd))
-            utils.write_log_file(task.path.joinpath(task.id),
-                                 'CMD: '+' '.join(align_cmd))
-            cmd_run = subprocess.run(
-                align_cmd, cwd=aligner_cwd, capture_output=True)
-            print(cmd_run.stderr.decode(encoding='utf-8'))
-
-            # build meta
-            logger.info('Analysis BAM file from impurity mapped reads')
-            # sorting
-            sorted_bam = 'impurity_%d_mapped.sorted.bam' % impurities_order
-            sorting_cmd = ['samtools', 'sort', '-@', task.threads,
-                           mapped_sam, '-o', sorted_bam]
-            logger.info('CMD: '+' '.join(sorting_cmd))
-            utils.write_log_file(task.path.joinpath(task.id),
-                                 'CMD: '+' '.join(sorting_cmd))
-            sorting_run = subprocess.run(
-                sorting_cmd, cwd=aligner_cwd, capture_output=True)
-            print(sorting_run.stdout.decode(encoding='utf-8'))
-            print(sorting_run.stderr.decode(encoding='utf-8'))
-            # extract unmapped with bt2
+            flagstat_file_path = task.path.joinpath(
+                aligner_cwd, 'flagstat_impurities_%d.txt' % impurities_order)
+            # unmapped reads are only extracted with bt2
             if aligner == 'bt2':
                 unmapped_fastq_r1 = str(task.path.joinpath(
                     task.id, 'reads', task.id + '_%d' % impurities_order +
@@ -181,26 +149,30 @@ def remove_impurities(task):
                 unmapped_fastq_r2 = str(task.path.joinpath(
                     task.id, 'reads', task.id + '_%d' % impurities_order +
                     '_impurity_removed_R2.fastq.gz'))
-                samtools_option_cmd = ['samtools', 'fastq', '-f 13']
-                samtools_fastq_cmd = [
-                    '-1', unmapped_fastq_r1, '-2', unmapped_fastq_r2]
-                samtools_run_cmd = samtools_option_cmd + \
-                    samtools_fastq_cmd + [sorted_bam]
-                subprocess.run(samtools_run_cmd, cwd=aligner_cwd, check=True)
-                utils.write_log_file(task.path.joinpath(
-                    task.id), 'CMD: '+' '.join(samtools_run_cmd))
-            # flagstat
-            flagstat_cmd = ['samtools', 'flagstat', '-@',
-                            task.threads, sorted_bam]
-            logger.info('CMD: '+' '.join(flagstat_cmd))
-            utils.write_log_file(task.path.joinpath(task.id),
-                                 'CMD: '+' '.join(flagstat_cmd))
-            flagstat_run = subprocess.run(
-                flagstat_cmd, cwd=aligner_cwd, capture_output=True)
-            stats_text = flagstat_run.stdout.decode(encoding='utf-8')
-            flagstat_file_path = task.path.joinpath(
-                aligner_cwd, 'flagstat_impurities_%d.txt' % impurities_order)
-            utils.build_text_file(flagstat_file_path, stats_text)
+            else:
+                unmapped_fastq_r1 = None
+                unmapped_fastq_r2 = None
+            if getattr(task, 'depletion_mode', 'stream') == 'stream':
+                # one pass, only the mapped reads are sorted for impurities_coverage_stat
+                utils.align_to_depleted_fastq(
+                    task, align_cmd, unmapped_fastq_r1, unmapped_fastq_r2, flagstat_file_path,
+                    aligner_cwd, mapped_bam=sorted_bam)
+            else:
+                utils.align_to_sorted_bam(task, align_cmd, sorted_bam, aligner_cwd)
+                # build meta
+                logger.info('Analysis BAM file from impurity mapped reads')
+                # extract unmapped with bt2
+                if unmapped_fastq_r1 != None:
+                    samtools_option_cmd = ['samtools', 'fastq', '-f 13']
+                    samtools_fastq_cmd = [
+                        '-1', unmapped_fastq_r1, '-2', unmapped_fastq_r2]
+                    samtools_run_cmd = samtools_option_cmd + \
+                        samtools_fastq_cmd + [sorted_bam]
+                    utils.run_cmd(task, samtools_run_cmd, aligner_cwd)
+                # flagstat
+                flagstat_cmd = ['samtools', 'flagstat', '-@',
+                                task.threads, sorted_bam]
+                utils.run_cmd(task, flagstat_cmd, aligner_cwd, stdout_path=flagstat_file_path)
 
             total_reads = task.total_reads_after_fastp
             primary_mapped_reads = utils.primary_mapped_from_flagstat(
@@ -211,8 +183,6 @@ def remove_impurities(task):
                 mapped_rate*Decimal('100'))
             utils.build_json_file(task.path.joinpath(
                 task.id, 'impurities_prefilter', 'impurities_remove.json'), impurities_remove_meta)
-            # remove sam file to release disk space
-            os.remove(task.path.joinpath(aligner_cwd, mapped_sam))
             # remove host bam file to release disk space
             # os.remove(task.path.joinpath(aligner_cwd, sorted_bam))
 
@@ -234,12 +204,8 @@ def impurities_coverage_stat(task):
 
             cov_dict[impurities_order][aligner] = {}
             flagstat_cmd = ['samtools', 'coverage', sorted_bam]
-            logger.info('CMD: '+' '.join(flagstat_cmd))
-            utils.write_log_file(task.path.joinpath(task.id),
-                                 'CMD: '+' '.join(flagstat_cmd))
-            flagstat_run = subprocess.run(
-                flagstat_cmd, cwd=aligner_cwd, capture_output=True)
-            stats_text = flagstat_run.stdout.decode(encoding='utf-8')
+            # empty stats are reported below
+            stats_text = utils.run_cmd(task, flagstat_cmd, aligner_cwd, capture=True, check=False).stdout
             if len(stats_text.split('\n')) > 1:
                 titles = stats_text.split('\n')[0].split('\t')
                 stats = stats_text.split('\n')[1].split('\t')
@@ -252,12 +218,166 @@ def impurities_coverage_stat(task):
     utils.build_json_file(task.path.joinpath(
         task.id, 'impurities_prefilter', 'impurities_coverage.json'), cov_dict)
 
+
+def aligner_cwd_path(task, aligner):
+    if aligner == 'bt2':
+        return task.path.joinpath(task.id, 'impurities_prefilter', "bt2_alignment")
+    return task.path.joinpath(task.id, 'impurities_prefilter', "bwa_alignment")
+
+
+def impurity_contig(impurities_order):
+    return 'impurity_%d' % impurities_order
+
+
+def build_combined_impurities_index(task):
+    # One FASTA with all impurities, contigs are renamed to impurity_<order> so stats can be split by contig.
+    def combined_records():
+        for impurities_order in range(1, task.impurities_prefilter_num+1):
+            _, seq = next(utils.iter_fasta(task.path.joinpath(
+                task.id, 'impurities_prefilter', '%s_impurities_%d.fasta' % (task.id, impurities_order))))
+            yield impurity_contig(impurities_order), seq
+
+    combined_fasta_path = task.path.joinpath(
+        task.id, 'impurities_prefilter', '%s_impurities_combined.fasta' % task.id)
+    utils.write_fasta_records(combined_fasta_path, combined_records())
+
+    def index_cell(task, aligner):
+        logger.info('Building %s combined index for impurities prefilter.' % aligner)
+        aligner_cwd = aligner_cwd_path(task, aligner)
+        Path.mkdir(aligner_cwd, parents=True, exist_ok=True)
+        shutil.copy2(combined_fasta_path, aligner_cwd)
+        if aligner == 'bt2':
+            index_cmd = ['bowtie2-build', '--threads', task.threads,
+                         combined_fasta_path.name, combined_fasta_path.stem]
+        else:
+            index_cmd = ['bwa', 'index', '-p',
+                         combined_fasta_path.stem, combined_fasta_path.name]
+        utils.run_cmd(task, index_cmd, aligner_cwd)
+
+    utils.fan_out(task, index_cell, [('bt2',), ('bwa',)])
+
+
+def combined_align_cell(task, aligner):
+    aligner_cwd = aligner_cwd_path(task, aligner)
+    if task.remove_host != None:
+        filterd_R1 = str(task.path.joinpath(
+            task.id, 'reads', task.id + '_host_removed_R1.fastq.gz'))
+        filterd_R2 = str(task.path.joinpath(
+            task.id, 'reads', task.id + '_host_removed_R2.fastq.gz'))
+    else:
+        filterd_R1 = str(task.path.joinpath(
+            task.id, 'reads', task.id + '_R1.fastq.gz'))
+        filterd_R2 = str(task.path.joinpath(
+            task.id, 'reads', task.id + '_R2.fastq.gz'))
+    index_name = '%s_impurities_combined' % task.id
+    if aligner == 'bt2':
+        align_cmd = [
+            'bowtie2',
+            '-p', str(task.threads),
+            '-x', index_name,
+            '-1', filterd_R1,
+            '-2', filterd_R2,
+            '--very-sensitive-local'
+        ]
+        # named as the last sequential pass, so reads_alignment picks it up unchanged
+        unmapped_fastq_r1 = str(task.path.joinpath(
+            task.id, 'reads', '%s_%d_impurity_removed_R1.fastq.gz' % (task.id, task.impurities_prefilter_num)))
+        unmapped_fastq_r2 = str(task.path.joinpath(
+            task.id, 'reads', '%s_%d_impurity_removed_R2.fastq.gz' % (task.id, task.impurities_prefilter_num)))
+    else:
+        align_cmd = [
+            'bwa',
+            'mem',
+            '-K 100000000',
+            '-Y',
+            '-t', str(task.threads),
+            index_name,
+            filterd_R1,
+            filterd_R2
+        ]
+        unmapped_fastq_r1 = None
+        unmapped_fastq_r2 = None
+    sorted_bam = 'impurities_combined_mapped.sorted.bam'
+    flagstat_file_path = aligner_cwd.joinpath('flagstat_impurities_combined.txt')
+    if getattr(task, 'depletion_mode', 'stream') == 'stream':
+        utils.align_to_depleted_fastq(
+            task, align_cmd, unmapped_fastq_r1, unmapped_fastq_r2,
+            flagstat_file_path, aligner_cwd, mapped_bam=sorted_bam)
+    else:
+        # whole library sorted, the per contig stats below only read the mapped reads of each contig
+        utils.align_to_sorted_bam(task, align_cmd, sorted_bam, aligner_cwd)
+        if unmapped_fastq_r1 != None:
+            samtools_run_cmd = ['samtools', 'fastq', '-f 13',
+                                '-1', unmapped_fastq_r1, '-2', unmapped_fastq_r2, sorted_bam]
+            utils.run_cmd(task, samtools_run_cmd, aligner_cwd)
+        flagstat_cmd = ['samtools', 'flagstat', '-@', task.threads, sorted_bam]
+        utils.run_cmd(task, flagstat_cmd, aligner_cwd, stdout_path=flagstat_file_path)
+    index_cmd = ['samtools', 'index', sorted_bam]
+    utils.run_cmd(task, index_cmd, aligner_cwd)
+
+
+def combined_stat_cell(task, impurities_order, aligner):
+    aligner_cwd = aligner_cwd_path(task, aligner)
+    sorted_bam = 'impurities_combined_mapped.sorted.bam'
+    contig = impurity_contig(impurities_order)
+    # primary mapped reads of the contig, same as the flagstat "primary mapped" of a single impurity index
+    count_cmd = ['samtools', 'view', '-c', '-F', '0x904', sorted_bam, contig]
+    primary_mapped_reads = utils.run_cmd(task, count_cmd, aligner_cwd, capture=True).stdout.strip()
+
+    coverage_cmd = ['samtools', 'coverage', '-r', contig, sorted_bam]
+    stats_text = utils.run_cmd(task, coverage_cmd, aligner_cwd, capture=True, check=False).stdout
+    coverage = {}
+    if len(stats_text.split('\n')) > 1:
+        titles = stats_text.split('\n')[0].split('\t')
+        stats = stats_text.split('\n')[1].split('\t')
+        for i in range(len(titles)):
+            coverage[titles[i]] = stats[i]
+    else:
+        logger.warning('Coverage stats empty for %s %s' % (aligner, contig))
+    return primary_mapped_reads, coverage
+
+
+def remove_impurities_combined(task):
+    # One alignment pass per aligner over all impurities, stats are split out by contig afterwards.
+    logger.info('Removing %d impurities in one pass.' % task.impurities_prefilter_num)
+    utils.fan_out(task, combined_align_cell, [('bt2',), ('bwa',)])
+
+    impurities_meta = utils.load_json_file(task.path.joinpath(
+        task.id, 'impurities_prefilter', 'impurities_prefilter_meta.json'))
+    cells = [(impurities_order, aligner)
+             for impurities_order in range(1, task.impurities_prefilter_num+1)
+             for aligner in ('bt2', 'bwa')]
+    results = utils.fan_out(task, combined_stat_cell, cells)
+
+    impurities_remove_meta = {}
+    cov_dict = {}
+    total_reads = task.total_reads_after_fastp
+    for (impurities_order, aligner), (primary_mapped_reads, coverage) in zip(cells, results):
+        mapped_rate = Decimal(primary_mapped_reads)/Decimal(total_reads)
+        impurities_remove_meta.setdefault(impurities_order, {})[aligner] = {
+            'mapped_reads': primary_mapped_reads,
+            'remove_percentage': "%f%%" % (mapped_rate*Decimal('100'))
+        }
+        if '#rname' in coverage:
+            # report the original sequence name instead of the renamed contig
+            coverage['#rname'] = impurities_meta['seq_meta'][str(impurities_order)]['fasta_header'].split()[0]
+        cov_dict.setdefault(impurities_order, {})[aligner] = coverage
+    utils.build_json_file(task.path.joinpath(
+        task.id, 'impurities_prefilter', 'impurities_remove.json'), impurities_remove_meta)
+    utils.build_json_file(task.path.joinpath(
+        task.id, 'impurities_prefilter', 'impurities_coverage.json'), cov_dict)
+
+
 def run(task):
     if task.remove_impurities != None:
         logger.info('Running impurities pre-filter.')
         import_impurities_fasta(task)
-        build_impurities_index(task)
-        remove_impurities(task)
-        impurities_coverage_stat(task)
+        if getattr(task, 'impurities_mode', 'sequential') == 'combined':
+            build_combined_impurities_index(task)
+            remove_impurities_combined(task)
+        else:
+            build_impurities_index(task)
+            remove_impurities(task)
+            impurities_coverage_stat(task)
     else:
         logger.info('No impurities pre-filter.')
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import time
+import uuid
+from pathlib import Path
+
+import utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+tool_versions = {}
+BT2_SUFFIXES = ['.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2', '.rev.2.bt2']
+# bowtie2 writes .bt2l for large refs
+INDEX_SUFFIXES = ['.amb', '.ann', '.bwt', '.pac', '.sa'] + BT2_SUFFIXES + [s + 'l' for s in BT2_SUFFIXES]
+
+
+def cache_enabled(task):
+    return getattr(task, 'index_cache', 'True') == 'True'
+
+
+def cache_root(task):
+    # inside the tasks folder, so all tasks of the mounted tasks volume share it
+    return task.path.joinpath('index_cache')
+
+
+def tool_version(tool):
+    if tool not in tool_versions:
+        if tool == 'bwa':
+            # bwa prints its version in the usage text on stderr
+            usage = subprocess.run(['bwa'], capture_output=True).stderr.decode(encoding='utf-8')
+            versions = [line.split(':', 1)[1].strip() for line in usage.split('\n') if line.startswith('Version:')]
+            tool_versions[tool] = versions[0] if len(versions) > 0 else 'unknown'
+        else:
+            version_text = subprocess.run([tool, '--version'], capture_output=True).stdout.decode(encoding='utf-8')
+            lines = version_text.strip().split('\n')
+            tool_versions[tool] = lines[0].split()[-1] if len(lines[0]) > 0 else 'unknown'
+    return tool_versions[tool]
+
+
+def cache_key(fasta_path, tool):
+    # FASTA headers are part of the index (contig names), so the whole file is hashed
+    key_text = '%s\t%s\t%s' % (utils.file_md5(fasta_path), tool, tool_version(tool))
+    return hashlib.md5(key_text.encode('utf-8')).hexdigest()
+
+
+def index_files(cwd, index_prefix):
+    # bowtie2 (.1.bt2 ... .rev.2.bt2, .bt2l for large refs) and bwa index files of the prefix
+    return [
+        p for p in Path(cwd).glob(index_prefix + '.*')
+        if p.is_file() and p.name[len(index_prefix):] in INDEX_SUFFIXES
+    ]
+
+
+def link_file(src, dst):
+    if dst.exists():
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # cache on another filesystem
+        shutil.copy2(src, dst)
+
+
+def link_entry(entry, cwd, index_prefix):
+    manifest_path = entry.joinpath('manifest.json')
+    if not manifest_path.is_file():
+        return False
+    try:
+        manifest = utils.load_json_file(manifest_path)
+        for suffix in manifest['suffixes']:
+            link_file(entry.joinpath('index' + suffix), Path(cwd).joinpath(index_prefix + suffix))
+        os.utime(manifest_path)
+    except (OSError, KeyError, ValueError) as e:
+        # entry evicted by another task while linking, build it again
+        logger.warning('Index cache entry %s not usable: %s' % (entry.name, str(e)))
+        return False
+    return True
+
+
+def store_entry(entry, cwd, index_prefix, manifest):
+    tmp_entry = entry.parent.joinpath('.tmp-%s' % uuid.uuid4().hex)
+    Path.mkdir(tmp_entry, parents=True)
+    suffixes = []
+    for p in index_files(cwd, index_prefix):
+        suffix = p.name[len(index_prefix):]
+        link_file(p, tmp_entry.joinpath('index' + suffix))
+        suffixes.append(suffix)
+    manifest['suffixes'] = sorted(suffixes)
+    utils.build_json_file(tmp_entry.joinpath('manifest.json'), manifest)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # same index stored by a concurrent task first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def entry_size(entry):
+    return sum(p.stat().st_size for p in entry.iterdir() if p.is_file())
+
+
+def evict(task, keep=None):
+    # least recently used entries go first until the cache fits in index_cache_max_gb
+    root = cache_root(task)
+    max_bytes = float(getattr(task, 'index_cache_max_gb', '20')) * 1024**3
+    entries = []
+    for entry in root.iterdir():
+        manifest_path = entry.joinpath('manifest.json')
+        if entry.name.startswith('.') or not manifest_path.is_file():
+            continue
+        entries.append((manifest_path.stat().st_mtime, entry_size(entry), entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        logger.info('Evicting index cache entry %s.' % entry.name)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def build_index(task, index_cmd, cwd, fasta_name, index_prefix):
+    # Run index_cmd in cwd, or link the same index built by an earlier task from the cache.
+    if cache_enabled(task):
+        tool = index_cmd[0]
+        key = cache_key(Path(cwd).joinpath(fasta_name), tool)
+        entry = cache_root(task).joinpath(key)
+        if link_entry(entry, cwd, index_prefix):
+            logger.info('Index cache hit for %s (%s).' % (index_prefix, tool))
+            utils.write_log_file(task.path.joinpath(task.id), 'INDEX_CACHE: hit %s %s %s' % (tool, index_prefix, key))
+            return
+    utils.run_cmd(task, index_cmd, cwd)
+    if cache_enabled(task):
+        Path.mkdir(cache_root(task), parents=True, exist_ok=True)
+        store_entry(entry, cwd, index_prefix, {
+            'tool': tool,
+            'version': tool_version(tool),
+            'fasta_md5': utils.file_md5(Path(cwd).joinpath(fasta_name)),
+            'fasta_name': fasta_name,
+            'created': int(time.time())
+        })
+        evict(task, keep=entry)
@@ -0,0 +1,250 @@
+import argparse
+import logging
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import db_manager
+import rvdb_anno_index
+import unmapped_analysis
+import utils
+import variant_calling
+from new_task import Task
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# input sizes of each case, realistic: common viral task, extreme: upper end seen in production
+SIZES = {
+    'realistic': {
+        'genome_len': 200000,
+        'vcf_lines': 1000,
+        'blast_lines': 100000,
+        'rvdb_anno_lines': 200000
+    },
+    'extreme': {
+        'genome_len': 2000000,
+        'vcf_lines': 10000,
+        'blast_lines': 1000000,
+        'rvdb_anno_lines': 2000000
+    }
+}
+ALIGNERS = ['bowtie2', 'bwa']
+RVDB_DB = 'U-RVDBv30.0.fasta'
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choices('ACGT', k=length))
+
+
+def bench_task(work_path, genome_len):
+    task = Task()
+    task.path = work_path
+    task.id = 'microbench'
+    task.ref_num = 1
+    task.alns = ALIGNERS
+    task.vc_threshold = '0.7'
+    task.min_vc_score = 1
+    task.unmapped_ident_filter = '95'
+    task.unmapped_len_filter = '500'
+    Path.mkdir(work_path.joinpath(task.id, 'reference'), parents=True, exist_ok=True)
+    Path.mkdir(work_path.joinpath(task.id, 'draft_genome'), parents=True, exist_ok=True)
+    for aligner in ALIGNERS:
+        Path.mkdir(work_path.joinpath(task.id, 'alignment', aligner), parents=True, exist_ok=True)
+    ref_path = work_path.joinpath(task.id, 'reference', '%s_ref_1.fasta' % task.id)
+    if not ref_path.is_file():
+        utils.build_fasta_file(ref_path, {'microbench_ref': random_seq(random.Random(1), genome_len)})
+    return task
+
+
+def write_vcf_files(task, vcf_lines, genome_len):
+    # VarScan and LoFreq VCFs of both aligners at distinct positions
+    rng = random.Random(2)
+    positions = sorted(rng.sample(range(1, genome_len + 1), vcf_lines))
+    for aligner in ALIGNERS:
+        varscan_lines = [
+            '##fileformat=VCFv4.1',
+            '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSample1'
+        ]
+        lofreq_lines = [
+            '##fileformat=VCFv4.0',
+            '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO'
+        ]
+        for pos in positions:
+            ref = rng.choice('ACGT')
+            alt = rng.choice([b for b in 'ACGT' if b != ref])
+            freq = rng.randint(1, 100)
+            varscan_lines.append(
+                'microbench_ref\t%d\t.\t%s\t%s\t.\tPASS\tADP=500;WT=0;HET=0;HOM=1;NC=0\t'
+                'GT:GQ:SDP:DP:RD:AD:FREQ:PVAL:RBQ:ABQ:RDF:RDR:ADF:ADR\t'
+                '1/1:255:500:500:%d:%d:%d%%:1E-100:37:37:0:0:250:250' % (pos, ref, alt, 500 - freq * 5, freq * 5, freq))
+            lofreq_lines.append(
+                'microbench_ref\t%d\t.\t%s\t%s\t%d\tPASS\tDP=500;AF=%.6f;SB=0;DP4=0,0,250,250' % (
+                    pos, ref, alt, rng.randint(50, 5000), freq / 100))
+        for caller, lines in (('varscan', varscan_lines), ('lofreq', lofreq_lines)):
+            utils.build_text_file(task.path.joinpath(
+                task.id, 'alignment', aligner, '%s_%s_ref_1_%s.vcf' % (task.id, aligner, caller)),
+                '\n'.join(lines) + '\n')
+
+
+def write_blast_table(path, blast_lines, rvdb_anno_lines):
+    # outfmt 6 columns of blast_assembled, RVDB style stitle so the annotation lookup is exercised
+    rng = random.Random(3)
+    with open(path, 'w') as f:
+        for i in range(blast_lines):
+            acc = 'MB%07d.1' % rng.randrange(rvdb_anno_lines // 2)
+            sstart = rng.randint(1, 20000)
+            length = rng.randint(100, 3000)
+            f.write('NODE_%d_length_%d\tacc|GENBANK|%s|\t%.3f\t%d\t%d\t%.2e\t'
+                    'acc|GENBANK|%s|Microbench virus segment %d|Microbenchviridae\t%d\t%d\t1\t%d\t%d\t%d\n' % (
+                        i // 50 + 1, length, acc, rng.uniform(80, 100), length, length, rng.uniform(0, 1e-6),
+                        acc, i, length * 2, rng.randint(50, 100), length, sstart, sstart + length - 1))
+
+
+def write_rvdb_anno(path, rvdb_anno_lines):
+    rng = random.Random(4)
+    with open(path, 'w') as f:
+        for i in range(rvdb_anno_lines):
+            start = rng.randint(1, 20000)
+            f.write('MB%07d.1\tacc|GENBANK|MB%07d.1|Microbench virus\t%d\t%d\t%s\n' % (
+                i // 2, i // 2, start, start + rng.randint(100, 5000), rng.choice(['Virus', 'Phage', 'Unclassified'])))
+
+
+def bench_cases(work_path, sizes, rvdb_anno_path=None):
+    # Each case is (name, run), inputs are generated before timing starts.
+    task = bench_task(work_path, sizes['genome_len'])
+    ref_path = task.path.joinpath(task.id, 'reference', '%s_ref_1.fasta' % task.id)
+    fasta_dict = utils.load_fasta_file(ref_path)
+    write_vcf_files(task, sizes['vcf_lines'], sizes['genome_len'])
+    vcf_path = task.path.joinpath(task.id, 'alignment', 'bwa', '%s_bwa_ref_1_varscan.vcf' % task.id)
+    if rvdb_anno_path == None:
+        rvdb_anno_path = work_path.joinpath('rvdb_anno.tab')
+        write_rvdb_anno(rvdb_anno_path, sizes['rvdb_anno_lines'])
+    blast_table_path = work_path.joinpath('blast.tsv')
+    write_blast_table(blast_table_path, sizes['blast_lines'], sizes['rvdb_anno_lines'])
+    annotation_index = rvdb_anno_index.load_index(rvdb_anno_path)
+    compiled_index_path = work_path.joinpath('rvdb_anno_compiled.idx')
+    variant_calling.build_vc_summary_json(task)
+    summary = {
+        'finish_date': '2026-01-01 00:00',
+        'ref_meta_dict': {'ref_num': 1, 'seq_meta': {'1': {'fasta_header_escape': 'microbench_ref'}}},
+        'vc': utils.load_json_file(task.path.joinpath(task.id, task.id + '_vc_summary.json')),
+        'cmd_metrics': []
+    }
+    db = db_manager.VIVADatabase(str(work_path.joinpath('microbench.db')))
+    return [
+        ('utils.load_fasta_file', lambda: utils.load_fasta_file(ref_path)),
+        ('utils.build_fasta_file', lambda: utils.build_fasta_file(work_path.joinpath('out.fasta'), fasta_dict)),
+        ('utils.load_vcf_file', lambda: utils.load_vcf_file(vcf_path)),
+        ('variant_calling.build_vc_summary_json', lambda: variant_calling.build_vc_summary_json(task)),
+        ('variant_calling.build_draft_genome_seq', lambda: variant_calling.build_draft_genome_seq(task)),
+        ('unmapped_analysis.blast_filters', lambda: unmapped_analysis.reduce_blast_hits(task, RVDB_DB, blast_table_path, annotation_index)),
+        ('utils.load_rvdb_anno_tab', lambda: utils.load_rvdb_anno_tab(rvdb_anno_path)),
+        ('rvdb_anno_index.compile_index', lambda: rvdb_anno_index.compile_index(rvdb_anno_path, compiled_index_path)),
+        ('rvdb_anno_index.map_index', lambda: rvdb_anno_index.map_index(rvdb_anno_index.index_path(rvdb_anno_path))),
+        ('db_manager.save_final_summary', lambda: db.save_final_summary(task.id, summary))
+    ]
+
+
+def measure(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    # allocations are traced in a separate run, tracemalloc slows the timed runs down
+    tracemalloc.start()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'min_time': round(min(times), 6),
+        'median_time': round(statistics.median(times), 6),
+        'peak_alloc_bytes': peak,
+        'retained_alloc_bytes': current
+    }
+
+
+def compare_baseline(result, baseline_runs, tolerance):
+    # the latest baseline run of the same size profile
+    same_runs = [r for r in baseline_runs if r['size'] == result['size']]
+    if len(same_runs) == 0:
+        return None
+    baseline = same_runs[-1]
+    regressions = []
+    for name, m in result['cases'].items():
+        base = baseline['cases'].get(name)
+        if base == None:
+            continue
+        if m['median_time'] > base['median_time'] * (1 + tolerance):
+            regressions.append({'name': name, 'baseline': base['median_time'], 'current': m['median_time']})
+            logger.warning('Regression in %s: %.4f s -> %.4f s.' % (name, base['median_time'], m['median_time']))
+    return {'baseline_time': baseline['time'], 'baseline_version': baseline['version'], 'regressions': regressions}
+
+
+def main(input_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--micro_size', help="Input size profile: realistic, extreme or all.", default='all')
+    parser.add_argument(
+        '--micro_repeat', help="Timed runs per case, the median and minimum are reported.", default='5')
+    parser.add_argument(
+        '--micro_cases', help="Comma separated case names to run (e.g. utils.load_vcf_file). Default: all.", default=None)
+    parser.add_argument(
+        '--rvdb_anno_path', help="Real RVDB annotation file for the annotation cases instead of a generated one.", default=None)
+    parser.add_argument(
+        '--bench_out', help="Microbenchmark results JSON file, results are appended.", default=None)
+    parser.add_argument(
+        '--bench_baseline', help="Results JSON file of an earlier microbenchmark to compare with.", default=None)
+    parser.add_argument(
+        '--bench_tolerance', help="Slowdown ratio reported as a regression against the baseline.", default='0.2')
+    args, unknown = parser.parse_known_args(input_args)
+
+    bench_path = Path.cwd().joinpath('tasks', 'benchmarks')
+    Path.mkdir(bench_path, parents=True, exist_ok=True)
+    bench_out = Path(args.bench_out) if args.bench_out != None else bench_path.joinpath('microbenchmark_results.json')
+    baseline_runs = utils.load_json_file(args.bench_baseline) if args.bench_baseline != None else []
+    size_names = list(SIZES) if args.micro_size == 'all' else [args.micro_size]
+    case_names = args.micro_cases.split(',') if args.micro_cases != None else None
+    viva_version = subprocess.run(
+        ['git', 'describe', '--always', '--tags'],
+        capture_output=True).stdout.decode(encoding='utf-8').strip()
+
+    for size_name in size_names:
+        result = {
+            'time': int(time.time()),
+            'version': viva_version,
+            'python': sys.version.split()[0],
+            'size': size_name,
+            'sizes': SIZES[size_name],
+            'cases': {}
+        }
+        with tempfile.TemporaryDirectory(dir=bench_path) as work_dir:
+            logger.info('Generating %s microbenchmark inputs.' % size_name)
+            cases = bench_cases(Path(work_dir), SIZES[size_name], args.rvdb_anno_path)
+            # per-hit logging of the measured functions is not part of what is measured here
+            logging.disable(logging.INFO)
+            try:
+                for name, run in cases:
+                    if case_names != None and name not in case_names:
+                        continue
+                    result['cases'][name] = measure(run, int(args.micro_repeat))
+                    logger.warning('%s [%s]: median %.4f s, peak alloc %.1f MB.' % (
+                        name, size_name, result['cases'][name]['median_time'],
+                        result['cases'][name]['peak_alloc_bytes'] / 1024**2))
+            finally:
+                logging.disable(logging.NOTSET)
+        result['baseline'] = compare_baseline(result, baseline_runs, float(args.bench_tolerance))
+        results = utils.load_json_file(bench_out) if bench_out.is_file() else []
+        results.append(result)
+        utils.build_json_file(bench_out, results)
+    logger.info('Microbenchmark results written to %s.' % bench_out)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
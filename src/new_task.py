@@ -5,6 +5,7 @@ import os
 import subprocess
 import sys
 import time
+import uuid
 from pathlib import Path
 
 import reads_alignment
@@ -17,6 +18,7 @@ import report_generator
 import summary_generator
 import impurities_prefilter
 import db_manager
+import stage_scheduler
 
 
 logger = logging.getLogger(__name__)
@@ -57,6 +59,107 @@ def check_deps(task):
         logger.critical('Conda pkg depency check fail.')
         sys.exit(100)
 
+
+def create_task_folder(task):
+    # Minute timestamp keeps ID readable, random suffix avoids ID clashes between concurrent batch tasks.
+    while True:
+        task.id = "%s_%s-%s" % (task.name, time.strftime(
+            "%Y%m%d%H%M", time.localtime()), uuid.uuid4().hex[:6])
+        try:
+            Path.mkdir(task.path.joinpath(task.id), parents=True)
+            return task.id
+        except FileExistsError:
+            continue
+
+
+def pipeline_stages(task):
+    task_cwd = task.path.joinpath(task.id)
+
+    def preprocess_outputs(task):
+        outputs = [task_cwd.joinpath('reads', task.id + '_R1.fastq.gz'), task_cwd.joinpath('reads', task.id + '_R2.fastq.gz')]
+        if task.remove_host != None:
+            outputs += [
+                task_cwd.joinpath('reads', task.id + '_host_removed_R1.fastq.gz'),
+                task_cwd.joinpath('reads', task.id + '_host_removed_R2.fastq.gz')
+            ]
+        return outputs
+
+    def reference_inputs(task):
+        return [task.ref] if task.with_ref else []
+
+    def reference_outputs(task):
+        return [task_cwd.joinpath('reference', task.id + '_ref.json')]
+
+    def impurities_inputs(task):
+        return [task.remove_impurities] if task.remove_impurities != None else []
+
+    def impurities_outputs(task):
+        if task.remove_impurities != None:
+            return [task_cwd.joinpath('impurities_prefilter', 'impurities_remove.json')]
+        return []
+
+    def alignment_outputs(task):
+        outputs = [task_cwd.joinpath('alignment', 'flagstat.json'), task_cwd.joinpath('alignment', 'coverage_stat.json')]
+        for aligner in task.alns:
+            for ref_order in range(1, task.ref_num+1):
+                outputs.append(task_cwd.joinpath('alignment', aligner, '%s_ref_%d.sorted.bam' % (task.id, ref_order)))
+        return outputs
+
+    def unmapped_inputs(task):
+        if task.unmapped_assemble == 'True' and 'bwa' in task.alns:
+            # unmapped assemble ONLY apply to the first bwa ref alignment.
+            return [
+                task_cwd.joinpath('alignment', 'bwa', task.id + '_ref_1_unmapped_R1.fastq.gz'),
+                task_cwd.joinpath('alignment', 'bwa', task.id + '_ref_1_unmapped_R2.fastq.gz')
+            ]
+        return []
+
+    def unmapped_outputs(task):
+        if task.unmapped_assemble == 'True':
+            return [task_cwd.joinpath('unmapped_analysis', 'unmapped_analysis.json')]
+        return []
+
+    def variant_calling_outputs(task):
+        return [task_cwd.joinpath(task.id + '_vc_summary.json'), task_cwd.joinpath(task.id + '_vc_table.bin')]
+
+    return [
+        stage_scheduler.Stage(
+            'reads_preprocess', reads_preprocess.run,
+            inputs=lambda task: [task.ex_r1, task.ex_r2], outputs=preprocess_outputs,
+            params=('global_trimming', 'remove_host')),
+        # importing a given reference is light, de novo reference needs the filtered reads and SPAdes
+        stage_scheduler.Stage(
+            'reference_prepare', reference_prepare.run,
+            after=() if task.with_ref else ('reads_preprocess',),
+            inputs=reference_inputs, outputs=reference_outputs,
+            params=('ref', 'spades_mode', 'spades_mem', 'blastdb_path', 'unmapped_blastdb'),
+            weight=0 if task.with_ref else 1),
+        stage_scheduler.Stage(
+            'impurities_prefilter', impurities_prefilter.run,
+            after=('reads_preprocess',), inputs=impurities_inputs, outputs=impurities_outputs,
+            params=('remove_impurities', 'impurities_mode')),
+        stage_scheduler.Stage(
+            'reads_alignment', reads_alignment.run,
+            after=('reference_prepare', 'impurities_prefilter'),
+            inputs=reference_outputs, outputs=alignment_outputs,
+            params=('alns', 'aln_ref_mode')),
+        # unmapped analysis and variant calling only depend on the alignment, run side by side
+        stage_scheduler.Stage(
+            'unmapped_analysis', unmapped_analysis.run,
+            after=('reads_alignment',), inputs=unmapped_inputs, outputs=unmapped_outputs,
+            params=(
+                'unmapped_assemble', 'unmapped_spades_mode', 'spades_mem',
+                'unmapped_bbnorm', 'unmapped_bbnorm_target', 'unmapped_bbnorm_min',
+                'blastdb_path', 'unmapped_blastdb', 'unmapped_blastdb_extra_list',
+                'unmapped_len_filter', 'unmapped_ident_filter', 'rvdb_anno_path',
+                'blast_cascade', 'blast_cascade_qcovs')),
+        stage_scheduler.Stage(
+            'variant_calling', variant_calling.run,
+            after=('reads_alignment',), inputs=alignment_outputs, outputs=variant_calling_outputs,
+            params=('vc_threshold', 'min_vc_score'))
+    ]
+
+
 def main(input_args):
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -71,12 +174,32 @@ def main(input_args):
         '--threads', help="CPU threads.", default=6)
     parser.add_argument(
         '--alns', help="Reads mapper list.", default='bowtie2,bwa')
+    parser.add_argument(
+        '--aln_concurrent', help="Run index and alignment of all aligners concurrently with split threads.", default='True')
+    parser.add_argument(
+        '--aln_ref_mode', help="Multi-reference alignment mode. per_ref: one index and alignment per reference; combined: one index and alignment over all references.", default='per_ref')
+    parser.add_argument(
+        '--index_cache', help="Reuse reference indexes built by earlier tasks from the shared index cache.", default='True')
+    parser.add_argument(
+        '--index_cache_max_gb', help="Size limit of the shared index cache in GB, least recently used indexes are removed first.", default='20')
+    parser.add_argument(
+        '--sort_mem', help="Per-thread memory of samtools sort for streamed aligner output (e.g. 768M, 2G).", default='768M')
+    parser.add_argument(
+        '--depletion_mode', help="Host/impurity removal mode. stream: one pass over aligner output without sorting; sort: sort the whole BAM first.", default='stream')
     parser.add_argument(
         '--global_trimming', help="Global trimming bases for reads.", default=0)
     parser.add_argument(
         '--remove_host', help="Remove specific host genome (human, dog, vero, chicken, rhesus_monkey).", default=None)
+    parser.add_argument(
+        '--host_index_mm', help="Run host removal bowtie2 with a memory-mapped index (--mm) shared by concurrent tasks.", default='True')
+    parser.add_argument(
+        '--host_index_warm', help="Load the host index into memory while reads are filtered.", default='True')
+    parser.add_argument(
+        '--host_index_mem', help="Memory cap (GB) of resident host indexes, auto: half of the host memory.", default='auto')
     parser.add_argument(
         '--remove_impurities', help="Remove specific impurity sequences FASTA file path.", default=None)
+    parser.add_argument(
+        '--impurities_mode', help="Impurities prefilter mode. sequential: one index and pass per impurity; combined: one index and pass over all impurities.", default='sequential')
     parser.add_argument(
         '--test', default=None)
     parser.add_argument(
@@ -105,10 +228,22 @@ def main(input_args):
         '--unmapped_blastdb', help="BLASTDB for reference prepare and unmapped reads assemble.", default=None)
     parser.add_argument(
         '--unmapped_blastdb_extra_list', help="Extra custom BLASTDB list for unmapped reads assemble. Use a single space to seperate DB names.", default=None)
+    parser.add_argument(
+        '--blast_chunks', help="Split assembled contigs into chunks BLASTed concurrently, auto: threads divided by the number of BLAST databases.", default='auto')
+    parser.add_argument(
+        '--blast_cache', help="Reuse BLAST hits of contigs searched by earlier tasks against the same database version.", default='True')
+    parser.add_argument(
+        '--blast_cascade', help="Search databases in order with megablast first, blastn only for contigs without a qualifying hit, and skip contigs resolved in earlier databases.", default='False')
+    parser.add_argument(
+        '--blast_cascade_qcovs', help="Min. query coverage (%) of a qualifying hit which resolves a contig in the BLAST cascade.", default='90')
     parser.add_argument(
         '--unmapped_len_filter', help="Min. length (bp) filter to hit in unmapped reads assemble BLAST.", default='500')
     parser.add_argument(
         '--unmapped_ident_filter', help="Min. identity (%) filter to hit in unmapped reads assemble BLAST.", default='95')
+    parser.add_argument(
+        '--stage_parallel', help="Run independent pipeline stages concurrently under the shared thread budget.", default='True')
+    parser.add_argument(
+        '--resume', help="Resume an interrupted task by task ID, skip stages whose checkpoint still matches.", default=None)
     parser.add_argument(
         '--preset_path', help="Load VIVA analysis setting from given preset file path.", default=None)
     parser.add_argument(
@@ -136,6 +271,7 @@ def main(input_args):
     task.name = args.prefix
     task.task_note = args.task_note
     task.id = ''
+    task.resume = args.resume
     task.with_ref = False
     task.ex_r1 = args.ex_r1
     task.ex_r2 = args.ex_r2
@@ -167,8 +303,23 @@ def main(input_args):
         task.unmapped_bbnorm_min = args.unmapped_bbnorm_min
         task.unmapped_blastdb = args.unmapped_blastdb
         task.unmapped_blastdb_extra_list = args.unmapped_blastdb_extra_list
+        task.blast_chunks = args.blast_chunks
+        task.blast_cache = args.blast_cache
+        task.blast_cascade = args.blast_cascade
+        task.blast_cascade_qcovs = args.blast_cascade_qcovs
         task.unmapped_len_filter = args.unmapped_len_filter
         task.unmapped_ident_filter = args.unmapped_ident_filter
+        task.stage_parallel = args.stage_parallel
+        task.aln_concurrent = args.aln_concurrent
+        task.aln_ref_mode = args.aln_ref_mode
+        task.index_cache = args.index_cache
+        task.index_cache_max_gb = str(args.index_cache_max_gb)
+        task.sort_mem = args.sort_mem
+        task.host_index_mm = args.host_index_mm
+        task.host_index_warm = args.host_index_warm
+        task.host_index_mem = args.host_index_mem
+        task.depletion_mode = args.depletion_mode
+        task.impurities_mode = args.impurities_mode
     else:
         # Parse all conf. as strings
         config = configparser.ConfigParser(allow_no_value=True)
@@ -191,8 +342,23 @@ def main(input_args):
         task.rvdb_anno_path = config['PRESET']['rvdb_anno_path']
         task.unmapped_blastdb = config['PRESET']['unmapped_blastdb']
         task.unmapped_blastdb_extra_list = config['PRESET']['unmapped_blastdb_extra_list']
+        task.blast_chunks = config['PRESET'].get('blast_chunks', 'auto')
+        task.blast_cache = config['PRESET'].get('blast_cache', 'True')
+        task.blast_cascade = config['PRESET'].get('blast_cascade', 'False')
+        task.blast_cascade_qcovs = config['PRESET'].get('blast_cascade_qcovs', '90')
         task.unmapped_len_filter = config['PRESET']['unmapped_len_filter']
         task.unmapped_ident_filter = config['PRESET']['unmapped_ident_filter']
+        task.stage_parallel = config['PRESET'].get('stage_parallel', 'True')
+        task.aln_concurrent = config['PRESET'].get('aln_concurrent', 'True')
+        task.aln_ref_mode = config['PRESET'].get('aln_ref_mode', 'per_ref')
+        task.index_cache = config['PRESET'].get('index_cache', 'True')
+        task.index_cache_max_gb = config['PRESET'].get('index_cache_max_gb', '20')
+        task.sort_mem = config['PRESET'].get('sort_mem', '768M')
+        task.host_index_mm = config['PRESET'].get('host_index_mm', 'True')
+        task.host_index_warm = config['PRESET'].get('host_index_warm', 'True')
+        task.host_index_mem = config['PRESET'].get('host_index_mem', 'auto')
+        task.depletion_mode = config['PRESET'].get('depletion_mode', 'stream')
+        task.impurities_mode = config['PRESET'].get('impurities_mode', 'sequential')
         task.preset_id = config['VERSION']['preset_id']
         task.preset_version = config['VERSION']['version']
         task.preset_last_rev_date = config['VERSION']['last_rev_date']
@@ -264,37 +430,45 @@ def main(input_args):
 
     logger.info('Checking reads files.')
     if check_reads_file(task) != -1:
-        task.id = "%s_%s" % (task.name, time.strftime(
-            "%Y%m%d%H%M", time.localtime()))
-        logger.info('Creating new task %s.' % task.id)
-        Path.mkdir(task.path.joinpath(task.id), parents=True)
-        logger.info('Starting pipeline.')
-        utils.write_log_file(
-            task.path.joinpath(task.id),
-            'Starting pipeline.'
-        )
-
         db = db_manager.VIVADatabase()
-        start_date = time.strftime("%Y-%m-%d %H:%M", time.localtime())
-        db.create_task(
-            task_id=task.id, 
-            task_name=task.name, 
-            start_date=start_date, 
-            preset_id=getattr(task, 'preset_id', None),
-            task_note=task.task_note,
-            product=task.sample_product_name,
-            lot=task.sample_product_lot,
-            seq_date=task.sample_sequencing_date
-        )
+        if task.resume != None:
+            task.id = task.resume
+            if not task.path.joinpath(task.id).is_dir():
+                logger.error('Task %s to resume not found. Exiting pipeline.' % task.id)
+                sys.exit()
+            logger.info('Resuming task %s.' % task.id)
+            utils.write_log_file(
+                task.path.joinpath(task.id),
+                'Resuming pipeline.'
+            )
+            db.update_task_status(task.id, 'Running')
+        else:
+            create_task_folder(task)
+            logger.info('Creating new task %s.' % task.id)
+            logger.info('Starting pipeline.')
+            utils.write_log_file(
+                task.path.joinpath(task.id),
+                'Starting pipeline.'
+            )
+
+            start_date = time.strftime("%Y-%m-%d %H:%M", time.localtime())
+            db.create_task(
+                task_id=task.id, 
+                task_name=task.name, 
+                start_date=start_date, 
+                preset_id=getattr(task, 'preset_id', None),
+                task_note=task.task_note,
+                product=task.sample_product_name,
+                lot=task.sample_product_lot,
+                seq_date=task.sample_sequencing_date
+            )
 
         try:
             # main pipeline
-            reads_preprocess.run(task)
-            reference_prepare.run(task)
-            impurities_prefilter.run(task)
-            reads_alignment.run(task)
-            unmapped_analysis.run(task)
-            variant_calling.run(task)
+            stage_scheduler.run_stages(
+                task, pipeline_stages(task),
+                parallel=task.stage_parallel == 'True',
+                resume=task.resume != None)
             logger.info('Pipeline finished.')
             utils.write_log_file(
                 task.path.joinpath(task.id),
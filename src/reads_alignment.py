@@ -1,10 +1,9 @@
 import logging
-import os
 import shutil
-import subprocess
 from decimal import Decimal
 from pathlib import Path
 
+import index_cache
 import utils
 
 logger = logging.getLogger(__name__)
@@ -23,11 +22,36 @@ def ref_index(task, aligner):
             index_cmd = ['bowtie2-build', '--threads', task.threads, '%s_ref_%d.fasta'%(task.id, ref_order), '%s_ref_%d'%(task.id, ref_order)]
         elif aligner == 'bwa':
             index_cmd = ['bwa', 'index', '-p', '%s_ref_%d'%(task.id, ref_order), '%s_ref_%d.fasta'%(task.id, ref_order)]
-        logger.info('CMD: '+' '.join(index_cmd))
-        utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(index_cmd))
-        ref_index_run = subprocess.run(index_cmd, cwd=aligner_cwd, capture_output=True)
-        print(ref_index_run.stdout.decode(encoding='utf-8'))
-        print(ref_index_run.stderr.decode(encoding='utf-8'))
+        index_cache.build_index(task, index_cmd, aligner_cwd, '%s_ref_%d.fasta'%(task.id, ref_order), '%s_ref_%d'%(task.id, ref_order))
+
+
+def filtered_reads(task):
+    # impurities_prefilter is latter process, so need to be check first, then remove_host
+    if task.impurities_prefilter_num > 0:
+        filterd_R1 = str(task.path.joinpath(
+            task.id, 'reads', '%s_%d_impurity_removed_R1.fastq.gz' % (task.id, task.impurities_prefilter_num)))
+        filterd_R2 = str(task.path.joinpath(
+            task.id, 'reads', '%s_%d_impurity_removed_R2.fastq.gz' % (task.id, task.impurities_prefilter_num)))
+    elif task.remove_host != None:
+        filterd_R1 = str(task.path.joinpath(task.id, 'reads', task.id + '_host_removed_R1.fastq.gz'))
+        filterd_R2 = str(task.path.joinpath(task.id, 'reads', task.id + '_host_removed_R2.fastq.gz'))
+    else:
+        filterd_R1 = str(task.path.joinpath(task.id, 'reads', task.id + '_R1.fastq.gz'))
+        filterd_R2 = str(task.path.joinpath(task.id, 'reads', task.id + '_R2.fastq.gz'))
+    return filterd_R1, filterd_R2
+
+
+def aln_cmd_of(task, aligner, ref_index_path):
+    filterd_R1, filterd_R2 = filtered_reads(task)
+    if aligner == 'bowtie2':
+        reads_cmd = ['-1', filterd_R1, '-2', filterd_R2]
+        thread_cmd = ['-p', str(task.threads)]
+        other_cmd = ['--very-sensitive-local']
+        return ['bowtie2', '-x', ref_index_path] + reads_cmd + thread_cmd + other_cmd
+    reads_cmd = [filterd_R1, filterd_R2]
+    option_cmd = ['-K 100000000 -Y']
+    thread_cmd = ['-t', str(task.threads)]
+    return ['bwa', 'mem'] + option_cmd + thread_cmd + [ref_index_path] + reads_cmd
 
 
 def align_bowtie2(task):
@@ -35,29 +59,9 @@ def align_bowtie2(task):
         logger.info('Running Bowtie2 alignment for ref #%d.'%ref_order)
         aligner_cwd = task.path.joinpath(task.id, 'alignment', 'bowtie2')
         ref_index_path = str(aligner_cwd.joinpath('%s_ref_%d'%(task.id, ref_order)))
-        # impurities_prefilter is latter process, so need to be check first, then remove_host
-        if task.impurities_prefilter_num > 0:
-            filterd_R1 = str(task.path.joinpath(
-                task.id, 'reads', '%s_%d_impurity_removed_R1.fastq.gz' % (task.id, task.impurities_prefilter_num)))
-            filterd_R2 = str(task.path.joinpath(
-                task.id, 'reads', '%s_%d_impurity_removed_R2.fastq.gz' % (task.id, task.impurities_prefilter_num)))
-        elif task.remove_host != None:
-            filterd_R1 = str(task.path.joinpath(task.id, 'reads', task.id + '_host_removed_R1.fastq.gz'))
-            filterd_R2 = str(task.path.joinpath(task.id, 'reads', task.id + '_host_removed_R2.fastq.gz'))
-        else:
-            filterd_R1 = str(task.path.joinpath(task.id, 'reads', task.id + '_R1.fastq.gz'))
-            filterd_R2 = str(task.path.joinpath(task.id, 'reads', task.id + '_R2.fastq.gz'))
-        reads_cmd = ['-1', filterd_R1, '-2', filterd_R2]
-        thread_cmd = ['-p', str(task.threads)]
-        output_cmd = ['-S', '%s_ref_%d.sam'%(task.id, ref_order)]
-        other_cmd = ['--very-sensitive-local']
-        aln_cmd = ['bowtie2', '-x', ref_index_path] + reads_cmd + output_cmd + thread_cmd + other_cmd
-        logger.info('CMD: '+' '.join(aln_cmd))
-        utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(aln_cmd))
-        bt2_run = subprocess.run(aln_cmd, cwd=aligner_cwd, capture_output=True)
-        print(bt2_run.stdout.decode(encoding='utf-8'))
-        print(bt2_run.stderr.decode(encoding='utf-8'))
-        bam_sort_n_index(task, 'bowtie2', ref_order)
+        aln_cmd = aln_cmd_of(task, 'bowtie2', ref_index_path)
+        utils.align_to_sorted_bam(task, aln_cmd, '%s_ref_%d.sorted.bam'%(task.id, ref_order), aligner_cwd)
+        bam_index(task, 'bowtie2', ref_order)
 
 
 def align_bwa(task):
@@ -65,103 +69,158 @@ def align_bwa(task):
         logger.info('Running BWA alignment for ref #%d.'%ref_order)
         aligner_cwd = task.path.joinpath(task.id, 'alignment', 'bwa')
         ref_index_path = str(aligner_cwd.joinpath('%s_ref_%d'%(task.id, ref_order)))
-        # impurities_prefilter is latter process, so need to be check first, then remove_host
-        if task.impurities_prefilter_num > 0:
-            filterd_R1 = str(task.path.joinpath(
-                task.id, 'reads', '%s_%d_impurity_removed_R1.fastq.gz' % (task.id, task.impurities_prefilter_num)))
-            filterd_R2 = str(task.path.joinpath(
-                task.id, 'reads', '%s_%d_impurity_removed_R2.fastq.gz' % (task.id, task.impurities_prefilter_num)))
-        elif task.remove_host != None:
-            filterd_R1 = str(task.path.joinpath(task.id, 'reads', task.id + '_host_removed_R1.fastq.gz'))
-            filterd_R2 = str(task.path.joinpath(task.id, 'reads', task.id + '_host_removed_R2.fastq.gz'))
-        else:
-            filterd_R1 = str(task.path.joinpath(task.id, 'reads', task.id + '_R1.fastq.gz'))
-            filterd_R2 = str(task.path.joinpath(task.id, 'reads', task.id + '_R2.fastq.gz'))
-        reads_cmd = [filterd_R1, filterd_R2]
-        option_cmd = ['-K 100000000 -Y']
-        thread_cmd = ['-t', str(task.threads)]
-        output_cmd = ['-o', '%s_ref_%d.sam'%(task.id, ref_order)]
-        aln_cmd = ['bwa', 'mem'] + option_cmd + thread_cmd + [ref_index_path] + reads_cmd + output_cmd
-        logger.info('CMD: '+' '.join(aln_cmd))
-        utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(aln_cmd))
-        bt2_run = subprocess.run(aln_cmd, cwd=aligner_cwd, capture_output=True)
-        print(bt2_run.stdout.decode(encoding='utf-8'))
-        print(bt2_run.stderr.decode(encoding='utf-8'))
-        bam_sort_n_index(task, 'bwa', ref_order)
-
-
-def bam_sort_n_index(task, aligner, ref_order):
-    logger.info('Sorting & indexing BAM file for aln #%d.'%ref_order)
+        aln_cmd = aln_cmd_of(task, 'bwa', ref_index_path)
+        utils.align_to_sorted_bam(task, aln_cmd, '%s_ref_%d.sorted.bam'%(task.id, ref_order), aligner_cwd)
+        bam_index(task, 'bwa', ref_order)
+
+
+def ref_contigs(task):
+    # contig names in BAM headers are the first word of the FASTA headers
+    ref_meta = utils.load_json_file(task.path.joinpath(task.id, 'reference', task.id + '_ref.json'))
+    return [ref_meta['seq_meta'][str(ref_order)]['fasta_header'].split()[0] for ref_order in range(1, task.ref_num+1)]
+
+
+def contig_region(contig):
+    # braces keep contig names with ':' from being parsed as a position range
+    return '{%s}' % contig if ':' in contig else contig
+
+
+def use_combined_ref(task):
+    if getattr(task, 'aln_ref_mode', 'per_ref') != 'combined' or task.ref_num < 2:
+        return False
+    contigs = ref_contigs(task)
+    if len(set(contigs)) != len(contigs):
+        logger.warning('Reference contig names are not unique, fall back to per reference alignment.')
+        return False
+    return True
+
+
+def combined_ref_index(task, aligner):
+    logger.info('Building %s combined index for %d refs.' % (aligner, task.ref_num))
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    Path.mkdir(aligner_cwd, parents=True, exist_ok=True)
+
+    def ref_records():
+        for ref_order in range(1, task.ref_num+1):
+            ref_fasta_path = task.path.joinpath(
+                task.id, 'reference', '%s_ref_%d.fasta'%(task.id, ref_order))
+            # per ref FASTA are still needed by variant calling
+            shutil.copy2(ref_fasta_path, aligner_cwd)
+            yield from utils.iter_fasta(ref_fasta_path)
+
+    utils.write_fasta_records(aligner_cwd.joinpath('%s_ref_all.fasta'%task.id), ref_records())
+    if aligner == 'bowtie2':
+        index_cmd = ['bowtie2-build', '--threads', task.threads, '%s_ref_all.fasta'%task.id, '%s_ref_all'%task.id]
+    elif aligner == 'bwa':
+        index_cmd = ['bwa', 'index', '-p', '%s_ref_all'%task.id, '%s_ref_all.fasta'%task.id]
+    index_cache.build_index(task, index_cmd, aligner_cwd, '%s_ref_all.fasta'%task.id, '%s_ref_all'%task.id)
+
+
+def split_ref_cell(task, aligner, ref_order, contig):
+    # region view of the combined BAM, output stays sorted and keeps the full header for mate references
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    split_cmd = ['samtools', 'view', '-b', '-@', task.threads, '-o', '%s_ref_%d.sorted.bam'%(task.id, ref_order),
+                 '%s_ref_all.sorted.bam'%task.id, contig_region(contig)]
+    utils.run_cmd(task, split_cmd, aligner_cwd)
+    bam_index(task, aligner, ref_order)
+
+
+def align_combined(task, aligner):
+    logger.info('Running %s alignment for %d refs in one pass.' % (aligner, task.ref_num))
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    aln_cmd = aln_cmd_of(task, aligner, str(aligner_cwd.joinpath('%s_ref_all'%task.id)))
+    utils.align_to_sorted_bam(task, aln_cmd, '%s_ref_all.sorted.bam'%task.id, aligner_cwd)
+    indexing_cmd = ['samtools', 'index', '-@', task.threads, '%s_ref_all.sorted.bam'%task.id]
+    utils.run_cmd(task, indexing_cmd, aligner_cwd)
+    # per ref BAM files keep the layout of per ref alignment for flagstat, coverage and variant calling
+    cells = [(aligner, ref_order, contig) for ref_order, contig in enumerate(ref_contigs(task), start=1)]
+    utils.fan_out(task, split_ref_cell, cells)
+
+
+def bam_index(task, aligner, ref_order):
+    logger.info('Indexing BAM file for aln #%d.'%ref_order)
     aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
-    # sorting
-    sorting_cmd = ['samtools', 'sort', '-@', task.threads, '%s_ref_%d.sam'%(task.id, ref_order), '-o', '%s_ref_%d.sorted.bam'%(task.id, ref_order)]
-    logger.info('CMD: '+' '.join(sorting_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(sorting_cmd))
-    sorting_run = subprocess.run(sorting_cmd, cwd=aligner_cwd, capture_output=True)
-    print(sorting_run.stdout.decode(encoding='utf-8'))
-    print(sorting_run.stderr.decode(encoding='utf-8'))
-    # indexing
     indexing_cmd = ['samtools', 'index', '-@', task.threads, '%s_ref_%d.sorted.bam'%(task.id, ref_order)]
-    logger.info('CMD: '+' '.join(indexing_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(indexing_cmd))
-    index_run = subprocess.run(indexing_cmd, cwd=aligner_cwd, capture_output=True)
-    print(index_run.stdout.decode(encoding='utf-8'))
-    print(index_run.stderr.decode(encoding='utf-8'))
-    # remove sam file to release disk space
-    os.remove(aligner_cwd.joinpath('%s_ref_%d.sam'%(task.id, ref_order)))
+    utils.run_cmd(task, indexing_cmd, aligner_cwd)
+
+
+def aln_cells(task, aligners):
+    return [(aligner, ref_order) for aligner in aligners for ref_order in range(1, task.ref_num+1)]
+
+
+def flagstat_cell(task, aligner, ref_order):
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    flagstat_cmd = ['samtools', 'flagstat', '-@', task.threads, '%s_ref_%d.sorted.bam'%(task.id, ref_order)]
+    flagstat_file_path = task.path.joinpath(aligner_cwd, 'flagstat_ref_%d.txt'%ref_order)
+    utils.run_cmd(task, flagstat_cmd, aligner_cwd, stdout_path=flagstat_file_path)
+    primary_mapped_reads = utils.primary_mapped_from_flagstat(flagstat_file_path)
+    mapped_rate = Decimal(primary_mapped_reads)/Decimal(task.total_reads_after_fastp)
+    return "%f%%" % (mapped_rate*Decimal('100')), primary_mapped_reads
 
 
 def align_flagstat(task, aligners):
     stats_dict = {'mapped_rate':{}, 'mapped_reads':{}}
-    for aligner in aligners:
-        logger.info('Analysis BAM file from %s' % aligner)
-        aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
-        stats_dict['mapped_rate'][aligner] = {}
-        stats_dict['mapped_reads'][aligner] = {}
-        for ref_order in range(1, task.ref_num+1):
-            flagstat_cmd = ['samtools', 'flagstat', '-@', task.threads, '%s_ref_%d.sorted.bam'%(task.id, ref_order)]
-            logger.info('CMD: '+' '.join(flagstat_cmd))
-            utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(flagstat_cmd))
-            flagstat_run = subprocess.run(flagstat_cmd, cwd=aligner_cwd, capture_output=True)
-            stats_text = flagstat_run.stdout.decode(encoding='utf-8')
-            flagstat_file_path = task.path.joinpath(aligner_cwd, 'flagstat_ref_%d.txt'%ref_order)
-            utils.build_text_file(flagstat_file_path, stats_text)
-            primary_mapped_reads = utils.primary_mapped_from_flagstat(flagstat_file_path)
-            mapped_rate = Decimal(primary_mapped_reads)/Decimal(task.total_reads_after_fastp)
-            stats_dict['mapped_rate'][aligner][ref_order]= "%f%%" % (mapped_rate*Decimal('100'))
-            stats_dict['mapped_reads'][aligner][ref_order]= primary_mapped_reads
+    logger.info('Analysis BAM files from %s' % ', '.join(aligners))
+    cells = aln_cells(task, aligners)
+    results = utils.fan_out(task, flagstat_cell, cells)
+    for (aligner, ref_order), (mapped_rate, primary_mapped_reads) in zip(cells, results):
+        stats_dict['mapped_rate'].setdefault(aligner, {})[ref_order] = mapped_rate
+        stats_dict['mapped_reads'].setdefault(aligner, {})[ref_order] = primary_mapped_reads
     utils.build_json_file(task.path.joinpath(task.id, 'alignment', 'flagstat.json'), stats_dict)
 
 
+def coverage_cell(task, aligner, ref_order, contig):
+    cov = {}
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    # region of the ref contig, BAM split from a combined alignment keeps all contigs in its header
+    flagstat_cmd = ['samtools', 'coverage', '-r', contig_region(contig), '%s_ref_%d.sorted.bam'%(task.id, ref_order)]
+    stats_text = utils.run_cmd(task, flagstat_cmd, aligner_cwd, capture=True).stdout
+    titles = stats_text.split('\n')[0].split('\t')
+    stats = stats_text.split('\n')[1].split('\t')
+    for i in range(len(titles)):
+        cov[titles[i]] = stats[i]
+    return cov
+
+
 def align_coverage_stat(task, aligners):
     cov_dict = {}
-    for aligner in aligners:
-        cov_dict[aligner] = {}
-        logger.info('Analysis coverage stats from %s BAM files.' % aligner)
-        aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
-        for ref_order in range(1, task.ref_num+1):
-            cov_dict[aligner][ref_order] = {}
-            flagstat_cmd = ['samtools', 'coverage', '%s_ref_%d.sorted.bam'%(task.id, ref_order)]
-            logger.info('CMD: '+' '.join(flagstat_cmd))
-            utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(flagstat_cmd))
-            flagstat_run = subprocess.run(flagstat_cmd, cwd=aligner_cwd, capture_output=True)
-            stats_text = flagstat_run.stdout.decode(encoding='utf-8')
-            titles = stats_text.split('\n')[0].split('\t')
-            stats = stats_text.split('\n')[1].split('\t')
-            for i in range(len(titles)):
-                cov_dict[aligner][ref_order][titles[i]] = stats[i]
+    logger.info('Analysis coverage stats from %s BAM files.' % ', '.join(aligners))
+    contigs = ref_contigs(task)
+    cells = [(aligner, ref_order, contigs[ref_order-1]) for aligner, ref_order in aln_cells(task, aligners)]
+    results = utils.fan_out(task, coverage_cell, cells)
+    for (aligner, ref_order, contig), cov in zip(cells, results):
+        cov_dict.setdefault(aligner, {})[ref_order] = cov
     utils.build_json_file(task.path.joinpath(task.id, 'alignment', 'coverage_stat.json'), cov_dict)
 
 
-def extract_unmapped_reads(task, aligners):
-    for aligner in aligners:
-        logger.info('Extract unmapped reads from %s BAM files.' % aligner)
-        aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
-        for ref_order in range(1, task.ref_num+1):
-            samtools_option_cmd = ['samtools', 'fastq', '-f 13']
-            samtools_fastq_cmd = ['-1', '%s_ref_%d_unmapped_R1.fastq.gz'%(task.id, ref_order), '-2', '%s_ref_%d_unmapped_R2.fastq.gz'%(task.id, ref_order)]
-            samtools_run_cmd = samtools_option_cmd + samtools_fastq_cmd + ['%s_ref_%d.sorted.bam'%(task.id, ref_order)]
-            subprocess.run(samtools_run_cmd, cwd=aligner_cwd, check=True)
+def unmapped_reads_cell(task, aligner, ref_order):
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    samtools_option_cmd = ['samtools', 'fastq', '-f 13']
+    samtools_fastq_cmd = ['-1', '%s_ref_%d_unmapped_R1.fastq.gz'%(task.id, ref_order), '-2', '%s_ref_%d_unmapped_R2.fastq.gz'%(task.id, ref_order)]
+    samtools_run_cmd = samtools_option_cmd + samtools_fastq_cmd + ['%s_ref_%d.sorted.bam'%(task.id, ref_order)]
+    utils.run_cmd(task, samtools_run_cmd, aligner_cwd)
+
+
+def combined_unmapped_reads_cell(task, aligner, ref_order, contig):
+    # same pairs as -f 13 of a per ref alignment: neither mate is mapped to this ref contig
+    aligner_cwd = task.path.joinpath(task.id, 'alignment', aligner)
+    filter_expr = 'flag.paired && (flag.unmap || rname != "%s") && (flag.munmap || mrname != "%s")' % (contig, contig)
+    utils.run_pipeline(task, [
+        ['samtools', 'view', '-u', '-F', '0x900', '-e', filter_expr, '%s_ref_all.sorted.bam'%task.id],
+        ['samtools', 'collate', '-u', '-O', '-'],
+        ['samtools', 'fastq', '-1', '%s_ref_%d_unmapped_R1.fastq.gz'%(task.id, ref_order),
+         '-2', '%s_ref_%d_unmapped_R2.fastq.gz'%(task.id, ref_order), '-']
+    ], aligner_cwd)
+
+
+def extract_unmapped_reads(task, aligners, combined=False):
+    logger.info('Extract unmapped reads from %s BAM files.' % ', '.join(aligners))
+    if combined:
+        contigs = ref_contigs(task)
+        cells = [(aligner, ref_order, contigs[ref_order-1]) for aligner, ref_order in aln_cells(task, aligners)]
+        utils.fan_out(task, combined_unmapped_reads_cell, cells)
+    else:
+        utils.fan_out(task, unmapped_reads_cell, aln_cells(task, aligners))
 
 
 def align_disp(task, aligner):
@@ -170,11 +229,28 @@ def align_disp(task, aligner):
     elif aligner == 'bwa':
         align_bwa(task)
 
-def run(task):
-    aligners = task.alns
-    for aligner in aligners:
+def index_n_align(task, aligner, combined=False):
+    if combined:
+        combined_ref_index(task, aligner)
+        align_combined(task, aligner)
+    else:
         ref_index(task, aligner)
         align_disp(task, aligner)
+
+
+def concurrent_index_n_align(task, aligners, combined=False):
+    # aligners read the same reads and write to their own folder, run them side by side with split threads
+    utils.fan_out(task, index_n_align, [(aligner, combined) for aligner in aligners])
+
+
+def run(task):
+    aligners = task.alns
+    combined = use_combined_ref(task)
+    if getattr(task, 'aln_concurrent', 'True') == 'True' and len(aligners) > 1:
+        concurrent_index_n_align(task, aligners, combined)
+    else:
+        for aligner in aligners:
+            index_n_align(task, aligner, combined)
     align_flagstat(task, aligners)
     align_coverage_stat(task, aligners)
-    extract_unmapped_reads(task, aligners)
+    extract_unmapped_reads(task, aligners, combined)
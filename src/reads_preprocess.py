@@ -2,11 +2,11 @@ import hashlib
 import logging
 import os
 import shutil
-import subprocess
 import sys
 from decimal import Decimal
 from pathlib import Path
 
+import host_index
 import summary_generator
 import utils
 
@@ -25,6 +25,9 @@ def import_reads(task):
         shutil.copy(external_reads_R2, original_reads_path.joinpath(
             task.id + '_R2.fastq.gz'))
         md5 = reads_hash_md5(task)
+        # same content as the copies, lets a resume check the raw reads without hashing them again
+        utils.remember_md5(external_reads_R1, md5[0])
+        utils.remember_md5(external_reads_R2, md5[1])
         reads_meta = {
             'file_name': {'r1': str(external_reads_R1), 'r2':str(external_reads_R2)},
             'md5': {'r1': md5[0], 'r2': md5[1]}
@@ -66,16 +69,7 @@ def run_fastp(task):
         '-T', str(task.global_trimming),
         '-w', str(task.threads)
     ]
-    logger.info('CMD: '+' '.join(fastp_cmd + reports_cmd + parameter_cmd))
-    utils.write_log_file(
-        task.path.joinpath(task.id),
-        'CMD: '+' '.join(fastp_cmd + reports_cmd + parameter_cmd)
-    )
-    fastp_run = subprocess.run(
-        fastp_cmd + reports_cmd + parameter_cmd,
-        capture_output=True
-    )
-    print(fastp_run.stderr.decode(encoding='utf-8'))
+    utils.run_cmd(task, fastp_cmd + reports_cmd + parameter_cmd, None)
     # record total reads after fastp
     task.total_reads_after_fastp = summary_generator.fastp_parser(task)['after_total_reads']
     mininal_reads = 100
@@ -109,80 +103,58 @@ def remove_host(task):
     host_remove_cwd = task.path.joinpath(task.id, 'reads')
     Path.mkdir(host_remove_cwd, parents=True, exist_ok=True)
 
-    if task.remove_host == 'dog':
-        dehost_meta['genome'] = 'Dog (Dog10K_Boxer_Tasha, GCF_000002285.5)'
-        genome_path = '/app/genomes/' + 'dog10k'
-    elif task.remove_host == 'human':
-        dehost_meta['genome'] = 'Human (GRCh38.p14, GCF_000001405.40)'
-        genome_path = '/app/genomes/' + 'GRCh38.p14'
-    elif task.remove_host == 'vero':
-        dehost_meta['genome'] = 'Vero (Vero_WHO_p1.0, GCF_015252025.1)'
-        genome_path = '/app/genomes/' +  'vero'
-    elif task.remove_host == 'chicken':
-        dehost_meta['genome'] = 'Chicken (GRCg6a, GCF_000002315.6)'
-        genome_path = '/app/genomes/' + 'grcg6a'
-    elif task.remove_host == 'rhesus_monkey':
-        dehost_meta['genome'] = 'Rhesus monkey (Mmul_10, GCF_003339765.1)'
-        genome_path = '/app/genomes/' + 'mmul_10'
-    else:
-        dehost_meta['genome'] = 'Custom sequence file (%s)'%task.remove_host
-        genome_path = '/app/genomes/' + task.remove_host
+    dehost_meta['genome'], genome_path = host_index.host_genome(task.remove_host)
 
-    mapped_reads_out = 'host_mapped.sam'
     align_cmd = [
         'bowtie2',
         '-p', str(task.threads),
         '-x', str(genome_path),
         '-1', str(task.path.joinpath(task.id, 'reads', task.id + '_R1.fastq.gz')),
         '-2', str(task.path.joinpath(task.id, 'reads', task.id + '_R2.fastq.gz')),
-        '-S', str(mapped_reads_out),
         '--very-sensitive-local'
     ]
-    logger.info('CMD: '+' '.join(align_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(align_cmd))
-    cmd_run = subprocess.run(align_cmd, cwd=host_remove_cwd, capture_output=True)
-    # print(cmd_run.stdout.decode(encoding='utf-8'))
-    print(cmd_run.stderr.decode(encoding='utf-8'))
-
-    # build meta
-    logger.info('Analysis BAM file from host mapped reads')
-    # sorting
-    sorting_cmd = ['samtools', 'sort', '-@', task.threads, 'host_mapped.sam', '-o', 'host_mapped.sorted.bam']
-    logger.info('CMD: '+' '.join(sorting_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(sorting_cmd))
-    sorting_run = subprocess.run(sorting_cmd, cwd=host_remove_cwd, capture_output=True)
-    print(sorting_run.stdout.decode(encoding='utf-8'))
-    print(sorting_run.stderr.decode(encoding='utf-8'))
-    # extract unmapped
+    if getattr(task, 'host_index_mm', 'True') == 'True':
+        # memory-mapped index, concurrent tasks share the pages of a warmed host index
+        align_cmd.append('--mm')
     unmapped_fastq_r1 = task.id + '_host_removed_R1.fastq.gz'
     unmapped_fastq_r2 = task.id + '_host_removed_R2.fastq.gz'
-    samtools_option_cmd = ['samtools', 'fastq', '-f 13']
-    samtools_fastq_cmd = ['-1', unmapped_fastq_r1, '-2', unmapped_fastq_r2]
-    samtools_run_cmd = samtools_option_cmd + samtools_fastq_cmd + ['host_mapped.sorted.bam']
-    subprocess.run(samtools_run_cmd, cwd=host_remove_cwd, check=True)
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(samtools_run_cmd))
-    # flagstat
-    flagstat_cmd = ['samtools', 'flagstat', '-@', task.threads, 'host_mapped.sorted.bam']
-    logger.info('CMD: '+' '.join(flagstat_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(flagstat_cmd))
-    flagstat_run = subprocess.run(flagstat_cmd, cwd=host_remove_cwd, capture_output=True)
-    stats_text = flagstat_run.stdout.decode(encoding='utf-8')
     flagstat_file_path = task.path.joinpath(host_remove_cwd, 'flagstat.txt')
-    utils.build_text_file(flagstat_file_path, stats_text)
+    if getattr(task, 'depletion_mode', 'stream') == 'stream':
+        # extract unmapped and count mapped reads in one pass, host BAM is not needed
+        utils.align_to_depleted_fastq(
+            task, align_cmd, unmapped_fastq_r1, unmapped_fastq_r2, flagstat_file_path, host_remove_cwd)
+    else:
+        utils.align_to_sorted_bam(task, align_cmd, 'host_mapped.sorted.bam', host_remove_cwd)
+        logger.info('Analysis BAM file from host mapped reads')
+        # extract unmapped
+        samtools_option_cmd = ['samtools', 'fastq', '-f 13']
+        samtools_fastq_cmd = ['-1', unmapped_fastq_r1, '-2', unmapped_fastq_r2]
+        samtools_run_cmd = samtools_option_cmd + samtools_fastq_cmd + ['host_mapped.sorted.bam']
+        utils.run_cmd(task, samtools_run_cmd, host_remove_cwd)
+        # flagstat
+        flagstat_cmd = ['samtools', 'flagstat', '-@', task.threads, 'host_mapped.sorted.bam']
+        utils.run_cmd(task, flagstat_cmd, host_remove_cwd, stdout_path=flagstat_file_path)
+        # remove host bam file to release disk space
+        os.remove(task.path.joinpath(host_remove_cwd, 'host_mapped.sorted.bam'))
+    # build meta
     total_reads = task.total_reads_after_fastp
     primary_mapped_reads = utils.primary_mapped_from_flagstat(flagstat_file_path)
     mapped_rate = Decimal(primary_mapped_reads)/Decimal(total_reads)
     dehost_meta['mapped_reads'] = primary_mapped_reads
     dehost_meta['remove_percentage'] = "%f%%" % (mapped_rate*Decimal('100'))
     utils.build_json_file(task.path.joinpath(host_remove_cwd, 'dehost_meta.json'), dehost_meta)
-    # remove sam file to release disk space
-    os.remove(task.path.joinpath(host_remove_cwd, mapped_reads_out))
-    # remove host bam file to release disk space
-    os.remove(task.path.joinpath(host_remove_cwd, 'host_mapped.sorted.bam'))
 
 def run(task):
+    warm_thread = None
+    if task.remove_host != None and getattr(task, 'host_index_warm', 'True') == 'True':
+        # load the host index into memory while reads are imported and filtered
+        warm_thread = host_index.warm_in_background(
+            task.path, [host_index.host_genome(task.remove_host)[1]],
+            host_index.mem_cap_bytes(getattr(task, 'host_index_mem', 'auto')))
     logger.info('Importing reads.')
     import_reads(task)
     run_fastp(task)
     if task.remove_host != None:
+        if warm_thread != None:
+            warm_thread.join()
         remove_host(task)
@@ -1,5 +1,4 @@
 import logging
-import subprocess
 import sys
 from pathlib import Path
 
@@ -30,11 +29,7 @@ def run_de_novo(task):
         '-2', r2,
         '-o', '%s_spades_%s'%(task.id, task.spades_mode)
     ]
-    logger.info('CMD: '+' '.join(assemble_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(assemble_cmd))
-    cmd_run = subprocess.run(assemble_cmd, cwd=assembly_cwd, capture_output=True)
-    print(cmd_run.stdout.decode(encoding='utf-8'))
-    print(cmd_run.stderr.decode(encoding='utf-8'))
+    utils.run_cmd(task, assemble_cmd, assembly_cwd)
 
 
 def blast_assembled(task):
@@ -55,11 +50,7 @@ def blast_assembled(task):
         '-max_target_seqs',
         '5'
     ]
-    logger.info('CMD: '+' '.join(blast_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(blast_cmd))
-    cmd_run = subprocess.run(blast_cmd, cwd=assembled_cwd, capture_output=True)
-    print(cmd_run.stdout.decode(encoding='utf-8'))
-    print(cmd_run.stderr.decode(encoding='utf-8'))
+    utils.run_cmd(task, blast_cmd, assembled_cwd)
 
 
 def extract_virus_refseq(task):
@@ -71,6 +62,9 @@ def extract_virus_refseq(task):
         utils.build_json_file(task.path.joinpath(task.id, 'assembly', 'best_hit.json'), best_hit_dict)
         refseq_virus_fasta_path = Path('/app/blastdb/%s'%task.unmapped_blastdb)
         fasta_dict = utils.extract_seq_from_fasta(refseq_virus_fasta_path, best_hit_dict['sseqid'])
+        if len(fasta_dict) == 0:
+            logger.critical('Best hit %s not found in %s.' % (best_hit_dict['sseqid'], refseq_virus_fasta_path))
+            sys.exit(-1)
         task.ref = task.path.joinpath(task.id, 'assembly', '%s.fasta'%best_hit_dict['sseqid'])
         utils.build_fasta_file(task.ref, fasta_dict)
     else:
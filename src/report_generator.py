@@ -190,6 +190,8 @@ def build_md_report(task):
         unmapped_as = 'Assembly mode: %s' % task.unmapped_spades_mode
         if task.unmapped_blastdb != None:
             unmapped_filt = 'Hits filter: Min. length %s bp,  Min. identity %s %%.'%(task.unmapped_len_filter, task.unmapped_ident_filter)
+            if getattr(task, 'blast_cascade', 'False') == 'True':
+                unmapped_filt += ' Cascade search: contigs resolved (Qcov >= %s %%) in a database are not searched in the following databases.' % task.blast_cascade_qcovs
             unmapped_c += '\n\n'.join([unmapped_as, unmapped_filt])
             for db, result in s['unmapped_analysis'].items():
                 unmapped_db = '\n\n### BLAST database: %s (date: %s)'% (result['BLASTdb_name'], result['BLASTdb_date'])
@@ -0,0 +1,193 @@
+import bisect
+import logging
+import mmap
+import os
+import threading
+from array import array
+from pathlib import Path
+
+import utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MAGIC = b'VIVARVI1'
+# byte order marker, counts (accessions, intervals, categories) and offsets of the 10 sections
+HEADER_LEN = 14
+SECTIONS = [
+    'name_offsets', 'names', 'acc_intervals', 'starts', 'ends', 'max_ends',
+    'orders', 'categories', 'category_offsets', 'category_names'
+]
+anno_indexes = {}
+anno_indexes_lock = threading.Lock()
+
+
+def index_path(tab_path):
+    return utils.sidecar_path(tab_path, '.idx')
+
+
+def compile_index(tab_path, idx_path):
+    # Intervals are grouped by accession (sorted by name) and sorted by start inside each accession.
+    # max_ends is the running maximum of ends, so an overlap scan can stop early.
+    annotation = {}
+    category_ids = {}
+    order = 0
+    with open(tab_path, 'r') as infile:
+        for line in infile:
+            accession, header_info, start_str, end_str, category = line.strip().split('\t')
+            try:
+                start = int(start_str)
+                end = int(end_str)
+            except ValueError:
+                logger.warning("Skipping line due to invalid start/end values %s" % accession)
+                continue
+            category_id = category_ids.setdefault(category, len(category_ids))
+            annotation.setdefault(accession, []).append((start, end, order, category_id))
+            order += 1
+
+    sections = {k: array('q') for k in SECTIONS if k not in ('names', 'category_names')}
+    names = bytearray()
+    sections['name_offsets'].append(0)
+    sections['acc_intervals'].append(0)
+    for accession in sorted(annotation, key=lambda a: a.encode('utf-8')):
+        names += accession.encode('utf-8')
+        sections['name_offsets'].append(len(names))
+        max_end = None
+        for start, end, order, category_id in sorted(annotation[accession]):
+            max_end = end if max_end == None else max(max_end, end)
+            sections['starts'].append(start)
+            sections['ends'].append(end)
+            sections['max_ends'].append(max_end)
+            sections['orders'].append(order)
+            sections['categories'].append(category_id)
+        sections['acc_intervals'].append(len(sections['starts']))
+    category_names = bytearray()
+    sections['category_offsets'].append(0)
+    for category in sorted(category_ids, key=category_ids.get):
+        category_names += category.encode('utf-8')
+        sections['category_offsets'].append(len(category_names))
+    sections['names'] = names
+    sections['category_names'] = category_names
+
+    header = array('q', [1, len(annotation), len(sections['starts']), len(category_ids)])
+    section_bytes = []
+    pos = len(MAGIC) + HEADER_LEN * 8
+    for k in SECTIONS:
+        data = bytes(sections[k])
+        header.append(pos)
+        # 8-byte aligned sections
+        data += b'\0' * (-len(data) % 8)
+        section_bytes.append(data)
+        pos += len(data)
+    tmp_idx_path = '%s.tmp-%d-%d' % (idx_path, os.getpid(), threading.get_ident())
+    with open(tmp_idx_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(header.tobytes())
+        for data in section_bytes:
+            f.write(data)
+    os.replace(tmp_idx_path, idx_path)
+
+
+def map_index(idx_path):
+    with open(idx_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        return None
+    header = view[len(MAGIC):len(MAGIC) + HEADER_LEN * 8].cast('q')
+    if header[0] != 1:
+        # written on a host of the other byte order
+        return None
+    acc_num, interval_num, category_num = header[1], header[2], header[3]
+    offsets = dict(zip(SECTIONS, header[4:]))
+
+    def q_section(name, n):
+        return view[offsets[name]:offsets[name] + n * 8].cast('q')
+
+    name_offsets = q_section('name_offsets', acc_num + 1)
+    category_offsets = q_section('category_offsets', category_num + 1)
+    category_names = bytes(view[offsets['category_names']:offsets['category_names'] + category_offsets[-1]])
+    return {
+        'mmap': mm,
+        'acc_num': acc_num,
+        'name_offsets': name_offsets,
+        'names_offset': offsets['names'],
+        'acc_intervals': q_section('acc_intervals', acc_num + 1),
+        'starts': q_section('starts', interval_num),
+        'ends': q_section('ends', interval_num),
+        'max_ends': q_section('max_ends', interval_num),
+        'orders': q_section('orders', interval_num),
+        'categories': q_section('categories', interval_num),
+        'category_names': [
+            category_names[category_offsets[i]:category_offsets[i+1]].decode('utf-8')
+            for i in range(category_num)
+        ],
+        # accessions already looked up, hits of a sample repeat the same accessions
+        'acc_cache': {}
+    }
+
+
+def load_index(tab_path):
+    # Compiled once next to the .tab (rebuilt when the .tab is newer) and memory-mapped,
+    # concurrent tasks share the pages of the same file. Each process maps it once.
+    idx_path = index_path(tab_path)
+    tab_stat = Path(tab_path).stat()
+    with anno_indexes_lock:
+        key = (str(idx_path), tab_stat.st_mtime_ns, tab_stat.st_size)
+        if key not in anno_indexes:
+            anno_index = None
+            if idx_path.is_file() and idx_path.stat().st_mtime_ns >= tab_stat.st_mtime_ns:
+                anno_index = map_index(idx_path)
+            if anno_index == None:
+                logger.info('Compiling RVDB annotation index of %s.' % tab_path)
+                Path.mkdir(idx_path.parent, parents=True, exist_ok=True)
+                compile_index(tab_path, idx_path)
+                anno_index = map_index(idx_path)
+            anno_indexes[key] = anno_index
+        return anno_indexes[key]
+
+
+def find_accession(anno_index, accession):
+    # binary search over the sorted names, slices of the mmap are compared without decoding
+    target = accession.encode('utf-8')
+    mm = anno_index['mmap']
+    base = anno_index['names_offset']
+    name_offsets = anno_index['name_offsets']
+    lo, hi = 0, anno_index['acc_num']
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mm[base + name_offsets[mid]:base + name_offsets[mid+1]] < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < anno_index['acc_num'] and mm[base + name_offsets[lo]:base + name_offsets[lo+1]] == target:
+        return lo
+    return None
+
+
+def find_category(anno_index, accession, start, end):
+    # Category of the annotation overlapping [start, end], the one listed last in the .tab wins
+    # like a scan of the annotation list in file order.
+    if start > end:
+        start, end = end, start
+    if accession not in anno_index['acc_cache']:
+        anno_index['acc_cache'][accession] = find_accession(anno_index, accession)
+    acc_order = anno_index['acc_cache'][accession]
+    if acc_order == None:
+        return None
+    lo = anno_index['acc_intervals'][acc_order]
+    hi = anno_index['acc_intervals'][acc_order+1]
+    # intervals starting after end can not overlap
+    i = bisect.bisect_right(anno_index['starts'], end, lo, hi)
+    best_order = -1
+    category_id = None
+    while i > lo:
+        i -= 1
+        if anno_index['max_ends'][i] < start:
+            break
+        if anno_index['ends'][i] >= start and anno_index['orders'][i] > best_order:
+            best_order = anno_index['orders'][i]
+            category_id = anno_index['categories'][i]
+    if category_id == None:
+        return None
+    return anno_index['category_names'][category_id]
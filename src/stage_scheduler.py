@@ -0,0 +1,289 @@
+import concurrent.futures
+import copy
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+
+import utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class Stage:
+    def __init__(self, name, run, after=(), inputs=None, outputs=None, params=(), weight=1):
+        # inputs/outputs are callables returning the file paths of the stage,
+        # they are evaluated lazily since most paths depend on earlier stages (e.g. task.ref_num).
+        # params are the task attribute names which change the stage result, recorded in the checkpoint.
+        # weight 0 marks a light stage which runs on 1 thread without reserving the thread budget.
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = tuple(params)
+        self.weight = weight
+
+
+def stage_paths(task, paths_func):
+    if paths_func == None:
+        return []
+    return [Path(p) for p in paths_func(task)]
+
+
+def missing_paths(task, paths_func):
+    return [p for p in stage_paths(task, paths_func) if not p.exists()]
+
+
+def allocate_threads(ready_stages, free_threads):
+    alloc = {}
+    heavy_stages = [s for s in ready_stages if s.weight > 0][:max(0, free_threads)]
+    total_weight = sum(s.weight for s in heavy_stages)
+    for stage in ready_stages:
+        if stage.weight == 0:
+            alloc[stage.name] = 1
+        elif stage in heavy_stages:
+            alloc[stage.name] = max(1, free_threads * stage.weight // total_weight)
+    return alloc
+
+
+def stage_task_view(task, threads, stage_name):
+    # Each stage gets a shallow copy of task so it can run with its own share of threads.
+    # stage_name tags the command metrics of the stage.
+    view = copy.copy(task)
+    view.threads = str(threads)
+    view.stage_name = stage_name
+    return view
+
+
+def merge_stage_task(task, view, snapshot):
+    # Only copy back attributes the stage changed, so concurrent stages do not overwrite each other.
+    changed = {}
+    for k, v in vars(view).items():
+        if k in ('threads', 'stage_name'):
+            continue
+        if k not in snapshot or snapshot[k] is not v:
+            setattr(task, k, v)
+            changed[k] = v
+    return changed
+
+
+def run_stage(stage, view, fingerprint=None):
+    # Fingerprint what the stage consumes before it runs, stages may change their params (e.g. de novo ref).
+    if fingerprint == None:
+        fingerprint = stage_fingerprint(view, stage)
+    # The stage's own Python I/O (e.g. copying the original reads) is counted on its worker thread,
+    # the I/O of external commands is recorded per command.
+    io_start = utils.read_proc_io('/proc/thread-self/io')
+    stage.run(view)
+    io_end = utils.read_proc_io('/proc/thread-self/io')
+    return fingerprint, {k: io_end[k] - io_start[k] for k in ('read_bytes', 'write_bytes', 'rchar', 'wchar')
+                         if k in io_start and k in io_end}
+
+
+def record_stage_metrics(task, stage_name, event, **metrics):
+    # tasks/<id>/stage_metrics.json, the task folder size is sampled at every stage boundary
+    task_cwd = task.path.joinpath(task.id)
+    metrics_path = task_cwd.joinpath('stage_metrics.json')
+    metrics_list = utils.load_json_file(metrics_path) if metrics_path.is_file() else []
+    metrics_list.append(dict({
+        'stage': stage_name,
+        'event': event,
+        'time': round(time.time(), 3),
+        'task_dir_bytes': utils.disk_usage(task_cwd)
+    }, **metrics))
+    utils.build_json_file(metrics_path, metrics_list)
+
+
+def json_normalize(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+def checkpoint_path(task, stage):
+    return task.path.joinpath(task.id, 'checkpoints', '%s.json' % stage.name)
+
+
+def stage_fingerprint(task, stage):
+    # Inputs size and mtime, params and upstream fingerprints decide if a finished stage is still valid.
+    # Inputs are not hashed here, a normal run does not read them an extra time.
+    upstream = {}
+    for dep in stage.after:
+        dep_manifest_path = task.path.joinpath(task.id, 'checkpoints', '%s.json' % dep)
+        if dep_manifest_path.is_file():
+            upstream[dep] = utils.load_json_file(dep_manifest_path)['fingerprint']
+        else:
+            upstream[dep] = None
+    fingerprint = {
+        'inputs': {str(p): utils.file_stat(p) for p in stage_paths(task, stage.inputs)},
+        'params': json_normalize({k: getattr(task, k, None) for k in stage.params}),
+        'upstream': upstream
+    }
+    digest = hashlib.md5(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+    return fingerprint, digest
+
+
+def known_input_md5s(fingerprint):
+    known = {}
+    for p, stat in fingerprint['inputs'].items():
+        md5 = utils.known_md5(p) if Path(p).is_file() else None
+        # only when the file is still the one fingerprinted before the stage ran
+        if md5 != None and utils.file_stat(p) == stat:
+            known[p] = md5
+    return known
+
+
+def write_checkpoint(task, stage, changed_attrs, fingerprint, digest):
+    manifest = {
+        'stage': stage.name,
+        'fingerprint': digest,
+        'inputs': fingerprint['inputs'],
+        'params': fingerprint['params'],
+        'upstream': fingerprint['upstream'],
+        # md5 of the inputs already hashed by the stages (e.g. raw reads), checked on resume when size or mtime changed
+        'input_md5': known_input_md5s(fingerprint),
+        'outputs': {str(p): p.stat().st_size for p in stage_paths(task, stage.outputs)},
+        'task_attrs': json_normalize(changed_attrs)
+    }
+    manifest_path = checkpoint_path(task, stage)
+    Path.mkdir(manifest_path.parent, parents=True, exist_ok=True)
+    utils.build_json_file(manifest_path, manifest)
+
+
+def inputs_unchanged(manifest, fingerprint):
+    # Inputs with the recorded size and mtime are unchanged. The others are hashed only when
+    # an md5 was recorded for them, e.g. raw reads copied again with the same content.
+    if set(manifest['inputs']) != set(fingerprint['inputs']):
+        return False
+    for p, stat in fingerprint['inputs'].items():
+        if manifest['inputs'][p] == stat:
+            continue
+        md5 = manifest.get('input_md5', {}).get(p)
+        if md5 == None or utils.file_md5(p) != md5:
+            return False
+        utils.remember_md5(p, md5)
+    return True
+
+
+def load_valid_checkpoint(task, stage):
+    # Returns (manifest or None, fingerprint or None), the fingerprint computed for a rejected checkpoint
+    # is reused when the stage is launched.
+    manifest_path = checkpoint_path(task, stage)
+    if not manifest_path.is_file():
+        return None, None
+    manifest = utils.load_json_file(manifest_path)
+    # restore the task attributes first, output paths may depend on them (e.g. ref_num)
+    restore_view = copy.copy(task)
+    for k, v in manifest['task_attrs'].items():
+        setattr(restore_view, k, v)
+    for output, size in manifest['outputs'].items():
+        if not Path(output).is_file() or Path(output).stat().st_size != size:
+            logger.info('Checkpoint of stage %s is outdated, output changed: %s' % (stage.name, output))
+            return None, None
+    if missing_paths(restore_view, stage.outputs):
+        return None, None
+    fingerprint = stage_fingerprint(task, stage)
+    if fingerprint[0]['params'] != manifest['params'] or fingerprint[0]['upstream'] != manifest['upstream'] \
+            or not inputs_unchanged(manifest, fingerprint[0]):
+        logger.info('Checkpoint of stage %s is outdated, inputs or params changed.' % stage.name)
+        return None, fingerprint
+    if fingerprint[0]['inputs'] != manifest['inputs']:
+        # same content with a new size/mtime record, the fingerprint passed to later stages is kept
+        manifest['inputs'] = fingerprint[0]['inputs']
+        utils.build_json_file(manifest_path, manifest)
+    return manifest, fingerprint
+
+
+def run_stages(task, stages, parallel=True, resume=False):
+    stage_names = [s.name for s in stages]
+    for stage in stages:
+        for dep in stage.after:
+            if dep not in stage_names:
+                raise ValueError('Stage %s depends on unknown stage %s.' % (stage.name, dep))
+
+    task_cwd = task.path.joinpath(task.id)
+    budget = max(1, int(task.threads))
+    used_threads = 0
+    pending = list(stages)
+    done = set()
+    running = {}
+    checked = set()
+    # a batch worker process runs the next task after a failed one
+    utils.cmds_cancelled.clear()
+    # fingerprints computed while checking rejected checkpoints
+    fingerprints = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(stages))
+    try:
+        while pending or running:
+            ready = [
+                s for s in pending
+                if all(dep in done for dep in s.after) and len(missing_paths(task, s.inputs)) == 0
+            ]
+            if not parallel:
+                ready = ready[:1] if len(running) == 0 else []
+            if resume:
+                skipped = False
+                for stage in ready:
+                    if stage.name in checked:
+                        continue
+                    checked.add(stage.name)
+                    manifest, fingerprint = load_valid_checkpoint(task, stage)
+                    if manifest == None:
+                        if fingerprint != None:
+                            fingerprints[stage.name] = fingerprint
+                    else:
+                        for k, v in manifest['task_attrs'].items():
+                            setattr(task, k, v)
+                        pending.remove(stage)
+                        done.add(stage.name)
+                        skipped = True
+                        logger.info('Stage %s skipped, checkpoint matched.' % stage.name)
+                        utils.write_log_file(task_cwd, 'STAGE: %s skipped (checkpoint)' % stage.name)
+                        record_stage_metrics(task, stage.name, 'skipped')
+                if skipped:
+                    continue
+            alloc = allocate_threads(ready, budget - used_threads)
+            for stage in ready:
+                if stage.name not in alloc:
+                    continue
+                threads = alloc[stage.name]
+                view = stage_task_view(task, threads, stage.name)
+                snapshot = dict(vars(view))
+                logger.info('Stage %s started with %d threads.' % (stage.name, threads))
+                utils.write_log_file(task_cwd, 'STAGE: %s started (threads %d)' % (stage.name, threads))
+                record_stage_metrics(task, stage.name, 'started', threads=threads)
+                future = executor.submit(run_stage, stage, view, fingerprints.pop(stage.name, None))
+                running[future] = (stage, view, snapshot, threads if stage.weight > 0 else 0)
+                used_threads += running[future][3]
+                pending.remove(stage)
+
+            if len(running) == 0:
+                blocked = ['%s (missing: %s)' % (s.name, ', '.join(str(p) for p in missing_paths(task, s.inputs)))
+                           for s in pending]
+                raise RuntimeError('Stages can not start: %s' % '; '.join(blocked))
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage, view, snapshot, threads = running.pop(future)
+                used_threads -= threads
+                fingerprint, stage_io = future.result()
+                changed_attrs = merge_stage_task(task, view, snapshot)
+                missing_outputs = missing_paths(task, stage.outputs)
+                if len(missing_outputs) > 0:
+                    raise RuntimeError('Stage %s finished without outputs: %s' % (
+                        stage.name, ', '.join(str(p) for p in missing_outputs)))
+                write_checkpoint(task, stage, changed_attrs, *fingerprint)
+                done.add(stage.name)
+                record_stage_metrics(task, stage.name, 'finished', python_io=stage_io)
+                logger.info('Stage %s finished.' % stage.name)
+                utils.write_log_file(task_cwd, 'STAGE: %s finished' % stage.name)
+    except BaseException:
+        # Do not block on long running siblings (e.g. SPAdes), let the error surface now. The worker threads
+        # are joined at interpreter exit, so their external commands are killed to let them end quickly,
+        # Python code of a sibling stage still runs until its next command.
+        utils.cancel_cmds()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
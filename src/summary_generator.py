@@ -6,6 +6,7 @@ from pathlib import Path
 
 import utils
 import db_manager
+import vc_table
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -81,7 +82,8 @@ def report_summary(task):
         }
     s['aln'] = single_meta_parser(task, 'alignment', 'flagstat.json')
     s['cov'] = single_meta_parser(task, 'alignment', 'coverage_stat.json')
-    s['vc'] = vc_parser(task)
+    variant_table = vc_parser(task)
+    s['vc'] = vc_table.table_to_vc_dict(variant_table)
     s['draft_meta'] = single_meta_parser(task, 'draft_genome', task.id + '_draft_summary.json').copy()
     if task.unmapped_blastdb != None:
         unmapped_summary = {}
@@ -94,6 +96,8 @@ def report_summary(task):
         s['unmapped_analysis'] = {}
         s['unmapped_analysis']['N/A'] = {'BLASTdb_name':'N/A','highly_matched_result':[]}
     s['version'] = tool_version_caller(task)
+    s['cmd_metrics'] = cmd_metrics_parser(task)
+    s['stage_metrics'], s['task_dir_peak_bytes'] = stage_metrics_parser(task, s['cmd_metrics'])
     utils.build_json_file(
         task.path.joinpath(task.id, task.id + '_summary.json'),
         s
@@ -102,7 +106,7 @@ def report_summary(task):
     # Save the parsed information into the task tracker database
     try:
         db = db_manager.VIVADatabase()
-        db.save_final_summary(task.id, s)
+        db.save_final_summary(task.id, s, variant_rows=vc_table.variant_rows(variant_table))
     except Exception as e:
         logger.error(f"Failed to record final summary to database: {e}")
 
@@ -174,11 +178,62 @@ def log_parser(task):
     return log_abs
 
 
+def cmd_metrics_parser(task):
+    cmd_metrics_path = task.path.joinpath(task.id, 'cmd_metrics.json')
+    if cmd_metrics_path.is_file():
+        return utils.load_json_file(cmd_metrics_path)
+    return []
+
+
+def stage_metrics_parser(task, cmd_metrics):
+    # One entry per stage run, disk I/O is the stage's Python I/O plus its external commands.
+    stage_metrics_path = task.path.joinpath(task.id, 'stage_metrics.json')
+    if not stage_metrics_path.is_file():
+        return [], None
+    events = utils.load_json_file(stage_metrics_path)
+    stage_runs = []
+    started = {}
+    for e in events:
+        if e['event'] == 'started':
+            started[e['stage']] = e
+        elif e['event'] == 'skipped':
+            stage_runs.append({
+                'stage': e['stage'],
+                'status': 'skipped',
+                'start_time': e['time'],
+                'finish_time': e['time'],
+                'task_dir_bytes_start': e['task_dir_bytes'],
+                'task_dir_bytes_end': e['task_dir_bytes']
+            })
+        elif e['event'] == 'finished' and e['stage'] in started:
+            start = started.pop(e['stage'])
+            stage_cmds = [
+                m for m in cmd_metrics
+                if m.get('stage') == e['stage'] and start['time'] <= m['start_time'] <= e['time']
+            ]
+            python_io = e.get('python_io', {})
+            stage_run = {
+                'stage': e['stage'],
+                'status': 'finished',
+                'threads': start.get('threads'),
+                'start_time': start['time'],
+                'finish_time': e['time'],
+                'task_dir_bytes_start': start['task_dir_bytes'],
+                'task_dir_bytes_end': e['task_dir_bytes']
+            }
+            for k in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+                cmd_bytes = sum(m.get(k) or 0 for m in stage_cmds)
+                stage_run['cmd_' + k] = cmd_bytes
+                stage_run['python_' + k] = python_io.get(k, 0)
+                stage_run[k] = cmd_bytes + python_io.get(k, 0)
+            stage_runs.append(stage_run)
+    task_dir_peak_bytes = max(e['task_dir_bytes'] for e in events) if len(events) > 0 else None
+    return stage_runs, task_dir_peak_bytes
+
+
 def vc_parser(task):
-    vc_json_path = task.path.joinpath(
-        task.id, task.id + '_vc_summary.json')
-    vc_dict = utils.load_json_file(vc_json_path)
-    return vc_dict
+    # the columnar variant table written next to _vc_summary.json, the summary and the database are built from it
+    return vc_table.load_table(vc_table.table_path(task))
 
 
 def tool_version_caller(task):
@@ -1,12 +1,17 @@
 import argparse
+import concurrent.futures
 import configparser
 import logging
+import os
 import subprocess
 import sys
 import time
 from ast import keyword
 from pathlib import Path
 
+import benchmark
+import host_index
+import microbenchmark
 import new_task
 import utils
 import batch_task_report
@@ -45,7 +50,52 @@ def input_paths_check(file_path):
         return False
 
 
-def batch_task_viva(task_sheet_dict):
+def host_mem_gb():
+    return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3)
+
+
+def preset_resources(preset_path):
+    # threads and spades_mem (GB) of a preset, defaults follow new_task args
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.read(preset_path)
+    threads = int(config.get('PRESET', 'threads', fallback='6'))
+    mem = int(config.get('PRESET', 'spades_mem', fallback='22'))
+    return threads, mem
+
+
+def preset_host_indexes(preset_paths):
+    # host index prefixes used by the presets, in queue order
+    index_prefixes = []
+    for preset_path in preset_paths:
+        config = configparser.ConfigParser(allow_no_value=True)
+        config.read(preset_path)
+        remove_host = config.get('PRESET', 'remove_host', fallback=None)
+        if remove_host != None and config.get('PRESET', 'host_index_warm', fallback='True') == 'True':
+            index_prefix = host_index.host_genome(remove_host)[1]
+            if index_prefix not in index_prefixes:
+                index_prefixes.append(index_prefix)
+    return index_prefixes
+
+
+def run_queue_task(task_inputs):
+    # run in a worker process of batch executor
+    try:
+        return new_task.main([
+            '--prefix', task_inputs['task_prefix'],
+            '--ex_r1', task_inputs['read_meta_dict']['ex_r1'],
+            '--ex_r2', task_inputs['read_meta_dict']['ex_r2'],
+            '--preset', task_inputs['preset_path'],
+            '--task_note', task_inputs['batch_task_note'],
+            '--sample_product_name', task_inputs['read_meta_dict']['product'],
+            '--sample_product_lot', task_inputs['read_meta_dict']['lot'],
+            '--sample_sequencing_date', task_inputs['read_meta_dict']['seq_date'],
+            '--sample_note', task_inputs['read_meta_dict']['reads_note']
+        ])
+    except SystemExit as e:
+        raise RuntimeError('Task exited with code %s' % e.code)
+
+
+def batch_task_viva(task_sheet_dict, max_threads=None, max_mem=None, host_index_mem=None):
     queue_dict = {}
     number = 1
     for v in task_sheet_dict.values():
@@ -75,40 +125,71 @@ def batch_task_viva(task_sheet_dict):
     
     finished_task_queue = {}
     finished_task_queue_path = Path.cwd().joinpath('tasks').joinpath('%s_queue_finished.json' % batch_task_id)
-    finished_task_id_list = []
+    finished_task_id_dict = {}
     queue_length = len(queue_dict)
     error_flag = False
-    for current_queue_number in range(1, queue_length+1):
-        try:
-            logger.info('Excuting queue No. %d' % current_queue_number)
+    if max_threads == None:
+        max_threads = os.cpu_count()
+    if max_mem == None:
+        max_mem = host_mem_gb()
+    logger.info('Batch budget: %d threads, %d GB memory.' % (max_threads, max_mem))
+    # host indexes of the whole queue are loaded once ahead of the tasks, tasks map them with bowtie2 --mm
+    host_index.warm_in_background(
+        Path.cwd().joinpath('tasks'),
+        preset_host_indexes([queue_dict[n]['preset_path'] for n in sorted(queue_dict)]),
+        host_index.mem_cap_bytes(host_index_mem))
+    preset_resources_dict = {}
+    waiting_queue = list(range(1, queue_length+1))
+    running = {}
+    used_threads = 0
+    used_mem = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(queue_length, max_threads))) as executor:
+            while waiting_queue or running:
+                for current_queue_number in list(waiting_queue):
+                    preset = queue_dict[current_queue_number]['preset_path']
+                    if preset not in preset_resources_dict:
+                        preset_resources_dict[preset] = preset_resources(preset)
+                    threads, mem = preset_resources_dict[preset]
+                    # a task larger than the whole budget still runs, but alone
+                    if len(running) == 0 or (used_threads+threads <= max_threads and used_mem+mem <= max_mem):
+                        logger.info('Excuting queue No. %d (%d threads, %d GB)' % (current_queue_number, threads, mem))
+                        task_inputs = queue_dict[current_queue_number].copy()
+                        future = executor.submit(run_queue_task, task_inputs)
+                        running[future] = (current_queue_number, task_inputs, threads, mem)
+                        used_threads += threads
+                        used_mem += mem
+                        waiting_queue.remove(current_queue_number)
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    current_queue_number, task_inputs, threads, mem = running.pop(future)
+                    used_threads -= threads
+                    used_mem -= mem
+                    try:
+                        task_id = future.result()
+                        task_inputs['task_id'] = task_id
+                        finished_task_queue[current_queue_number] = task_inputs
+                        finished_task_queue[current_queue_number]['task_status'] = 'done'
+                        finished_task_id_dict[current_queue_number] = task_id
+                    except Exception as e:
+                        logger.error('Task error occured: %s'%e)
+                        finished_task_queue[current_queue_number] = {}
+                        finished_task_queue[current_queue_number]['task_status'] = 'Error: %s'%e
+                        error_flag = True
+    except concurrent.futures.process.BrokenProcessPool as e:
+        # A worker process died (e.g. SPAdes killed for OOM), the pool takes no more tasks.
+        # Tasks finished so far keep their results, the rest of the queue is marked as failed.
+        logger.error('Batch worker pool broken: %s' % e)
+        for current_queue_number in [v[0] for v in running.values()] + waiting_queue:
             finished_task_queue[current_queue_number] = {}
-            task_inputs = queue_dict[current_queue_number].copy()
-            prefix = task_inputs['task_prefix']
-            ex_r1 = task_inputs['read_meta_dict']['ex_r1']
-            ex_r2 = task_inputs['read_meta_dict']['ex_r2']
-            preset = task_inputs['preset_path']
-            task_note = task_inputs['batch_task_note']
-            task_id = new_task.main([
-                '--prefix', prefix,
-                '--ex_r1', ex_r1,
-                '--ex_r2', ex_r2,
-                '--preset', preset,
-                '--task_note', task_note,
-                '--sample_product_name', task_inputs['read_meta_dict']['product'],
-                '--sample_product_lot', task_inputs['read_meta_dict']['lot'],
-                '--sample_sequencing_date', task_inputs['read_meta_dict']['seq_date'],
-                '--sample_note', task_inputs['read_meta_dict']['reads_note']
-            ])
-            task_inputs['task_id'] = task_id
-            finished_task_queue[current_queue_number] = task_inputs
-            finished_task_queue[current_queue_number]['task_status'] = 'done'
-            finished_task_id_list.append(task_id)
-        except Exception as e:
-            logger.error('Task error occured: %s'%e)
-            finished_task_queue[current_queue_number]['task_status'] = 'Error: %s'%e
-            error_flag = True
-    utils.build_json_file(finished_task_queue_path, finished_task_queue)
-    batch_task_report.generate_summary_csv(batch_task_id, finished_task_id_list)
+            finished_task_queue[current_queue_number]['task_status'] = 'Error: %s' % e
+        error_flag = True
+    finally:
+        finished_task_queue = dict(sorted(finished_task_queue.items()))
+        finished_task_id_list = [finished_task_id_dict[k] for k in sorted(finished_task_id_dict)]
+        utils.build_json_file(finished_task_queue_path, finished_task_queue)
+        batch_task_report.generate_summary_csv(batch_task_id, finished_task_id_list)
     if error_flag:
         logger.warning('Batch VIVA was finished with error. Task done: %s/%s'%(len(finished_task_id_list), queue_length))
     else:
@@ -120,9 +201,23 @@ def main():
         '--single_task', help="Run single task.", action='store_true')
     parser.add_argument(
         '--task_sheet', help="Task sheet filename to run with.", default=None)
+    parser.add_argument(
+        '--benchmark', help="Run the end-to-end benchmark on synthetic reads.", action='store_true')
+    parser.add_argument(
+        '--microbenchmark', help="Run the microbenchmarks of the Python hot paths.", action='store_true')
+    parser.add_argument(
+        '--batch_threads', help="Total CPU threads shared by concurrent batch tasks. Default: all CPUs.", type=int, default=None)
+    parser.add_argument(
+        '--batch_mem', help="Total memory (GB) shared by concurrent batch tasks, counted by preset spades_mem. Default: host memory.", type=int, default=None)
+    parser.add_argument(
+        '--batch_host_index_mem', help="Memory cap (GB) of host indexes kept resident for the batch. Default: half of host memory.", default=None)
     args, unknown = parser.parse_known_args()
     if args.single_task:
         new_task.main(sys.argv[1:])
+    elif args.benchmark:
+        benchmark.main(sys.argv[1:])
+    elif args.microbenchmark:
+        microbenchmark.main(sys.argv[1:])
     elif args.task_sheet != None:
         if input_paths_check(args.task_sheet):
             task_sheet_dict = {}
@@ -132,12 +227,12 @@ def main():
                 task_sheet_dict[section] = {}
                 for key, val in task_sheet_config.items(section):
                     task_sheet_dict[section][key] = val
-            batch_task_viva(task_sheet_dict)
+            batch_task_viva(task_sheet_dict, args.batch_threads, args.batch_mem, args.batch_host_index_mem)
         else:
             logger.critical('Task sheet was not found.')
             sys.exit(-1)
     else:
-        logger.critical('Must provide a task sheet or use --single_task arg.')
+        logger.critical('Must provide a task sheet or use --single_task, --benchmark or --microbenchmark arg.')
         sys.exit(-1)
 
 
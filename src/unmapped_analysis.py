@@ -3,9 +3,10 @@ import subprocess
 import sys
 import os
 import shutil
-from decimal import Decimal
 from pathlib import Path
 
+import blast_cache
+import rvdb_anno_index
 import utils
 
 logger = logging.getLogger(__name__)
@@ -37,11 +38,7 @@ def run_de_novo(task):
             'target=' + str(target),
             'min=' + str(min_cov)
         ]
-        logger.info('CMD: '+' '.join(bbnorm_cmd))
-        utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(bbnorm_cmd))
-        cmd_run = subprocess.run(bbnorm_cmd, cwd=unmapped_assembly_cwd, capture_output=True)
-        print(cmd_run.stdout.decode(encoding='utf-8'))
-        print(cmd_run.stderr.decode(encoding='utf-8'))
+        utils.run_cmd(task, bbnorm_cmd, unmapped_assembly_cwd)
         
         r1 = norm_r1
         r2 = norm_r2
@@ -56,13 +53,8 @@ def run_de_novo(task):
         '-2', r2,
         '-o', output_folder_name
     ]
-    logger.info('CMD: '+' '.join(assemble_cmd))
-    utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(assemble_cmd))
-    cmd_run = subprocess.run(assemble_cmd, cwd=unmapped_assembly_cwd, capture_output=True)
-    stdout_msg = cmd_run.stdout.decode(encoding='utf-8')
-    stderr_msg = cmd_run.stderr.decode(encoding='utf-8')
-    print(stdout_msg)
-    print(stderr_msg)
+    # failures are handled by the retries below
+    cmd_run = utils.run_cmd(task, assemble_cmd, unmapped_assembly_cwd, check=False)
 
     if cmd_run.returncode != 0:
         # Retry Phase 1: Half threads (to handle Race Conditions and moderate OOM)
@@ -83,13 +75,7 @@ def run_de_novo(task):
         except (ValueError, IndexError):
             pass
         
-        logger.info('Retry Phase 1 CMD: '+' '.join(retry_cmd))
-        utils.write_log_file(task.path.joinpath(task.id), 'Retry Phase 1 CMD: '+' '.join(retry_cmd))
-        cmd_run = subprocess.run(retry_cmd, cwd=unmapped_assembly_cwd, capture_output=True)
-        stdout_msg = cmd_run.stdout.decode(encoding='utf-8')
-        stderr_msg = cmd_run.stderr.decode(encoding='utf-8')
-        print(stdout_msg)
-        print(stderr_msg)
+        cmd_run = utils.run_cmd(task, retry_cmd, unmapped_assembly_cwd, check=False, label='Retry Phase 1 CMD')
         
         # Final Retry Phase 2: --only-assembler (to bypass all Error Correction bugs/limits)
         if cmd_run.returncode != 0:
@@ -103,11 +89,7 @@ def run_de_novo(task):
             shutil.rmtree(Path(unmapped_assembly_cwd, output_folder_name), ignore_errors=True)
             
             final_cmd = assemble_cmd + ['--only-assembler']
-            logger.info('Retry Phase 2 CMD: '+' '.join(final_cmd))
-            utils.write_log_file(task.path.joinpath(task.id), 'Retry Phase 2 CMD: '+' '.join(final_cmd))
-            cmd_run = subprocess.run(final_cmd, cwd=unmapped_assembly_cwd, capture_output=True)
-            print(cmd_run.stdout.decode(encoding='utf-8'))
-            print(cmd_run.stderr.decode(encoding='utf-8'))
+            cmd_run = utils.run_cmd(task, final_cmd, unmapped_assembly_cwd, check=False, label='Retry Phase 2 CMD')
 
     # check if assemble result exists
     contigs_path = Path(unmapped_assembly_cwd, output_folder_name, 'contigs.fasta')
@@ -116,86 +98,279 @@ def run_de_novo(task):
         return -1
 
 
+BLAST_OUTFMT = '6 qseqid sacc pident qlen length evalue stitle bitscore qcovs qstart qend sstart send'
+BLAST_OPTIONS = ['-max_target_seqs', '100', '-max_hsps', '1', '-evalue', '1e-6']
+# blastn runs megablast unless -task is given, the cascade sends contigs without a qualifying hit to sensitive blastn
+SENSITIVE_BLAST_OPTIONS = ['-task', 'blastn'] + BLAST_OPTIONS
+UNKNOWN_DB_DATES = ('Unknown', 'Date not found', 'Error fetching date', 'Error')
+
+
+def blast_chunk_num(task, db_num):
+    # auto: enough chunk x database jobs to give every thread its own blastn
+    blast_chunks = getattr(task, 'blast_chunks', 'auto')
+    if blast_chunks == 'auto':
+        chunk_num = -(-int(task.threads) // db_num)
+    else:
+        chunk_num = int(blast_chunks)
+    return max(1, chunk_num)
+
+
+def split_query_fasta(query_path, chunk_cwd, chunk_num):
+    # Contiguous chunks balanced by total contig length, so merged outputs keep the query order.
+    contigs = list(utils.iter_fasta(query_path))
+    chunk_num = min(chunk_num, len(contigs))
+    if chunk_num <= 1:
+        return [query_path]
+    Path.mkdir(chunk_cwd, parents=True, exist_ok=True)
+    total_len = sum(len(seq) for _, seq in contigs)
+    chunks = [[]]
+    chunk_len = 0
+    for header, seq in contigs:
+        # cut when this chunk reached its share of the total length
+        if len(chunks[-1]) > 0 and chunk_len >= total_len * len(chunks) / chunk_num and len(chunks) < chunk_num:
+            chunks.append([])
+        chunks[-1].append((header, seq))
+        chunk_len += len(seq)
+    chunk_paths = []
+    for i, records in enumerate(chunks):
+        chunk_path = chunk_cwd.joinpath('contigs_chunk_%d.fasta' % (i+1))
+        utils.write_fasta_records(chunk_path, records)
+        chunk_paths.append(chunk_path)
+    return chunk_paths
+
+
+def blast_cell(task, assembled_cwd, m_env, db, query_path, output_path, blast_options):
+    blast_cmd = [
+        'blastn',
+        '-db',
+        db,
+        '-query',
+        str(query_path),
+        '-out',
+        str(output_path),
+        '-outfmt',
+        BLAST_OUTFMT,
+        '-num_threads',
+        task.threads,
+    ] + blast_options
+    utils.run_cmd(task, blast_cmd, assembled_cwd, env=m_env)
+
+
+def merge_chunk_outputs(chunk_output_paths, output_path):
+    # chunks are contiguous slices of the query, concatenation gives the single blastn output
+    with open(output_path, 'wb') as out:
+        for chunk_output_path in chunk_output_paths:
+            with open(chunk_output_path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(chunk_output_path)
+
+
+def run_blast_jobs(task, assembled_cwd, m_env, db_queries, blast_options):
+    # db_queries: [(db, query_path, output_path)], the query may differ per database (e.g. contigs not cached).
+    # chunk x database blastn jobs share the task thread budget, outputs are merged per database.
+    if len(db_queries) == 0:
+        return
+    chunk_root = assembled_cwd.joinpath('blast_chunks')
+    chunk_num = blast_chunk_num(task, len(db_queries))
+    cells = []
+    chunk_outputs = []
+    for db, query_path, output_path in db_queries:
+        chunk_cwd = chunk_root.joinpath(Path(output_path).name)
+        chunk_paths = split_query_fasta(query_path, chunk_cwd, chunk_num)
+        logger.info('BLASTing %d query chunks against %s.' % (len(chunk_paths), db))
+        if len(chunk_paths) == 1:
+            cells.append((assembled_cwd, m_env, db, chunk_paths[0], output_path, blast_options))
+            continue
+        chunk_output_paths = []
+        for i, chunk_path in enumerate(chunk_paths):
+            chunk_output_path = chunk_cwd.joinpath('%s.chunk_%d' % (Path(output_path).name, i+1))
+            cells.append((assembled_cwd, m_env, db, chunk_path, chunk_output_path, blast_options))
+            chunk_output_paths.append(chunk_output_path)
+        chunk_outputs.append((chunk_output_paths, output_path))
+    utils.fan_out(task, blast_cell, cells)
+    for chunk_output_paths, output_path in chunk_outputs:
+        merge_chunk_outputs(chunk_output_paths, output_path)
+    shutil.rmtree(chunk_root, ignore_errors=True)
+
+
+def blast_db_date(task, db, assembled_cwd, m_env):
+    # Get the date information for the current BLAST database
+    db_date = "Unknown"
+    try:
+        info_cmds = [['blastdbcmd', '-db', db, '-info'], ['awk', '/^Date:/ {print $2, $3, $4}']]
+        cmd_result = utils.run_pipeline(task, info_cmds, assembled_cwd, capture=True, env=m_env)
+        db_date = cmd_result.stdout.strip()
+        if not db_date:
+            db_date = "Date not found"
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Failed to get info for BLAST DB '{db}'. Error: {e}")
+        db_date = "Error fetching date"
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while fetching DB info for '{db}': {e}")
+        db_date = "Error"
+    return db_date
+
+
+def read_hits_by_query(blast_result_path):
+    # qseqid -> hit lines without the qseqid column, in output order
+    hits_by_query = {}
+    if blast_result_path.is_file():
+        with open(blast_result_path, 'r') as f:
+            for line in f:
+                qseqid, hit = line.rstrip('\n').split('\t', 1)
+                hits_by_query.setdefault(qseqid, []).append(hit)
+    return hits_by_query
+
+
+def write_hits_by_query(blast_result_path, contigs, hits_by_query):
+    with open(blast_result_path, 'w') as out:
+        for header, _ in contigs:
+            qseqid = header.split()[0]
+            for hit in hits_by_query.get(qseqid, []):
+                out.write('%s\t%s\n' % (qseqid, hit))
+
+
+def cached_blast_query(task, db, db_date, contigs, query_path, blast_options):
+    # Hits of contigs searched by earlier tasks come from the BLAST cache, the rest are written
+    # to query_path for blastn (None when every contig is cached).
+    db_search_key = blast_cache.search_key(db, db_date, ' '.join(['-outfmt', BLAST_OUTFMT] + blast_options))
+    contig_keys = [blast_cache.contig_key(seq, db_search_key) for _, seq in contigs]
+    cached_hits = blast_cache.lookup(task, contig_keys)
+    uncached_contigs = [c for c, key in zip(contigs, contig_keys) if key not in cached_hits]
+    logger.info('BLAST cache: %d of %d contigs found for %s.' % (len(contigs) - len(uncached_contigs), len(contigs), db))
+    utils.write_log_file(task.path.joinpath(task.id), 'BLAST_CACHE: %s %d/%d contigs cached' % (
+        db, len(contigs) - len(uncached_contigs), len(contigs)))
+    if len(uncached_contigs) == 0:
+        return None, contig_keys, cached_hits
+    utils.write_fasta_records(query_path, uncached_contigs)
+    return query_path, contig_keys, cached_hits
+
+
+def merge_cached_hits(task, db, db_date, contigs, contig_keys, cached_hits, blast_result_path):
+    # blastn output of the uncached contigs is stored per contig (no hits is stored too), then the result
+    # is rewritten in the order of the query, the same as one blastn over all contigs.
+    new_hits = read_hits_by_query(blast_result_path)
+    hits_by_query = {}
+    new_entries = {}
+    for (header, seq), key in zip(contigs, contig_keys):
+        qseqid = header.split()[0]
+        if key in cached_hits:
+            hits_by_query[qseqid] = cached_hits[key]
+        else:
+            hits_by_query[qseqid] = new_hits.get(qseqid, [])
+            new_entries[key] = hits_by_query[qseqid]
+    write_hits_by_query(blast_result_path, contigs, hits_by_query)
+    if len(new_entries) > 0:
+        blast_cache.store(task, db, db_date, new_entries)
+
+
+def search_contigs(task, assembled_cwd, m_env, db_dates, db_contigs, blast_options, result_suffix=''):
+    # One search round: db_contigs (db -> contig records) are BLASTed with blast_options, through the cache
+    # when enabled. Returns db -> tsv path with the hits in the order of the contig records.
+    all_contigs_path = assembled_cwd.joinpath('contigs.fasta')
+    all_contig_num = sum(1 for _ in utils.iter_fasta(all_contigs_path))
+    db_queries = []
+    cache_states = {}
+    result_paths = {}
+    for db, contigs in db_contigs.items():
+        blast_result_path = assembled_cwd.joinpath('%s_spades_%s_%s%s.tsv'%(task.id, task.unmapped_spades_mode, db, result_suffix))
+        result_paths[db] = blast_result_path
+        query_path = assembled_cwd.joinpath('%s.query.fasta' % blast_result_path.name)
+        if len(contigs) == 0:
+            open(blast_result_path, 'w').close()
+        # the date tells database versions apart, unknown versions are always searched
+        elif blast_cache.cache_enabled(task) and db_dates[db] not in UNKNOWN_DB_DATES:
+            db_query_path, contig_keys, cached_hits = cached_blast_query(
+                task, db, db_dates[db], contigs, query_path, blast_options)
+            cache_states[db] = (contig_keys, cached_hits)
+            if db_query_path != None:
+                db_queries.append((db, db_query_path, blast_result_path))
+        elif len(contigs) == all_contig_num:
+            db_queries.append((db, all_contigs_path, blast_result_path))
+        else:
+            utils.write_fasta_records(query_path, contigs)
+            db_queries.append((db, query_path, blast_result_path))
+    run_blast_jobs(task, assembled_cwd, m_env, db_queries, blast_options)
+    for db, blast_result_path in result_paths.items():
+        if db in cache_states:
+            merge_cached_hits(task, db, db_dates[db], db_contigs[db], *cache_states[db], blast_result_path)
+        query_path = assembled_cwd.joinpath('%s.query.fasta' % blast_result_path.name)
+        if query_path.is_file():
+            os.remove(query_path)
+    return result_paths
+
+
+def blast_hit_qualified(task, hit, min_qcovs=None):
+    # hit passes the report filters, with min_qcovs it also has to cover that much of the contig
+    if not blast_hits_significant_filter(task, hit):
+        return False
+    return min_qcovs == None or float(hit[8]) >= float(min_qcovs)
+
+
+def cascade_search(task, assembled_cwd, m_env, db_dates, blastdbs, contigs):
+    # Databases are searched in order (the primary unmapped_blastdb first). Each database gets a megablast
+    # pass, contigs without a qualifying hit are searched again with sensitive blastn, and contigs resolved
+    # with a qualifying hit covering blast_cascade_qcovs are not sent to the next databases.
+    result_paths = {}
+    pending_contigs = contigs
+    for db in blastdbs:
+        logger.info('BLAST cascade: %d contigs left for %s.' % (len(pending_contigs), db))
+        blast_result_path = search_contigs(task, assembled_cwd, m_env, db_dates, {db: pending_contigs}, BLAST_OPTIONS)[db]
+        hits_by_query = read_hits_by_query(blast_result_path)
+        unresolved_contigs = [
+            (header, seq) for header, seq in pending_contigs
+            if not any(blast_hit_qualified(task, [header.split()[0]] + hit.split('\t'))
+                       for hit in hits_by_query.get(header.split()[0], []))
+        ]
+        if len(unresolved_contigs) > 0:
+            logger.info('BLAST cascade: %d contigs without qualifying megablast hit, searching with blastn.' % len(unresolved_contigs))
+            sensitive_result_path = search_contigs(
+                task, assembled_cwd, m_env, db_dates, {db: unresolved_contigs}, SENSITIVE_BLAST_OPTIONS, '.blastn')[db]
+            sensitive_hits_by_query = read_hits_by_query(sensitive_result_path)
+            for header, _ in unresolved_contigs:
+                hits_by_query[header.split()[0]] = sensitive_hits_by_query.get(header.split()[0], [])
+            os.remove(sensitive_result_path)
+            write_hits_by_query(blast_result_path, pending_contigs, hits_by_query)
+        utils.write_log_file(task.path.joinpath(task.id), 'BLAST_CASCADE: %s %d contigs searched, %d with blastn' % (
+            db, len(pending_contigs), len(unresolved_contigs)))
+        result_paths[db] = blast_result_path
+        pending_contigs = [
+            (header, seq) for header, seq in pending_contigs
+            if not any(blast_hit_qualified(task, [header.split()[0]] + hit.split('\t'), task.blast_cascade_qcovs)
+                       for hit in hits_by_query.get(header.split()[0], []))
+        ]
+    return result_paths
+
+
 def blast_assembled(task):
     logger.info('BLASTing unmapped reads assembled.')
     assembled_cwd = task.path.joinpath(task.id, 'unmapped_analysis', '%s_unmapped_spades_%s'%(task.id, task.unmapped_spades_mode))
-    qeury_filename = 'contigs.fasta'
     if task.unmapped_blastdb_extra_list != None:
         blastdbs = [task.unmapped_blastdb] + task.unmapped_blastdb_extra_list.split()
     else:
         blastdbs = [task.unmapped_blastdb]
     
     highly_match_result_dict = {}
+    # compiled once and shared by all databases of the task
+    if task.rvdb_anno_path != None:
+        annotation_index = rvdb_anno_index.load_index(task.rvdb_anno_path)
+    else:
+        annotation_index = None
     m_env = os.environ.copy()
     m_env['BLASTDB'] = task.blastdb_path
+    contigs = list(utils.iter_fasta(assembled_cwd.joinpath('contigs.fasta')))
+    db_dates = {db: blast_db_date(task, db, assembled_cwd, m_env) for db in blastdbs}
+    if getattr(task, 'blast_cascade', 'False') == 'True':
+        result_paths = cascade_search(task, assembled_cwd, m_env, db_dates, blastdbs, contigs)
+    else:
+        result_paths = search_contigs(task, assembled_cwd, m_env, db_dates, {db: contigs for db in blastdbs}, BLAST_OPTIONS)
     for db in blastdbs:
-        blast_result_filename = '%s_spades_%s_%s.tsv'%(task.id, task.unmapped_spades_mode, db)
-        blast_cmd = [
-            'blastn',
-            '-db',
-            db,
-            '-query',
-            qeury_filename,
-            '-out',
-            blast_result_filename,
-            '-outfmt',
-            '6 qseqid sacc pident qlen length evalue stitle bitscore qcovs qstart qend sstart send',
-            '-num_threads',
-            task.threads,
-            '-max_target_seqs',
-            '100',
-            '-max_hsps',
-            '1',
-            '-evalue',
-            '1e-6',
-        ]
-        logger.info('CMD: '+' '.join(blast_cmd))
-        utils.write_log_file(task.path.joinpath(task.id), 'CMD: '+' '.join(blast_cmd))
-        cmd_run = subprocess.run(blast_cmd, cwd=assembled_cwd, capture_output=True, env=m_env)
-        print(cmd_run.stdout.decode(encoding='utf-8'))
-        print(cmd_run.stderr.decode(encoding='utf-8'))
-    
-        # filter highly matched hits and add annotation from RVDB
+        # keep the best hit of each contig, then format and annotate the winners from RVDB
         logger.info('Filter highly matched hits')
-        blast_result_path = assembled_cwd.joinpath(blast_result_filename)
-        annotation_dict = utils.load_rvdb_anno_tab(task.rvdb_anno_path)
-        filtered_hits_list = []
-        hit = []
-        with open(blast_result_path, 'r') as f:
-            for line in f.readlines():
-                hit = line.strip().split('\t')
-                if blast_hits_significant_filter(task, hit):
-                    filtered_hit = blast_hits_string_formater(db, hit)
-                    filtered_hit = blast_hits_anno_finder(db, filtered_hit, annotation_dict)
-                    filtered_hits_list.append(filtered_hit)
-
-        # Get the date information for the current BLAST database
-        db_date = "Unknown"
-        try:
-            info_cmd = f"blastdbcmd -db {db} -info | awk '/^Date:/ {{print $2, $3, $4}}'"
-
-            cmd_result = subprocess.run(
-                info_cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True,
-                env=m_env
-            )
-            db_date = cmd_result.stdout.strip()
-            if not db_date:
-                db_date = "Date not found"
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to get info for BLAST DB '{db}'. Error: {e.stderr.strip()}")
-            db_date = "Error fetching date"
-        except Exception as e:
-            logger.error(f"An unexpected error occurred while fetching DB info for '{db}': {e}")
-            db_date = "Error"
-    
         highly_match_result_dict[db] = {
             'BLASTdb_name': db,
-            'BLASTdb_date': db_date,
-            'highly_matched_result': blast_hits_max1_bitscore_filter(task, filtered_hits_list)
+            'BLASTdb_date': db_dates[db],
+            'highly_matched_result': reduce_blast_hits(task, db, result_paths[db], annotation_index)
         }
 
     return highly_match_result_dict
@@ -205,27 +380,32 @@ def build_unmapped_json(task, result_dict):
     utils.build_json_file(unmapped_analysis_json_path, result_dict)
 
 
-def blast_hits_max1_bitscore_filter(task, hits_list):
-    filtered_dict = {}
-    filtered_list = []
-    for hit in hits_list:
-        if not hit['qseqid'] in filtered_dict:
-            filtered_dict[hit['qseqid']] = {
-                'current_best_score': Decimal('0'),
-                'hit': {}
-            }
-        if Decimal(hit['bitscore']) > Decimal(filtered_dict[hit['qseqid']]['current_best_score']):
-            filtered_dict[hit['qseqid']]['hit'] = hit.copy()
-            filtered_dict[hit['qseqid']]['current_best_score'] = str(hit['bitscore'])
-    for v in filtered_dict.values():
-        filtered_list.append(v['hit'])
-    return filtered_list
+def reduce_blast_hits(task, db, blast_result_path, annotation_index):
+    # Stream the tabular output and keep only the current best hit of each contig (the first one with
+    # the top bitscore among hits passing the filters), contigs keep the order they first pass in.
+    ident_filter = float(task.unmapped_ident_filter)
+    len_filter = float(task.unmapped_len_filter)
+    best_hits = {}
+    with open(blast_result_path, 'r') as f:
+        for line in f:
+            hit = line.strip().split('\t')
+            if float(hit[2]) < ident_filter or float(hit[4]) < len_filter:
+                continue
+            bitscore = float(hit[7])
+            best_hit = best_hits.get(hit[0])
+            if best_hit == None or bitscore > best_hit[0]:
+                # the line is kept rather than its fields, split again only for the winners
+                best_hits[hit[0]] = (bitscore, line)
+    return [
+        blast_hits_anno_finder(db, blast_hits_string_formater(db, line.strip().split('\t')), annotation_index)
+        for _, line in best_hits.values()
+    ]
 
 
 def blast_hits_significant_filter(task, hit):
-    if Decimal(hit[2]) < Decimal(task.unmapped_ident_filter):
+    if float(hit[2]) < float(task.unmapped_ident_filter):
         return False
-    if Decimal(hit[4]) < Decimal(task.unmapped_len_filter):
+    if float(hit[4]) < float(task.unmapped_len_filter):
         return False
     else:
         return True
@@ -264,26 +444,19 @@ def blast_hits_string_formater(db, hit):
     }
 
 
-def blast_hits_anno_finder(db, hit, annotation):
+def blast_hits_anno_finder(db, hit, annotation_index):
     hit['anno'] = ''
     if db.startswith(("U-RVDB","C-RVDB")):
         clean_sacc = hit.get('clean_sacc')
         sstart = hit.get('sstart')
         send = hit.get('send')
         if clean_sacc and sstart is not None and send is not None:
-            if clean_sacc in annotation:
-                logger.info('Hit matches RVDB annotation.')
-                for anno_entry in annotation[clean_sacc]:
-                    anno_start = anno_entry['start']
-                    anno_end = anno_entry['end']
-                    category = anno_entry['category']
-                    # swap alignment direction to forward if it's not
-                    if sstart > send:
-                        sstart, send = send, sstart
-                    # Check if alignment overlaps annotation range
-                    overlap = not(int(send) < int(anno_start) or int(anno_end) < int(sstart))
-                    if overlap:
-                        hit['anno'] = category
+            if annotation_index != None:
+                # alignment direction is swapped to forward inside the lookup
+                category = rvdb_anno_index.find_category(annotation_index, clean_sacc, int(sstart), int(send))
+                if category != None:
+                    logger.info('Hit matches RVDB annotation.')
+                    hit['anno'] = category
         else:
             logger.warning('Hit result is not completed, skipping.')
     return hit
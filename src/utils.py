@@ -1,11 +1,14 @@
+import collections
+import concurrent.futures
+import copy
 import hashlib
 import json
 import logging
 import os
+import signal
 import subprocess
-import textwrap
+import threading
 import time
-from decimal import Decimal
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -16,29 +19,164 @@ def is_valid_fasta(file_path):
     pass
 
 
-def load_fasta_file(file_path):
-    fasta_dict = {}
+def iter_fasta(file_path):
+    # Yield (header, seq) one record at a time, sequence lines are joined once per record.
     header = ''
+    seq_lines = []
     with open(file_path, 'r', encoding='UTF-8') as f:
-        for line in f.readlines():
+        for line in f:
             if '>' in line:
+                if header != '':
+                    yield header, ''.join(seq_lines)
                 header = line.rstrip().split('>')[1]
-                if len(header) > 0:
-                    fasta_dict[header] = ''
-            else:
+                seq_lines = []
+            elif header != '':
                 # only write base after first ">" symbol
-                if header != '':
-                    fasta_dict[header] += line.rstrip()
-    return fasta_dict
+                seq_lines.append(line.rstrip())
+    if header != '':
+        yield header, ''.join(seq_lines)
 
 
-def build_fasta_file(file_path, fasta_dict):
+def load_fasta_file(file_path):
+    return dict(iter_fasta(file_path))
+
+
+def write_fasta_records(file_path, records, line_width=80, fai=False):
+    # records is any iterable of (header, seq), e.g. iter_fasta of another file.
+    # fai=True also writes <file_path>.fai (samtools faidx format), offsets are known while writing.
+    fai_lines = []
+    offset = 0
     with open(file_path, 'w', encoding='utf-8') as f:
-        for header, seq in fasta_dict.items():
-            splited_seq_list = textwrap.wrap(seq, 80)
-            f.write('>%s\n' % header)
-            for line in splited_seq_list:
-                f.write(line+'\n')
+        for header, seq in records:
+            header_line = '>%s\n' % header
+            seq_text = ''.join(seq[i:i+line_width] + '\n' for i in range(0, len(seq), line_width))
+            f.write(header_line)
+            f.write(seq_text)
+            if fai:
+                offset += len(header_line.encode('utf-8'))
+                line_bases = min(len(seq), line_width)
+                fai_lines.append('%s\t%d\t%d\t%d\t%d\n' % (
+                    header.split()[0], len(seq), offset, line_bases, line_bases + 1))
+                offset += len(seq_text)
+    if fai:
+        build_text_file(str(file_path) + '.fai', ''.join(fai_lines))
+
+
+def build_fasta_file(file_path, fasta_dict, fai=False):
+    write_fasta_records(file_path, fasta_dict.items(), fai=fai)
+
+
+def build_fasta_index(file_path, fai_path=None):
+    # <file_path>.fai of an existing FASTA, one binary pass without holding sequences
+    # entries are [name, length, offset, line bases, line width]
+    fai_entries = []
+    with open(file_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            offset += len(line)
+            if line.startswith(b'>'):
+                fai_entries.append([line[1:].decode('utf-8').split()[0], 0, offset, 0, 0])
+            elif len(fai_entries) > 0:
+                entry = fai_entries[-1]
+                bases = len(line.rstrip(b'\r\n'))
+                if entry[3] == 0:
+                    entry[3], entry[4] = bases, len(line)
+                entry[1] += bases
+    if fai_path == None:
+        fai_path = str(file_path) + '.fai'
+    # concurrent tasks may index the same FASTA, readers only ever see a complete file
+    tmp_fai_path = '%s.tmp-%d-%d' % (fai_path, os.getpid(), threading.get_ident())
+    build_text_file(tmp_fai_path, ''.join('%s\t%d\t%d\t%d\t%d\n' % tuple(e) for e in fai_entries))
+    os.replace(tmp_fai_path, fai_path)
+    return fai_path
+
+
+fasta_indexes = {}
+fasta_indexes_lock = threading.Lock()
+
+
+def sidecar_path(file_path, suffix):
+    # <file_path><suffix> next to the source file, or in the shared index cache (inside the tasks folder,
+    # which is mounted) when its folder is read-only
+    file_path = Path(file_path).resolve()
+    if os.access(file_path.parent, os.W_OK):
+        return Path(str(file_path) + suffix)
+    path_key = hashlib.md5(str(file_path).encode('utf-8')).hexdigest()
+    return Path.cwd().joinpath('tasks', 'index_cache', suffix.lstrip('.'), '%s_%s%s' % (file_path.name, path_key, suffix))
+
+
+def fasta_index_path(file_path):
+    # next to the FASTA like samtools faidx
+    return sidecar_path(file_path, '.fai')
+
+
+def load_fasta_index(file_path):
+    # The .fai is built once per FASTA and rebuilt when the FASTA is newer, the parsed index stays in memory.
+    fai_path = fasta_index_path(file_path)
+    fasta_stat = Path(file_path).stat()
+    with fasta_indexes_lock:
+        key = (str(fai_path), fasta_stat.st_mtime_ns, fasta_stat.st_size)
+        if key not in fasta_indexes:
+            if not fai_path.is_file() or fai_path.stat().st_mtime_ns < fasta_stat.st_mtime_ns:
+                logger.info('Indexing FASTA %s.' % file_path)
+                Path.mkdir(fai_path.parent, parents=True, exist_ok=True)
+                build_fasta_index(file_path, fai_path)
+            entries = []
+            with open(fai_path, 'r') as f:
+                for line in f:
+                    name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                    entries.append((name, int(length), int(offset), int(line_bases), int(line_width)))
+            fasta_indexes[key] = {
+                'entries': entries,
+                'names': {e[0]: n for n, e in reversed(list(enumerate(entries)))}
+            }
+        return fasta_indexes[key]
+
+
+def find_fasta_entry(fasta_index, acc):
+    # exact sequence name first, then BLAST local ids (gnl|BL_ORD_ID|<ordinal>), then a whole '|' field
+    if acc in fasta_index['names']:
+        return fasta_index['entries'][fasta_index['names'][acc]]
+    if acc.startswith('gnl|BL_ORD_ID|') and acc.split('|')[2].isdigit():
+        ordinal = int(acc.split('|')[2])
+        if ordinal < len(fasta_index['entries']):
+            return fasta_index['entries'][ordinal]
+    for entry in fasta_index['entries']:
+        if acc in entry[0].split('|'):
+            return entry
+    return None
+
+
+def read_fasta_entry(f, entry):
+    name, length, offset, line_bases, line_width = entry
+    # the header line ends right before the sequence offset
+    head_start = max(0, offset - 65536)
+    f.seek(head_start)
+    head = f.read(offset - head_start).rstrip(b'\r\n')
+    header_start = head.rfind(b'\n>')
+    header = head[header_start+2:] if header_start != -1 else head[1:]
+    f.seek(offset)
+    if line_bases > 0:
+        seq_bytes = length + (length + line_bases - 1) // line_bases * (line_width - line_bases)
+    else:
+        seq_bytes = 0
+    seq = f.read(seq_bytes).replace(b'\n', b'').replace(b'\r', b'')
+    return header.decode('utf-8').strip(), seq.decode('utf-8')
+
+
+def fetch_fasta_records(file_path, acc_list):
+    # {header: seq} of the accessions found, each record is read in O(record size) through the .fai offsets
+    fasta_index = load_fasta_index(file_path)
+    seq_dict = {}
+    with open(file_path, 'rb') as f:
+        for acc in acc_list:
+            entry = find_fasta_entry(fasta_index, acc)
+            if entry == None:
+                logger.error('Sequence %s not found in %s.' % (acc, file_path))
+                continue
+            header, seq = read_fasta_entry(f, entry)
+            seq_dict[header] = seq
+    return seq_dict
 
 
 def load_json_file(file_path):
@@ -48,9 +186,9 @@ def load_json_file(file_path):
 
 
 def build_json_file(file_path, python_dict):
+    # json.dumps encodes in C, json.dump to a file falls back to the pure Python encoder
     with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(python_dict, f)
-    pass
+        f.write(json.dumps(python_dict))
 
 
 def build_text_file(file_path, text):
@@ -83,6 +221,24 @@ def load_rvdb_anno_tab(file_path):
         return {}
     return annotation_data
 
+
+def iter_vcf_records(file_path):
+    # Yield the fields of each record line, header lines are skipped.
+    column_num = None
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.startswith('##'):
+                continue
+            elif line.startswith('#'):
+                column_num = len(line[1:].strip().split('\t'))
+            else:
+                vc = line.strip().split('\t')
+                if len(vc) == column_num:
+                    yield vc
+                else:
+                    logger.error('Parsing VCF error.')
+
+
 def load_vcf_file(file_path):
     vcf_dict = {'comments': [], 'column_names': [], 'vc': []}
     with open(file_path, 'r') as f:
@@ -103,6 +259,312 @@ def load_vcf_file(file_path):
         return vcf_dict
 
 
+def split_threads(threads, n):
+    # split a thread budget into n shares (at least 1 each), remainder goes to the first shares
+    threads = int(threads)
+    base, rest = divmod(threads, n)
+    return [max(1, base + (1 if i < rest else 0)) for i in range(n)]
+
+
+def fan_out(task, cell_func, cells, min_cell_threads=1):
+    # Run cell_func(task, *cell) for independent cells (e.g. aligner x ref_order) in parallel under task.threads.
+    # Each cell gets its share of threads in a task copy, results keep the order of cells.
+    cells = list(cells)
+    if len(cells) == 0:
+        return []
+    workers = min(len(cells), max(1, int(task.threads) // min_cell_threads))
+    if len(cells) <= workers:
+        cell_threads_list = split_threads(task.threads, len(cells))
+    else:
+        cell_threads_list = [max(1, int(task.threads) // workers)] * len(cells)
+
+    def run_cell(cell, cell_threads):
+        cell_task = copy.copy(task)
+        cell_task.threads = str(cell_threads)
+        return cell_func(cell_task, *cell)
+
+    if workers == 1:
+        return [run_cell(cell, t) for cell, t in zip(cells, cell_threads_list)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_cell, cells, cell_threads_list))
+
+
+cmd_log_lock = threading.Lock()
+cmd_log_counters = {}
+# external commands started and not reaped yet, killed by cancel_cmds when a task fails
+running_cmds = set()
+running_cmds_lock = threading.Lock()
+cmds_cancelled = threading.Event()
+
+
+def cmd_log_prefix(task, cmd):
+    # tasks/<id>/cmd_logs/0001_bowtie2, numbered in start order and continued on resume
+    log_dir = task.path.joinpath(task.id, 'cmd_logs')
+    with cmd_log_lock:
+        if log_dir not in cmd_log_counters:
+            Path.mkdir(log_dir, parents=True, exist_ok=True)
+            cmd_log_counters[log_dir] = len(list(log_dir.glob('*.err.log')))
+        cmd_log_counters[log_dir] += 1
+        return log_dir.joinpath('%04d_%s' % (cmd_log_counters[log_dir], Path(cmd[0]).name))
+
+
+def log_tail(file_path, lines=20):
+    with open(file_path, 'r', errors='replace') as f:
+        return ''.join(collections.deque(f, lines))
+
+
+def start_cmd(task, cmd, cwd, stdin=None, stdout=None, env=None):
+    # stderr (and stdout when not consumed) are streamed into the command log files, not into Python memory
+    if cmds_cancelled.is_set():
+        raise RuntimeError('Task cancelled, %s not started.' % cmd[0])
+    log_prefix = cmd_log_prefix(task, cmd)
+    err_path = Path(str(log_prefix) + '.err.log')
+    files = []
+    with open(err_path, 'wb') as err:
+        if stdout == None:
+            stdout = open(str(log_prefix) + '.out.log', 'wb')
+            files.append(stdout)
+        try:
+            cmd_run = subprocess.Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout, stderr=err, env=env)
+        finally:
+            for f in files:
+                f.close()
+    cmd_run.cmd = cmd
+    cmd_run.err_path = err_path
+    cmd_run.out_path = Path(str(log_prefix) + '.out.log')
+    # each process is reaped by its own thread, so the wall time ends when the process ends, not when it is joined
+    cmd_run.waiter = threading.Thread(
+        target=reap_cmd, args=(task, cmd_run, log_prefix.name, time.time(), time.monotonic()), daemon=True)
+    cmd_run.waiter.start()
+    with running_cmds_lock:
+        running_cmds.add(cmd_run)
+        cancelled = cmds_cancelled.is_set()
+    if cancelled:
+        kill_cmd(cmd_run)
+    return cmd_run
+
+
+def read_proc_io(io_path):
+    # /proc/<pid>/io counters, read_bytes/write_bytes are the bytes which reached the storage layer
+    try:
+        with open(io_path) as f:
+            return {k: int(v) for k, v in (line.split(':') for line in f if ':' in line)}
+    except OSError:
+        return {}
+
+
+def reap_cmd(task, cmd_run, log_name, start_time, start_monotonic):
+    # Leave the exited process as a zombie first, its /proc/<pid>/io then covers the waited descendants too.
+    try:
+        os.waitid(os.P_PID, cmd_run.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        pass
+    io = read_proc_io('/proc/%d/io' % cmd_run.pid)
+    # wait4 gives the rusage of the process and its waited descendants (e.g. spades.py and spades-core)
+    _, status, rusage = os.wait4(cmd_run.pid, 0)
+    with running_cmds_lock:
+        running_cmds.discard(cmd_run)
+    wall_time = time.monotonic() - start_monotonic
+    cmd_run.returncode = os.waitstatus_to_exitcode(status)
+    record_cmd_metrics(task, {
+        'log': log_name,
+        'stage': getattr(task, 'stage_name', None),
+        'tool': Path(cmd_run.cmd[0]).name,
+        'cmd': ' '.join(cmd_run.cmd),
+        'threads': str(getattr(task, 'threads', '')),
+        'start_time': round(start_time, 3),
+        'wall_time': round(wall_time, 3),
+        'user_time': round(rusage.ru_utime, 3),
+        'sys_time': round(rusage.ru_stime, 3),
+        'max_rss_kb': rusage.ru_maxrss,
+        'read_bytes': io.get('read_bytes'),
+        'write_bytes': io.get('write_bytes'),
+        'rchar': io.get('rchar'),
+        'wchar': io.get('wchar'),
+        'returncode': cmd_run.returncode
+    })
+
+
+def wait_cmd(cmd_run):
+    cmd_run.waiter.join()
+    return cmd_run.returncode
+
+
+def kill_cmd(cmd_run):
+    # not Popen.kill, its poll() could reap the process before the waiter thread
+    if cmd_run.returncode == None:
+        try:
+            os.kill(cmd_run.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def cancel_cmds():
+    # Kill the running external commands (e.g. SPAdes of a sibling stage) and refuse to start new ones,
+    # the threads waiting on them then fail instead of running to the end.
+    with running_cmds_lock:
+        cmds_cancelled.set()
+        cmd_runs = list(running_cmds)
+    for cmd_run in cmd_runs:
+        kill_cmd(cmd_run)
+
+
+def disk_usage(path):
+    # allocated bytes under path, hardlinked files (e.g. cached indexes) are counted once
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                # removed by a running stage
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+cmd_metrics_lock = threading.Lock()
+
+
+def record_cmd_metrics(task, metrics):
+    # tasks/<id>/cmd_metrics.json, one entry per external command
+    metrics_path = task.path.joinpath(task.id, 'cmd_metrics.json')
+    with cmd_metrics_lock:
+        metrics_list = load_json_file(metrics_path) if metrics_path.is_file() else []
+        metrics_list.append(metrics)
+        build_json_file(metrics_path, metrics_list)
+
+
+def check_cmds(cmd_runs):
+    for cmd_run in cmd_runs:
+        if cmd_run.returncode != 0:
+            logger.error('%s exited with code %d, log: %s\n%s' % (
+                cmd_run.cmd[0], cmd_run.returncode, cmd_run.err_path, log_tail(cmd_run.err_path)))
+            raise subprocess.CalledProcessError(cmd_run.returncode, cmd_run.cmd)
+
+
+def run_pipeline(task, cmds, cwd, stdout_path=None, capture=False, check=True, env=None, label='CMD'):
+    # Run cmds connected by pipes (cmd1 | cmd2 | ...), all processes run at once with bounded pipe buffers.
+    # The last stdout goes to stdout_path, or to its command log file. capture=True returns it as text,
+    # only meant for small outputs (e.g. samtools coverage).
+    cmd_text = ' | '.join(' '.join(cmd) for cmd in cmds)
+    if stdout_path != None:
+        cmd_text += ' > ' + str(stdout_path)
+    logger.info('%s: %s' % (label, cmd_text))
+    write_log_file(task.path.joinpath(task.id), '%s: %s' % (label, cmd_text))
+    cmd_runs = []
+    out_file = open(stdout_path, 'wb') if stdout_path != None else None
+    try:
+        for i, cmd in enumerate(cmds):
+            stdin = None if i == 0 else cmd_runs[-1].stdout
+            stdout = subprocess.PIPE if i < len(cmds)-1 else out_file
+            cmd_run = start_cmd(task, cmd, cwd, stdin=stdin, stdout=stdout, env=env)
+            if i > 0:
+                cmd_runs[-1].stdout.close()
+            cmd_runs.append(cmd_run)
+        for cmd_run in cmd_runs:
+            wait_cmd(cmd_run)
+    except BaseException:
+        for cmd_run in cmd_runs:
+            kill_cmd(cmd_run)
+            wait_cmd(cmd_run)
+        raise
+    finally:
+        if out_file != None:
+            out_file.close()
+    if check:
+        check_cmds(cmd_runs)
+    stdout_text = None
+    if capture:
+        with open(stdout_path if stdout_path != None else cmd_runs[-1].out_path, 'r', errors='replace') as f:
+            stdout_text = f.read()
+    return subprocess.CompletedProcess(cmds[-1], cmd_runs[-1].returncode, stdout=stdout_text)
+
+
+def run_cmd(task, cmd, cwd, **kwargs):
+    return run_pipeline(task, [cmd], cwd, **kwargs)
+
+
+def align_to_sorted_bam(task, align_cmd, sorted_bam, cwd):
+    # Pipe aligner SAM output straight into samtools sort, no SAM file is written to disk.
+    sorting_cmd = [
+        'samtools', 'sort',
+        '-@', str(task.threads),
+        '-m', getattr(task, 'sort_mem', '768M'),
+        '-o', str(sorted_bam),
+        '-'
+    ]
+    run_pipeline(task, [align_cmd, sorting_cmd], cwd)
+
+
+def align_to_depleted_fastq(task, align_cmd, unmapped_fastq_r1, unmapped_fastq_r2, flagstat_path, cwd, mapped_bam=None):
+    # Read the aligner output once and feed it to all consumers at the same time:
+    # unmapped pairs to FASTQ, flagstat counts, and optionally a sorted BAM of the mapped reads only.
+    # The whole library is never sorted, so no full size BAM is written.
+    sinks = []
+    if unmapped_fastq_r1 != None:
+        sinks.append([['samtools', 'fastq', '-f', '13', '-1', str(unmapped_fastq_r1), '-2', str(unmapped_fastq_r2), '-']])
+    flagstat_sink = [['samtools', 'flagstat', '-']]
+    sinks.append(flagstat_sink)
+    if mapped_bam != None:
+        sinks.append([
+            ['samtools', 'view', '-u', '-F', '4', '-'],
+            ['samtools', 'sort', '-@', str(task.threads), '-m', getattr(task, 'sort_mem', '768M'), '-o', str(mapped_bam), '-']
+        ])
+    cmd_text = ' '.join(align_cmd) + ' | tee ' + ' '.join(
+        '>(%s)' % ' | '.join(' '.join(cmd) for cmd in sink) for sink in sinks)
+    logger.info('CMD: '+cmd_text)
+    write_log_file(task.path.joinpath(task.id), 'CMD: '+cmd_text)
+
+    cmd_runs = []
+    sink_stdins = []
+    flagstat_file = open(flagstat_path, 'wb')
+    try:
+        align_run = start_cmd(task, align_cmd, cwd, stdout=subprocess.PIPE)
+        cmd_runs.append(align_run)
+        for sink in sinks:
+            for i, cmd in enumerate(sink):
+                if i == len(sink)-1:
+                    stdout = flagstat_file if sink is flagstat_sink else None
+                else:
+                    stdout = subprocess.PIPE
+                stdin = subprocess.PIPE if i == 0 else cmd_runs[-1].stdout
+                cmd_run = start_cmd(task, cmd, cwd, stdin=stdin, stdout=stdout)
+                if i == 0:
+                    sink_stdins.append(cmd_run.stdin)
+                else:
+                    cmd_runs[-1].stdout.close()
+                cmd_runs.append(cmd_run)
+
+        open_stdins = list(sink_stdins)
+        for chunk in iter(lambda: align_run.stdout.read(1048576), b""):
+            for stdin in list(open_stdins):
+                try:
+                    stdin.write(chunk)
+                except BrokenPipeError:
+                    open_stdins.remove(stdin)
+        align_run.stdout.close()
+        for stdin in sink_stdins:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+        for cmd_run in cmd_runs:
+            wait_cmd(cmd_run)
+    except BaseException:
+        for cmd_run in cmd_runs:
+            kill_cmd(cmd_run)
+            wait_cmd(cmd_run)
+        raise
+    finally:
+        flagstat_file.close()
+    check_cmds(cmd_runs)
+
+
 def write_log_file(log_path, text):
     log_file_path = log_path.joinpath('log.txt')
     with open(log_file_path, 'a') as f:
@@ -117,27 +579,31 @@ def load_log_file(log_path):
 
 
 def load_blast_fmt6_max1_bitscore(file_path):
-    fmt6_dict = {}
+    # streamed, only the first top-bitscore hit of each query is kept and formatted
+    best_hits = {}
     with open(file_path, 'r') as f:
-        for line in f.readlines():
+        for line in f:
             hit = line.strip().split('\t')
-            if hit[0] in fmt6_dict:
-                if Decimal(hit[11]) <= Decimal(fmt6_dict[hit[0]]['bitscore']):
-                    continue
-            fmt6_dict[hit[0]] = {
-                'qseqid': hit[0],
-                'sseqid': hit[1],
-                'pident': hit[2],
-                'length': hit[3],
-                'mismatch': hit[4],
-                'gapopen': hit[5],
-                'qstart': hit[6],
-                'qend': hit[7],
-                'sstart': hit[8],
-                'send': hit[9],
-                'evalue': hit[10],
-                'bitscore': hit[11]
-            }
+            bitscore = float(hit[11])
+            if hit[0] in best_hits and bitscore <= best_hits[hit[0]][0]:
+                continue
+            best_hits[hit[0]] = (bitscore, hit)
+    fmt6_dict = {}
+    for qseqid, (_, hit) in best_hits.items():
+        fmt6_dict[qseqid] = {
+            'qseqid': hit[0],
+            'sseqid': hit[1],
+            'pident': hit[2],
+            'length': hit[3],
+            'mismatch': hit[4],
+            'gapopen': hit[5],
+            'qstart': hit[6],
+            'qend': hit[7],
+            'sstart': hit[8],
+            'send': hit[9],
+            'evalue': hit[10],
+            'bitscore': hit[11]
+        }
     return fmt6_dict
 
 
@@ -153,45 +619,34 @@ def build_fmt6_file(file_path, fmt6_dict):
 def find_top_score_hits(fmt6_dict):
     top_hit = {}
     for hit in fmt6_dict.values():
-        if Decimal(hit['bitscore']) > Decimal(top_hit.get('bitscore', 0)):
+        if float(hit['bitscore']) > float(top_hit.get('bitscore', 0)):
             top_hit = hit.copy()
     return top_hit
 
 
 def extract_seq_from_fasta(file_path, target_acc):
-    seq_dict = {}
-    extracting = False
-    target_header = ''
-    with open(file_path, 'r') as f:
-        for line in f.readlines():
-            if target_acc in line:
-                extracting = True
-                target_header = line.strip()[1:]
-                seq_dict[target_header] = ''
-                continue
-            if extracting:
-                if line.startswith('>'):
-                    return seq_dict
-                else:
-                    seq_dict[target_header] += line.strip()
+    return fetch_fasta_records(file_path, [target_acc])
 
 
 def load_blast_fmt_sciname_max1_bitscore(file_path):
-    fmt6_dict = {}
+    best_hits = {}
     with open(file_path, 'r') as f:
-        for line in f.readlines():
+        for line in f:
             hit = line.strip().split('\t')
-            if hit[0] in fmt6_dict:
-                if Decimal(hit[4]) <= Decimal(fmt6_dict[hit[0]]['bitscore']):
-                    continue
-            fmt6_dict[hit[0]] = {
-                'sseqid': hit[1],
-                'pident': hit[2],
-                'length': hit[3],
-                'bitscore': hit[4],
-                'sci': hit[5],
-                'common': hit[6]
-            }
+            bitscore = float(hit[4])
+            if hit[0] in best_hits and bitscore <= best_hits[hit[0]][0]:
+                continue
+            best_hits[hit[0]] = (bitscore, hit)
+    fmt6_dict = {}
+    for qseqid, (_, hit) in best_hits.items():
+        fmt6_dict[qseqid] = {
+            'sseqid': hit[1],
+            'pident': hit[2],
+            'length': hit[3],
+            'bitscore': hit[4],
+            'sci': hit[5],
+            'common': hit[6]
+        }
     return fmt6_dict
 
 
@@ -236,6 +691,38 @@ def conda_pkg_versions(pkg_list):
         return -1
 
 
+# path -> (size, mtime_ns, md5) of files whose md5 is already known in this process
+known_md5s = {}
+known_md5s_lock = threading.Lock()
+
+
+def file_stat(file_path):
+    stat = Path(file_path).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def remember_md5(file_path, md5):
+    with known_md5s_lock:
+        known_md5s[str(file_path)] = tuple(file_stat(file_path)) + (md5,)
+
+
+def known_md5(file_path):
+    # md5 recorded for the file, None when unknown or the file changed since
+    with known_md5s_lock:
+        known = known_md5s.get(str(file_path))
+    if known == None or list(known[:2]) != file_stat(file_path):
+        return None
+    return known[2]
+
+
+def file_md5(file_path):
+    hashmd5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            hashmd5.update(chunk)
+    return hashmd5.hexdigest()
+
+
 def md5_check(file_path, md5_string):
     try:
         logger.info('Checking md5 hash.')
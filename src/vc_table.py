@@ -0,0 +1,213 @@
+import logging
+import mmap
+import os
+import threading
+from array import array
+from decimal import Decimal
+
+import utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MAGIC = b'VIVAVCT1'
+# byte order marker, counts (ref_num, rows, strings) and offsets of the sections
+HEADER_LEN = 4
+# callers in the order of the vc_summary.json tables
+CALLERS = ['lofreq', 'varscan']
+# Row columns. Text columns hold codes into the string table, the VCF text is kept for the JSON and report,
+# freq (AF in percent, as reported), dp and qual are the typed values for filtering.
+# superseded marks a row replaced by a later call of the same caller/ref/pos/alt/aligner.
+INT_COLUMNS = [
+    'ref_order', 'pos', 'dp', 'superseded',
+    'caller', 'aligner', 'ref', 'alt', 'filter', 'freq_text', 'qual_text', 'dp_text'
+]
+FLOAT_COLUMNS = ['freq', 'qual']
+SECTIONS = INT_COLUMNS + FLOAT_COLUMNS + ['string_offsets', 'strings']
+
+
+def table_path(task):
+    return task.path.joinpath(task.id, task.id + '_vc_table.bin')
+
+
+def varscan_calls(vcf_path):
+    # (pos, ref, alt, filter, freq, qual, dp) of the variant lines, FORMAT is GT:GQ:SDP:DP:RD:AD:FREQ:...
+    for fields in utils.iter_vcf_records(vcf_path):
+        if fields[4] != '.':
+            sample = fields[9].split(':')
+            yield fields[1], fields[3], fields[4], fields[6], sample[6], sample[1], sample[2]
+
+
+def lofreq_calls(vcf_path):
+    # calls with AF >= 10%, INFO starts with DP=..;AF=..
+    af_texts = {}
+    for fields in utils.iter_vcf_records(vcf_path):
+        info = fields[7].split(';')
+        af = info[1].split('=')[1]
+        if float(af) >= 0.1:
+            # formatted with Decimal as before, many calls share the same AF
+            if af not in af_texts:
+                af_texts[af] = '%.02f%%' % (Decimal(af)*Decimal('100'))
+            yield fields[1], fields[3], fields[4], fields[6], af_texts[af], fields[5], info[0].split('=')[1]
+
+
+def to_int(text, default=-1):
+    return int(text) if text.isdigit() else default
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+
+def build_table(task):
+    # Rows are ordered like a walk of the nested vc_summary.json (caller, ref, pos, alt, aligner),
+    # each level in first seen order.
+    first_seen = {}
+    rows = []
+    for ref_order in range(1, task.ref_num+1):
+        for aligner in task.alns:
+            vcf_prefix = task.path.joinpath(task.id, 'alignment', aligner, '%s_%s_ref_%d' % (task.id, aligner, ref_order))
+            for caller, calls in (
+                    ('varscan', varscan_calls('%s_varscan.vcf' % vcf_prefix)),
+                    ('lofreq', lofreq_calls('%s_lofreq.vcf' % vcf_prefix))):
+                for pos, ref, alt, vc_filter, freq, qual, dp in calls:
+                    pos_key = (caller, ref_order, pos)
+                    alt_key = pos_key + (alt,)
+                    aligner_key = alt_key + (aligner,)
+                    order = (
+                        CALLERS.index(caller), ref_order,
+                        first_seen.setdefault(pos_key, len(first_seen)),
+                        first_seen.setdefault(alt_key, len(first_seen)),
+                        first_seen.setdefault(aligner_key, len(first_seen)),
+                        len(rows))
+                    rows.append((order, aligner_key, (caller, ref_order, pos, ref, alt, aligner, vc_filter, freq, qual, dp)))
+    rows.sort(key=lambda r: r[0])
+    calls = [r[2] for r in rows]
+    aligner_keys = [r[1] for r in rows]
+
+    # strings are coded in first seen order, the codes of a column are filled in one pass
+    string_codes = {}
+    columns = {
+        'ref_order': array('q', [c[1] for c in calls]),
+        'pos': array('q', [int(c[2]) for c in calls]),
+        'dp': array('q', [to_int(c[9]) for c in calls]),
+        'superseded': array('q', [
+            1 if i+1 < len(aligner_keys) and aligner_keys[i+1] == aligner_keys[i] else 0
+            for i in range(len(aligner_keys))
+        ]),
+        'freq': array('d', [to_float(c[7][:-1]) for c in calls]),
+        'qual': array('d', [to_float(c[8]) for c in calls])
+    }
+    for k, field in (('caller', 0), ('aligner', 5), ('ref', 3), ('alt', 4), ('filter', 6),
+                     ('freq_text', 7), ('qual_text', 8), ('dp_text', 9)):
+        columns[k] = array('q', [string_codes.setdefault(c[field], len(string_codes)) for c in calls])
+    return {
+        'ref_num': task.ref_num,
+        'columns': columns,
+        'strings': list(string_codes)
+    }
+
+
+def row_num(table):
+    return len(table['columns']['pos'])
+
+
+def column_lists(table, names):
+    # whole columns as lists, the consumers zip over them instead of indexing the arrays row by row
+    return [table['columns'][k].tolist() for k in names]
+
+
+def save_table(table, path):
+    string_offsets = array('q', [0])
+    string_bytes = bytearray()
+    for text in table['strings']:
+        string_bytes += text.encode('utf-8')
+        string_offsets.append(len(string_bytes))
+    sections = dict(table['columns'], string_offsets=string_offsets, strings=string_bytes)
+
+    header = array('q', [1, table['ref_num'], row_num(table), len(table['strings'])])
+    section_bytes = []
+    pos = len(MAGIC) + (HEADER_LEN + len(SECTIONS)) * 8
+    for k in SECTIONS:
+        data = bytes(sections[k])
+        header.append(pos)
+        # 8-byte aligned sections
+        data += b'\0' * (-len(data) % 8)
+        section_bytes.append(data)
+        pos += len(data)
+    tmp_path = '%s.tmp-%d-%d' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(header.tobytes())
+        for data in section_bytes:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_table(path):
+    # columns are memoryviews over the mapped file, the string table is decoded once
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError('Not a variant table: %s' % path)
+    header = view[len(MAGIC):len(MAGIC) + (HEADER_LEN + len(SECTIONS)) * 8].cast('q')
+    if header[0] != 1:
+        raise ValueError('Variant table written on a host of the other byte order: %s' % path)
+    ref_num, rows, string_num = header[1], header[2], header[3]
+    offsets = dict(zip(SECTIONS, header[HEADER_LEN:]))
+    columns = {k: view[offsets[k]:offsets[k] + rows * 8].cast('q') for k in INT_COLUMNS}
+    columns.update({k: view[offsets[k]:offsets[k] + rows * 8].cast('d') for k in FLOAT_COLUMNS})
+    string_offsets = view[offsets['string_offsets']:offsets['string_offsets'] + (string_num + 1) * 8].cast('q')
+    string_bytes = bytes(view[offsets['strings']:offsets['strings'] + string_offsets[-1]])
+    return {
+        'mmap': mm,
+        'ref_num': ref_num,
+        'columns': columns,
+        'strings': [string_bytes[string_offsets[i]:string_offsets[i+1]].decode('utf-8') for i in range(string_num)]
+    }
+
+
+def pos_refs(table):
+    # REF of a position is the one of its first call, like the REF of a position in vc_summary.json
+    refs = {}
+    for caller, ref_order, pos, ref in zip(*column_lists(table, ['caller', 'ref_order', 'pos', 'ref'])):
+        refs.setdefault((caller, ref_order, pos), ref)
+    return refs
+
+
+def variant_rows(table):
+    # (ref_order, pos, REF, alt, caller, bowtie2 FREQ, bwa FREQ) per called alt, in the order of a walk of
+    # vc_summary.json by ref, caller, pos and alt. Superseded calls are left out like in the JSON.
+    strings = table['strings']
+    refs = pos_refs(table)
+    rows = {}
+    for caller, ref_order, pos, alt, aligner, freq, superseded in zip(*column_lists(table, [
+            'caller', 'ref_order', 'pos', 'alt', 'aligner', 'freq_text', 'superseded'])):
+        if superseded:
+            continue
+        key = (ref_order, CALLERS.index(strings[caller]), pos, alt)
+        if key not in rows:
+            rows[key] = [ref_order, str(pos), strings[refs[(caller, ref_order, pos)]], strings[alt], strings[caller], None, None]
+        rows[key][5 if strings[aligner] == 'bowtie2' else 6] = strings[freq]
+    # rows are in caller, ref order, the stable sort keeps the pos and alt order within each ref and caller
+    return [tuple(row) for key, row in sorted(rows.items(), key=lambda r: r[0][:2])]
+
+
+def table_to_vc_dict(table):
+    # {caller: {ref_order: {pos: {'REF': ref, 'SNV': {alt: {aligner: {...}}}}}}}, the vc_summary.json layout
+    strings = table['strings']
+    vc_dict = {caller: {ref_order: {} for ref_order in range(1, table['ref_num']+1)} for caller in CALLERS}
+    for caller, ref_order, pos, ref, alt, aligner, vc_filter, freq, qual, dp in zip(*column_lists(table, [
+            'caller', 'ref_order', 'pos', 'ref', 'alt', 'aligner', 'filter', 'freq_text', 'qual_text', 'dp_text'])):
+        ref_dict = vc_dict[strings[caller]][ref_order]
+        pos = str(pos)
+        if pos not in ref_dict:
+            ref_dict[pos] = {'REF': strings[ref], 'SNV': {}}
+        ref_dict[pos]['SNV'].setdefault(strings[alt], {})[strings[aligner]] = {
+            'FILTER': strings[vc_filter], 'FREQ': strings[freq], 'QUAL': strings[qual], 'DP': strings[dp]
+        }
+    return vc_dict
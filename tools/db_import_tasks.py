@@ -33,7 +33,8 @@ def import_task(task_dir, db):
         parts = task_id.rsplit('_', 1)
         if len(parts) == 2:
             task_name = parts[0]
-            date_part = parts[1]
+            # task ID suffix is YYYYMMDDHHMM or YYYYMMDDHHMM-xxxxxx
+            date_part = parts[1].split('-')[0]
             if len(date_part) == 12 and date_part.isdigit():
                 start_date = f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]} {date_part[8:10]}:{date_part[10:12]}:00"
         